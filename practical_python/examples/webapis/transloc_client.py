@@ -0,0 +1,245 @@
+"""
+
+Reusable client for the Transloc web API.
+
+Using `requests.get(...)` directly is fine for one-off scripts, but each call opens a new TCP (and TLS)
+connection to the server, which often takes longer than the request itself.
+A `requests.Session` keeps connections open ("keep-alive") and re-uses them for subsequent requests.
+The client also sets a default timeout (requests waits forever by default), and retries failed
+requests with exponential backoff.
+
+The Transloc `vehicle_statuses` and `routes` endpoints take a comma-separated list of agency IDs,
+so we can get data for many agencies in a single request instead of one request per agency.
+
+Responses are parsed incrementally (see `practical_python.utils.json_utils`), so records we are not
+interested in, e.g. vehicles on other routes, are discarded while parsing instead of being kept in memory.
+
+Usage:
+    >>> client = TranslocClient()
+    >>> vehicles = client.vehicle_statuses([64, 52])
+
+Refs:
+* http://docs.python-requests.org/en/master/user/advanced/#session-objects
+* https://urllib3.readthedocs.io/en/latest/reference/urllib3.util.html#urllib3.util.Retry
+
+"""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from practical_python.utils.json_utils import iter_json_array
+from practical_python.utils import metrics
+
+TRANSLOC_URL = "https://feeds.transloc.com/3/"
+
+
+def agencies_param(agency_ids):
+    """Format one or more agency IDs as a comma-separated string, e.g. [64, 52] -> "64,52"."""
+    if isinstance(agency_ids, (int, str)):
+        return str(agency_ids)
+    return ",".join(str(agency_id) for agency_id in agency_ids)
+
+
+class TranslocClient:
+    """Client for the Transloc API, using a pooled session with keep-alive, timeouts and retries.
+
+    Args:
+        base_url: Base URL of the Transloc API.
+        timeout: Request timeout in seconds, either a single value or a (connect, read) tuple.
+        retries: Number of times to retry failed requests (connection errors and 429/5xx responses).
+        backoff_factor: Wait `backoff_factor * 2**(retry-1)` seconds between retries.
+        pool_maxsize: Maximum number of connections to keep open (per host).
+        batch_size: Maximum number of agencies to request in a single request.
+    """
+
+    def __init__(self, base_url=TRANSLOC_URL, timeout=(3.05, 10), retries=3, backoff_factor=0.5,
+                 pool_maxsize=10, batch_size=50):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.session = requests.Session()
+        retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=frozenset(['GET', 'HEAD']), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_maxsize, pool_maxsize=pool_maxsize, max_retries=retry)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Close all open connections."""
+        self.session.close()
+
+    def get(self, endpoint, params=None, **kwargs):
+        """Make a GET request to the given endpoint, e.g. 'agencies', and return the response."""
+        kwargs.setdefault('timeout', self.timeout)
+        with metrics.timer('http'):
+            res = self.session.get(self.base_url + endpoint, params=params, **kwargs)
+        metrics.count('http_requests')
+        if not kwargs.get('stream'):
+            metrics.count('http_bytes', len(res.content))  # Already downloaded, unless streaming.
+        return res
+
+    def get_json(self, endpoint, params=None, **kwargs):
+        """Make a GET request to the given endpoint and return the parsed json data."""
+        res = self.get(endpoint, params=params, **kwargs)
+        res.raise_for_status()
+        with metrics.timer('parse'):
+            return res.json()
+
+    def iter_records(self, endpoint, key, params=None, predicate=None, fields=None, chunk_size=64*1024):
+        """Yield records in the `key` list of the endpoint's response one at a time, as they are parsed.
+
+        Args:
+            endpoint: API endpoint, e.g. 'agencies'.
+            key: Entry in the response data with the list of records, e.g. 'agencies'.
+            params: Request parameters.
+            predicate: If given, only yield records for which `predicate(record)` is true.
+            fields: If given, only keep these fields of each record.
+            chunk_size: Number of bytes to read at a time.
+
+        If the generator is closed before all records have been read, the rest of the response is not downloaded.
+        """
+        res = self.get(endpoint, params=params, stream=True)
+        try:
+            res.raise_for_status()
+            # When streaming, the body is downloaded while parsing, so 'parse' includes the download time:
+            chunks = metrics.counted_iter(res.iter_content(chunk_size), 'http_bytes')
+            records = iter_json_array(chunks, key, predicate=predicate, fields=fields)
+            yield from metrics.timed_iter(records, 'parse')
+        finally:
+            res.close()
+
+    def find_record(self, endpoint, key, predicate, params=None):
+        """Return the first record for which `predicate(record)` is true, or None. Stops reading when found.
+
+        Examples:
+            >>> client.find_record('agencies', 'agencies', lambda agency: agency['short_name'] == "MASCO")
+        """
+        records = self.iter_records(endpoint, key, params=params, predicate=predicate)
+        try:
+            return next(records, None)
+        finally:
+            records.close()
+
+    def _get_batched(self, endpoint, key, agency_ids, predicate=None):
+        """Get `key` entries from `endpoint` for all `agency_ids`, using as few requests as possible."""
+        if isinstance(agency_ids, (int, str)):
+            agency_ids = [agency_ids]
+        agency_ids = list(agency_ids)
+        records = []
+        for start in range(0, len(agency_ids), self.batch_size):
+            params = dict(agencies=agencies_param(agency_ids[start:start+self.batch_size]))
+            records.extend(self.iter_records(endpoint, key, params=params, predicate=predicate))
+        return records
+
+    def agencies(self):
+        """Return list of all agencies."""
+        return list(self.iter_records('agencies', 'agencies'))
+
+    def routes(self, agency_ids):
+        """Return list of all routes for the given agency ID(s)."""
+        return self._get_batched('routes', 'routes', agency_ids)
+
+    def vehicle_statuses(self, agency_ids, route_ids=None):
+        """Return list of real-time vehicle statuses for the given agency ID(s).
+
+        If `route_ids` is given, only vehicles on these routes are returned.
+        """
+        predicate = None
+        if route_ids is not None:
+            route_ids = {route_ids} if isinstance(route_ids, (int, str)) else set(route_ids)
+            predicate = lambda vehicle: vehicle['route_id'] in route_ids  # noqa: E731
+        return self._get_batched('vehicle_statuses', 'vehicles', agency_ids, predicate=predicate)
+
+
+class StubTranslocHandler(BaseHTTPRequestHandler):
+    """Request handler for a local stub Transloc server, serving the data in `server.data`.
+
+    `server.data` is a dict with 'agencies', 'routes' and 'vehicles' lists.
+    Requests are logged to `server.requests_log` as (client_address, path, params) tuples.
+    """
+
+    protocol_version = "HTTP/1.1"  # Required for keep-alive.
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        self.server.requests_log.append((self.client_address, url.path, params))
+        if self.server.fail_next:
+            self.server.fail_next -= 1
+            return self._send(503, {'success': False})
+        endpoint = url.path.rsplit("/", 1)[-1]
+        key = {'agencies': 'agencies', 'routes': 'routes', 'vehicle_statuses': 'vehicles'}.get(endpoint)
+        if key is None:
+            return self._send(404, {'success': False})
+        records = self.server.data.get(key, [])
+        if 'agencies' in params and key != 'agencies':
+            agency_ids = {int(agency_id) for agency_id in params['agencies'].split(",")}
+            records = [record for record in records if record.get('agency_id') in agency_ids]
+        self._send(200, {'success': True, key: records})
+
+    def _send(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server(data, host="127.0.0.1", port=0):
+    """Start a stub Transloc server in a background thread, serving `data`.
+
+    Returns:
+        The server. The API base URL is "http://%s:%s/3/" % server.server_address.
+        Call `server.shutdown()` to stop it.
+    """
+    server = ThreadingHTTPServer((host, port), StubTranslocHandler)
+    server.data = data
+    server.requests_log = []
+    server.fail_next = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def test_transloc_client():
+    data = {
+        'agencies': [dict(id=64, short_name="MASCO"), dict(id=52, short_name="Harvard")],
+        'vehicles': [dict(id=1, agency_id=64, route_id=4008182), dict(id=2, agency_id=52, route_id=1),
+                     dict(id=3, agency_id=12, route_id=2)],
+    }
+    server = start_stub_server(data)
+    try:
+        base_url = "http://%s:%s/3/" % server.server_address
+        with TranslocClient(base_url=base_url, backoff_factor=0, batch_size=1) as client:
+            assert [agency['id'] for agency in client.agencies()] == [64, 52]
+            assert [bus['id'] for bus in client.vehicle_statuses([64, 52])] == [1, 2]
+            client.batch_size = 10
+            assert [bus['id'] for bus in client.vehicle_statuses([64, 52, 12])] == [1, 2, 3]
+            assert server.requests_log[-1][2] == {'agencies': "64,52,12"}
+            # All requests should re-use the same connection:
+            assert len({client_address for client_address, path, params in server.requests_log}) == 1
+            assert [bus['id'] for bus in client.vehicle_statuses([64, 52], route_ids=[1])] == [2]
+            assert client.find_record('agencies', 'agencies', lambda agency: agency['id'] == 52)['short_name'] == "Harvard"
+            # Failed requests are retried:
+            server.fail_next = 2
+            assert len(client.vehicle_statuses(64)) == 1
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    test_transloc_client()
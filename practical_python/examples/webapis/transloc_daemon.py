@@ -0,0 +1,317 @@
+"""
+
+Long-running service polling Transloc, and serving the current bus proximity results over local HTTP.
+
+Running `transloc_realtime_locations_02.py` from cron every few seconds spends most of its time starting
+the Python interpreter, importing numpy and requests, loading the metadata cache, and opening a new
+connection to the Transloc server. The service instead does all of that once, and then keeps its state warm:
+
+* The `TranslocClient` session, with its open (keep-alive) connections.
+* The `MetadataCache`, so agency and route IDs are looked up once, at start-up. Restart the service to pick up
+  changed IDs.
+* The latest `VehicleSnapshot`, with a spatial index over the vehicle positions, which is used to answer
+  both the configured proximity queries and ad-hoc `/near` queries without re-fetching anything.
+
+Endpoints (all return json, except /metrics):
+* GET /proximity          Vehicles within `radius` of each target, e.g. {"targets": {"LMA": [...]}}.
+* GET /vehicles           All vehicles in the latest snapshot.
+* GET /near?lat=&lon=&radius=   Vehicles near any position, using the warm spatial index.
+* GET /health             Time of the last successful poll, and the number of polls.
+* GET /metrics            Prometheus text metrics, if started with `--metrics` (see `practical_python.utils.metrics`).
+
+Usage:
+    transloc-daemon --agency MASCO --route M2 --target LMA 42.3378699 -71.1024789 --port 8765
+    curl http://127.0.0.1:8765/proximity
+
+Or on a Unix socket, which is only accessible to local users with permissions to the socket file:
+    transloc-daemon --socket /tmp/transloc.sock
+    curl --unix-socket /tmp/transloc.sock http://localhost/proximity
+
+"""
+import argparse
+import asyncio
+import json
+import os
+import socketserver
+import stat
+import threading
+import time
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+
+from practical_python.examples.webapis.transloc_client import TranslocClient, start_stub_server
+from practical_python.examples.webapis.transloc_metadata import MetadataCache
+from practical_python.examples.webapis.transloc_poller import Feed, VehiclePoller
+from practical_python.examples.webapis.transloc_replay import replay_client
+from practical_python.examples.webapis.transloc_snapshot import VehicleSnapshot
+from practical_python.utils import metrics
+from practical_python.utils.metrics import PrometheusFileHook, format_prometheus
+
+# The M2 LMA bus stop, the default target:
+lma_pos = (42.3378699, -71.1024789)  # lat, lon
+
+# State derived from the latest snapshot. Replaced as a whole on each poll, so request handlers always see
+# a consistent state without locking:
+ServiceState = namedtuple('ServiceState', 'snapshot index proximity')
+
+
+class ProximityService:
+    """Poll vehicles on a route, and keep track of the vehicles near each target position.
+
+    Args:
+        agency: Agency ID or name, e.g. "MASCO".
+        route: Route ID or name, e.g. "M2".
+        targets: Dict of {name: (lat, lon)} positions to monitor.
+        radius: Proximity radius, in km.
+        interval: Time between polls, in seconds.
+        client: `TranslocClient` to use. A new client is created if not given.
+        cachefn: Metadata cache file (see `MetadataCache`).
+    """
+
+    def __init__(self, agency="MASCO", route="M2", targets=None, radius=1.0, interval=5.0, client=None,
+                 cachefn=None):
+        self.client = client if client is not None else TranslocClient()
+        self.metadata = MetadataCache(cachefn, session=self.client.session, base_url=self.client.base_url)
+        self.agency_id = self.metadata.get('agencies', agency)['id']
+        self.route_id = self.metadata.get('routes', route, agency_id=self.agency_id)['id']
+        self.targets = dict(targets) if targets else {"LMA": lma_pos}
+        self.radius = radius
+        self.poller = VehiclePoller([Feed(self.agency_id, route_ids=[self.route_id], interval=interval)],
+                                    client=self.client)
+        empty = VehicleSnapshot.from_records([])
+        self.state = ServiceState(empty, empty.index(cell_size=radius), {name: empty for name in self.targets})
+        self.polls = 0
+        self.last_poll = None
+
+    def update(self, feed_snapshot):
+        """Update the state with a new `FeedSnapshot` from the poller."""
+        snapshot = VehicleSnapshot.from_records(feed_snapshot.vehicles, timestamp=feed_snapshot.timestamp)
+        index = snapshot.index(cell_size=self.radius)
+        with metrics.timer('distance'):
+            proximity = {name: snapshot[np.sort(index.query_radius(pos, self.radius))]
+                         for name, pos in self.targets.items()}
+        self.state = ServiceState(snapshot, index, proximity)
+        self.polls += 1
+        self.last_poll = time.time()
+        metrics.report()
+
+    def run(self, max_polls=None):
+        """Poll forever (or `max_polls` times), updating the state after each poll. Blocking."""
+        asyncio.run(self.poller.run(self.update, max_polls=max_polls))
+
+    def near(self, pos, radius):
+        """Return the vehicles in the latest snapshot within `radius` km of `pos`, as a `VehicleSnapshot`."""
+        state = self.state
+        return state.snapshot[np.sort(state.index.query_radius(pos, radius))]
+
+    def proximity(self):
+        """Return dict with the current proximity results, ready to be serialized as json."""
+        state = self.state
+        return {
+            'timestamp': state.snapshot.timestamp,
+            'radius': self.radius,
+            'targets': {name: list(vehicles.records()) for name, vehicles in state.proximity.items()},
+        }
+
+
+class ProximityRequestHandler(BaseHTTPRequestHandler):
+    """Request handler serving the state of `server.service`, a `ProximityService`."""
+
+    protocol_version = "HTTP/1.1"  # Keep-alive, so clients can poll the service without reconnecting.
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        service = self.server.service
+        if url.path == "/proximity":
+            return self._send(200, service.proximity())
+        elif url.path == "/vehicles":
+            state = service.state
+            return self._send(200, {'timestamp': state.snapshot.timestamp, 'vehicles': list(state.snapshot.records())})
+        elif url.path == "/near":
+            try:
+                pos = (float(params['lat']), float(params['lon']))
+                radius = float(params.get('radius', service.radius))
+            except (KeyError, ValueError):
+                return self._send(400, {'error': "Parameters `lat` and `lon` (and optionally `radius`) are required."})
+            return self._send(200, {'vehicles': list(service.near(pos, radius).records())})
+        elif url.path == "/health":
+            return self._send(200, {'status': "ok" if service.polls else "starting", 'polls': service.polls,
+                                    'last_poll': service.last_poll})
+        elif url.path == "/metrics":
+            active = metrics.get_metrics()
+            if active is None:
+                return self._send(404, {'error': "Metrics are not enabled."})
+            return self._send(200, format_prometheus(active.snapshot()).encode(),
+                              content_type="text/plain; version=0.0.4")
+        self._send(404, {'error': "Unknown endpoint %r." % url.path})
+
+    def _send(self, status, data, content_type="application/json"):
+        body = data if isinstance(data, bytes) else json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        return str(self.client_address[0]) if self.client_address else "unix-socket"
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """HTTP server listening on a Unix socket."""
+
+    daemon_threads = True
+
+
+def serve(service, host="127.0.0.1", port=8765, socket_path=None):
+    """Serve `service` over HTTP in a background thread, on `host`:`port` or on the Unix socket `socket_path`.
+
+    A socket left over from a previous run is replaced, but any other existing file at `socket_path` is not.
+
+    Returns:
+        The server. Call `server.shutdown()` to stop it.
+    """
+    if socket_path:
+        if os.path.lexists(socket_path):
+            if not stat.S_ISSOCK(os.lstat(socket_path).st_mode):
+                raise ValueError("%r exists and is not a socket, refusing to replace it." % (socket_path,))
+            os.remove(socket_path)  # Left over from a previous run.
+        server = ThreadingUnixHTTPServer(socket_path, ProximityRequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), ProximityRequestHandler)
+    server.service = service
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def parse_args(argv=None):
+    ap = argparse.ArgumentParser(description="Poll Transloc and serve vehicle proximity results over local HTTP.")
+    ap.add_argument("--agency", default="MASCO", help="Agency ID or name.")
+    ap.add_argument("--route", default="M2", help="Route ID or name.")
+    ap.add_argument("--target", nargs=3, action='append', metavar=("NAME", "LAT", "LON"),
+                    help="Position to monitor (can be given multiple times). Default is the LMA M2 stop.")
+    ap.add_argument("--radius", type=float, default=1.0, help="Proximity radius, in km.")
+    ap.add_argument("--interval", type=float, default=5.0, help="Time between polls, in seconds.")
+    ap.add_argument("--host", default="127.0.0.1", help="Host/interface to listen on.")
+    ap.add_argument("--port", type=int, default=8765, help="Port to listen on.")
+    ap.add_argument("--socket", metavar="PATH", help="Listen on this Unix socket instead of host/port.")
+    ap.add_argument("--cache", default="transloc_cache.json", help="Metadata cache file.")
+    ap.add_argument("--replay", metavar="FILE", help="Replay recorded responses instead of polling Transloc.")
+    ap.add_argument("--speed", type=float, default=1.0, help="Replay speed, relative to real time.")
+    ap.add_argument("--metrics", action='store_true', help="Enable instrumentation, served at /metrics.")
+    ap.add_argument("--metrics-file", metavar="FILE", help="Also write metrics to this Prometheus text file.")
+    return ap.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.metrics or args.metrics_file:
+        metrics.enable(hooks=[PrometheusFileHook(args.metrics_file)] if args.metrics_file else [])
+    client = TranslocClient()
+    if args.replay:
+        replay_client(client, args.replay, speed=args.speed)
+    agency = int(args.agency) if args.agency.isdigit() else args.agency
+    route = int(args.route) if args.route.isdigit() else args.route
+    targets = {name: (float(lat), float(lon)) for name, lat, lon in args.target} if args.target else None
+    service = ProximityService(agency, route, targets=targets, radius=args.radius, interval=args.interval,
+                               client=client, cachefn=args.cache)
+    server = serve(service, host=args.host, port=args.port, socket_path=args.socket)
+    print("Serving on %s" % (args.socket or "http://%s:%s/" % server.server_address[:2]))
+    try:
+        service.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+        client.close()
+    return 0
+
+
+def test_proximity_service():
+    import socket
+    import tempfile
+    import requests
+
+    data = {
+        'agencies': [dict(id=64, short_name="MASCO")],
+        'routes': [dict(id=4008182, agency_id=64, short_name="M2", long_name="M2")],
+        'vehicles': [dict(id=1, agency_id=64, route_id=4008182, call_name="1101", position=[42.3380, -71.1025]),
+                     dict(id=2, agency_id=64, route_id=4008182, call_name="1102", position=[42.3745, -71.1189]),
+                     dict(id=3, agency_id=64, route_id=1, call_name="1201", position=[42.3380, -71.1025])],
+    }
+    stub = start_stub_server(data)
+    try:
+        client = TranslocClient(base_url="http://%s:%s/3/" % stub.server_address, backoff_factor=0)
+        service = ProximityService("MASCO", "M2", targets={"LMA": lma_pos, "Harvard Sq": (42.3736, -71.1190)},
+                                   interval=0.01, client=client)
+        assert (service.agency_id, service.route_id) == (64, 4008182)
+        server = serve(service, port=0)
+        base_url = "http://%s:%s/" % server.server_address[:2]
+        try:
+            assert requests.get(base_url + "health").json()['status'] == "starting"
+            with metrics.instrumented():
+                service.run(max_polls=2)
+                assert "transloc_stage_calls_total" in requests.get(base_url + "metrics").text
+            assert requests.get(base_url + "metrics").status_code == 404
+
+            proximity = requests.get(base_url + "proximity").json()
+            assert {name: [bus['id'] for bus in buses] for name, buses in proximity['targets'].items()} == {
+                "LMA": [1], "Harvard Sq": [2]}
+            assert [bus['id'] for bus in requests.get(base_url + "vehicles").json()['vehicles']] == [1, 2]
+            near = requests.get(base_url + "near", params=dict(lat=42.3745, lon=-71.1189, radius=0.1)).json()
+            assert [bus['id'] for bus in near['vehicles']] == [2]
+            assert requests.get(base_url + "near").status_code == 400
+            assert requests.get(base_url + "health").json()['polls'] == 2
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        # The same service on a Unix socket:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            socket_path = os.path.join(tmpdir, "transloc.sock")
+            server = serve(service, socket_path=socket_path)
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                    sock.connect(socket_path)
+                    sock.sendall(b"GET /proximity HTTP/1.0\r\nHost: localhost\r\n\r\n")
+                    response = b""
+                    while True:
+                        chunk = sock.recv(65536)
+                        if not chunk:
+                            break
+                        response += chunk
+                headers, body = response.split(b"\r\n\r\n", 1)
+                assert headers.startswith(b"HTTP/1.1 200")
+                assert [bus['id'] for bus in json.loads(body)['targets']['LMA']] == [1]
+            finally:
+                server.shutdown()
+                server.server_close()
+            # The socket left over from the previous server is replaced, but a regular file is not:
+            server = serve(service, socket_path=socket_path)
+            server.shutdown()
+            server.server_close()
+            regular_fn = os.path.join(tmpdir, "notes.txt")
+            with open(regular_fn, 'w') as fd:
+                fd.write("Not a socket")
+            try:
+                serve(service, socket_path=regular_fn)
+            except ValueError:
+                pass
+            else:
+                raise AssertionError("Expected ValueError for a socket path that is a regular file.")
+            with open(regular_fn) as fd:
+                assert fd.read() == "Not a socket"
+    finally:
+        stub.shutdown()
+        stub.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+"""
+
+Track changes between consecutive snapshots of vehicle statuses.
+
+Most vehicles barely move between two polls, so re-processing every vehicle on every poll is mostly wasted work.
+`SnapshotTracker` compares each new `VehicleSnapshot` with the previous one, matching vehicles by id,
+and only reports what changed:
+
+* 'arrived':      A vehicle that was not in the previous snapshot.
+* 'departed':     A vehicle that is no longer in the snapshot.
+* 'moved':        A vehicle that has moved more than `move_threshold` km since the last time it was reported as moved.
+* 'stop_changed': A vehicle whose `current_stop_id` changed.
+* 'entered', 'exited': A vehicle entered or exited one of the geofences.
+
+Geofences are only evaluated for vehicles that arrived or moved, using the position they were last reported at.
+The threshold thus also sets the precision of the geofence events.
+
+Each snapshot from the poller only has the vehicles of a single feed, so the tracker keeps separate state for
+each feed. Otherwise, the vehicles of all other feeds would depart with every update.
+
+Usage:
+    >>> tracker = SnapshotTracker(move_threshold=0.05, geofences=[CircleGeofence(lma_pos, 1.0, name="LMA")])
+    >>> async for feed_snapshot in poller.snapshots():
+    ...     snapshot = VehicleSnapshot.from_records(feed_snapshot.vehicles, timestamp=feed_snapshot.timestamp)
+    ...     for event in tracker.update(snapshot, feed=feed_snapshot.feed):
+    ...         print(event)
+
+"""
+from collections import namedtuple
+import numpy as np
+
+from practical_python.utils.geo_utils import dist_rowwise, CircleGeofence
+from practical_python.examples.webapis.transloc_snapshot import VehicleSnapshot
+
+# `data` is a dict with event-specific details, e.g. the new position of a moved vehicle:
+VehicleEvent = namedtuple('VehicleEvent', 'kind vehicle_id timestamp data')
+
+# State of the known vehicles in a feed, sorted by vehicle id: their last reported positions, current stop IDs,
+# and whether each vehicle is inside each geofence:
+TrackerState = namedtuple('TrackerState', 'ids positions stop_ids inside')
+
+
+class SnapshotTracker:
+    """Compare consecutive vehicle snapshots and emit events for the changes.
+
+    Args:
+        move_threshold: Minimum distance in km a vehicle must move before a 'moved' event is emitted.
+        geofences: Objects with a `name` attribute and a `contains(positions)` method, e.g. `CircleGeofence`,
+            `PolygonGeofence` or `CorridorGeofence`.
+    """
+
+    def __init__(self, move_threshold=0.05, geofences=()):
+        self.move_threshold = move_threshold
+        self.geofences = list(geofences)
+        self.states = {}  # {feed: TrackerState}
+        self.updated_ids = np.empty(0, dtype=np.int64)  # Vehicles that arrived or moved in the last update.
+
+    def state(self, feed=None):
+        """Return the `TrackerState` of the given feed (empty if the feed has not been updated yet)."""
+        state = self.states.get(feed)
+        if state is None:
+            state = TrackerState(np.empty(0, dtype=np.int64), np.empty((0, 2)), np.empty(0, dtype=np.int64),
+                                 np.empty((0, len(self.geofences)), dtype=bool))
+        return state
+
+    def _geofence_events(self, vehicle_ids, inside_before, inside_after, timestamp):
+        events = []
+        for row, col in zip(*np.nonzero(inside_before != inside_after)):
+            kind = 'entered' if inside_after[row, col] else 'exited'
+            events.append(VehicleEvent(kind, vehicle_ids[row].item(), timestamp,
+                                       {'geofence': self.geofences[col].name}))
+        return events
+
+    def update(self, snapshot, feed=None):
+        """Update state with a new snapshot, and return list of `VehicleEvent` for everything that changed.
+
+        Args:
+            snapshot: `VehicleSnapshot` with all vehicles in the feed.
+            feed: Key of the feed the snapshot is from, e.g. `FeedSnapshot.feed`. Vehicles are only compared
+                with the previous snapshot of the same feed. Use None if each snapshot has the whole fleet.
+        """
+        prev = self.state(feed)
+        timestamp = snapshot.timestamp
+        snapshot = snapshot[np.argsort(snapshot.id, kind='stable')]
+        ids, positions, stop_ids = snapshot.id, snapshot.positions, snapshot.current_stop_id
+        _, prev_idx, cur_idx = np.intersect1d(prev.ids, ids, assume_unique=True, return_indices=True)
+        departed = np.setdiff1d(np.arange(len(prev.ids)), prev_idx, assume_unique=True)
+        arrived = np.setdiff1d(np.arange(len(ids)), cur_idx, assume_unique=True)
+        events = []
+
+        for i in departed:
+            events.append(VehicleEvent('departed', prev.ids[i].item(), timestamp,
+                                       {'position': prev.positions[i].tolist()}))
+            # Vehicles leaving the feed also leave all geofences they were in:
+            for col in np.flatnonzero(prev.inside[i]):
+                events.append(VehicleEvent('exited', prev.ids[i].item(), timestamp,
+                                           {'geofence': self.geofences[col].name}))
+        for i in arrived:
+            events.append(VehicleEvent('arrived', ids[i].item(), timestamp, {'position': positions[i].tolist()}))
+
+        # Carry over state for vehicles that have not moved; use the new position for the others:
+        new_positions = positions.copy()
+        new_positions[cur_idx] = prev.positions[prev_idx]
+        dists = dist_rowwise(prev.positions[prev_idx], positions[cur_idx])
+        moved = dists > self.move_threshold
+        new_positions[cur_idx[moved]] = positions[cur_idx[moved]]
+        for i, dist in zip(cur_idx[moved], dists[moved]):
+            events.append(VehicleEvent('moved', ids[i].item(), timestamp,
+                                       {'position': positions[i].tolist(), 'distance': float(dist)}))
+
+        stop_changed = prev.stop_ids[prev_idx] != stop_ids[cur_idx]
+        for i, j in zip(prev_idx[stop_changed], cur_idx[stop_changed]):
+            events.append(VehicleEvent('stop_changed', ids[j].item(), timestamp,
+                                       {'previous': prev.stop_ids[i].item(), 'current': stop_ids[j].item()}))
+
+        # Only evaluate geofences for vehicles that arrived or moved:
+        updated = np.concatenate([arrived, cur_idx[moved]])
+        inside = np.zeros((len(ids), len(self.geofences)), dtype=bool)
+        inside[cur_idx] = prev.inside[prev_idx]
+        if len(updated) and self.geofences:
+            inside_before = inside[updated]
+            inside[updated] = np.column_stack([geofence.contains(positions[updated]) for geofence in self.geofences])
+            events.extend(self._geofence_events(ids[updated], inside_before, inside[updated], timestamp))
+
+        self.states[feed] = TrackerState(ids, new_positions, stop_ids, inside)
+        self.updated_ids = ids[np.sort(updated)]
+        return events
+
+
+def test_snapshot_tracker():
+    lma_pos = (42.3378699, -71.1024789)
+    tracker = SnapshotTracker(move_threshold=0.05, geofences=[CircleGeofence(lma_pos, 1.0, name="LMA")])
+
+    def snapshot(timestamp, vehicles):
+        return VehicleSnapshot.from_records([
+            dict(id=vehicle_id, route_id=1, current_stop_id=stop_id, heading=0, speed=0, position=position)
+            for vehicle_id, position, stop_id in vehicles], timestamp=timestamp)
+
+    events = tracker.update(snapshot(0, [(1, (42.3378, -71.1024), 10), (2, (42.40, -71.00), None)]))
+    assert sorted((event.kind, event.vehicle_id) for event in events) == [
+        ('arrived', 1), ('arrived', 2), ('entered', 1)]
+
+    # Vehicle 1 barely moves (no events), vehicle 2 moves into the geofence, vehicle 3 arrives:
+    events = tracker.update(snapshot(1, [(3, (42.0, -71.0), None), (1, (42.3379, -71.1024), 10),
+                                         (2, (42.3390, -71.1020), 11)]))
+    assert sorted((event.kind, event.vehicle_id) for event in events) == [
+        ('arrived', 3), ('entered', 2), ('moved', 2), ('stop_changed', 2)]
+    assert tracker.updated_ids.tolist() == [2, 3]
+
+    # Small movements accumulate until the threshold is reached:
+    events = tracker.update(snapshot(2, [(1, (42.3378 + 0.0003, -71.1024), 10), (2, (42.3390, -71.1020), 11)]))
+    assert sorted((event.kind, event.vehicle_id) for event in events) == [('departed', 3)]
+    events = tracker.update(snapshot(3, [(1, (42.3378 + 0.0006, -71.1024), 10), (2, (42.3390, -71.1020), 11)]))
+    assert [(event.kind, event.vehicle_id) for event in events] == [('moved', 1)]
+
+    events = tracker.update(snapshot(4, [(1, (42.3378 + 0.0006, -71.1024), 10)]))
+    assert sorted((event.kind, event.vehicle_id) for event in events) == [('departed', 2), ('exited', 2)]
+
+
+def test_snapshot_tracker_feeds():
+    from practical_python.examples.webapis.transloc_poller import Feed
+
+    lma_pos = (42.3378699, -71.1024789)
+    tracker = SnapshotTracker(move_threshold=0.05, geofences=[CircleGeofence(lma_pos, 1.0, name="LMA")])
+    feeds = [Feed(64, interval=5), Feed(52, interval=5)]
+
+    def snapshot(timestamp, vehicles):
+        return VehicleSnapshot.from_records(
+            [dict(id=vehicle_id, position=position) for vehicle_id, position in vehicles], timestamp=timestamp)
+
+    # Snapshots from the two feeds alternate, as delivered by the poller:
+    events = tracker.update(snapshot(0, [(1, (42.3378, -71.1024))]), feed=feeds[0])
+    assert sorted((event.kind, event.vehicle_id) for event in events) == [('arrived', 1), ('entered', 1)]
+    events = tracker.update(snapshot(1, [(2, (42.3379, -71.1024))]), feed=feeds[1])
+    assert sorted((event.kind, event.vehicle_id) for event in events) == [('arrived', 2), ('entered', 2)]
+    for timestamp in range(2, 6):  # No changes, so no events; vehicles of the other feed don't depart:
+        assert tracker.update(snapshot(timestamp, [(1, (42.3378, -71.1024))]), feed=feeds[0]) == []
+        assert tracker.update(snapshot(timestamp, [(2, (42.3379, -71.1024))]), feed=feeds[1]) == []
+    events = tracker.update(snapshot(6, [(2, (42.40, -71.00))]), feed=feeds[1])
+    assert sorted((event.kind, event.vehicle_id) for event in events) == [('exited', 2), ('moved', 2)]
+    assert tracker.state(feeds[0]).ids.tolist() == [1] and tracker.state(feeds[0]).inside.tolist() == [[True]]
+
+
+if __name__ == '__main__':
+    test_snapshot_tracker()
+    test_snapshot_tracker_feeds()
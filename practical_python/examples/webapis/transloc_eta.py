@@ -0,0 +1,322 @@
+"""
+
+Estimate bus arrival times (ETAs) at every stop of a route.
+
+Checking whether a bus is within 1 km of a stop doesn't tell riders when the bus will actually arrive.
+To estimate that, we need to know where along its route each bus is, and how fast it is moving:
+
+1. For each route, the route geometry is computed once (`RouteGeometry`): the route shape as a `Polyline`,
+   with the cumulative distance along the route at each vertex, and the distance along the route to each stop.
+2. On each poll, each bus is projected onto its route, giving its distance along the route.
+   Buses usually only move a little between polls, so the projection only searches the route edges
+   just ahead of where the bus was last time, rather than the whole route (see `Polyline.project`).
+3. Speed is measured from the progress along the route between polls, smoothed with an exponentially
+   weighted moving average. We don't use the reported `speed`, since its units are unclear (see
+   transloc_realtime_locations_02), and it is an instantaneous value, e.g. 0 while waiting at a red light.
+4. The ETA at a downstream stop is then the remaining distance along the route divided by the smoothed speed.
+
+Each snapshot from the poller only has the vehicles of a single feed, so `ETAEngine.update` only replaces
+the vehicles of that feed, and keeps the vehicles (and their speed history) of all other feeds.
+
+Usage:
+    >>> engine = ETAEngine([RouteGeometry.from_metadata(route, stops, segments) for route in routes])
+    >>> async for feed_snapshot in poller.snapshots():
+    ...     snapshot = VehicleSnapshot.from_records(feed_snapshot.vehicles, timestamp=feed_snapshot.timestamp)
+    ...     engine.update(snapshot, feed=feed_snapshot.feed)
+    ...     for stop_id, (vehicle_id, arrival_time) in engine.stop_etas(m2_id).items():
+    ...         print(stop_id, vehicle_id, arrival_time - time.time())
+
+"""
+from collections import namedtuple, defaultdict
+import numpy as np
+
+from practical_python.utils.geo_utils import Polyline, decode_polyline, haversine_py
+
+# Progress of a vehicle along its route, as of the last snapshot:
+VehicleProgress = namedtuple('VehicleProgress', 'route_id timestamp along offset edge speed')
+
+
+class RouteGeometry:
+    """Precomputed geometry of a route: its shape, and the distance along the shape to each stop.
+
+    Args:
+        route_id: Route ID, as used in the `route_id` column of vehicle snapshots.
+        shape: Array-like of shape (M, 2) with the (lat, lon) vertices of the route, in driving order.
+        stop_ids: IDs of the route's stops, in driving order.
+        stop_positions: Array-like of shape (K, 2) with the stop positions. If None, `shape` is taken to be
+            the stop positions, i.e. the route goes in straight lines from stop to stop.
+        loop: Whether the route is a closed loop, i.e. vehicles continue from the end of the shape to the start.
+            If None, the route is taken to be a loop if the shape ends within 50 m of where it starts.
+    """
+
+    def __init__(self, route_id, shape, stop_ids, stop_positions=None, loop=None):
+        self.route_id = route_id
+        self.shape = Polyline(shape)
+        self.stop_ids = list(stop_ids)
+        if loop is None:
+            loop = haversine_py(self.shape.vertices[0], self.shape.vertices[-1]) < 0.05
+        self.loop = loop
+        if stop_positions is None:
+            if len(self.stop_ids) != len(self.shape.vertices):
+                raise ValueError("Need one stop ID per shape vertex when `stop_positions` is not given.")
+            self.stop_along = self.shape.cumulative.copy()
+        else:
+            self.stop_along = self._project_stops(np.asarray(stop_positions, dtype=float).reshape(-1, 2))
+
+    @property
+    def length(self):
+        """Length of the route, in km."""
+        return self.shape.length
+
+    def _project_stops(self, stop_positions):
+        """Return distance along the shape to each stop, making sure each stop comes after the previous one.
+
+        This matters for routes that pass the same place more than once, e.g. going back and forth along
+        the same street: a stop is always matched to the first pass after the previous stop.
+        """
+        all_edges = np.arange(len(self.shape))[None, :]
+        stop_along = np.zeros(len(stop_positions))
+        previous = 0.0
+        for k, pos in enumerate(stop_positions):
+            along, offset = self.shape._project_edges(pos[None, :], all_edges)
+            offset = np.where(self.shape.cumulative[1:] >= previous, offset[0], np.inf)
+            best = np.argmin(offset)
+            previous = stop_along[k] = max(along[0, best], previous)
+        return stop_along
+
+    @classmethod
+    def from_metadata(cls, route, stops, segments=None):
+        """Create route geometry from Transloc metadata records (see `MetadataCache`).
+
+        Args:
+            route: Route record, with an 'id', and a 'stops' list of stop IDs in driving order.
+                If the route has a 'segments' list of `[segment_id, direction]` pairs and `segments` is given,
+                the route shape is made from the segment polylines. Otherwise, straight lines between stops are used.
+            stops: Dict of {stop_id: stop record}, each with a (lat, lon) 'position'.
+            segments: Dict of {segment_id: segment record}, each with encoded polyline 'points'.
+        """
+        stop_positions = [stops[stop_id]['position'] for stop_id in route['stops']]
+        if not segments or not route.get('segments'):
+            return cls(route['id'], stop_positions, route['stops'])
+        shape = []
+        for segment_id, direction in route['segments']:
+            points = decode_polyline(segments[segment_id]['points'])
+            shape.extend(points[::-1] if direction == 'backward' else points)
+        return cls(route['id'], shape, route['stops'], stop_positions=stop_positions)
+
+
+class ETAEngine:
+    """Track vehicle progress along their routes, and estimate arrival times at the stops.
+
+    Args:
+        routes: `RouteGeometry` objects for the routes to track. Vehicles on other routes are ignored.
+        alpha: Smoothing factor for the speed average, between 0 and 1. Higher values follow speed changes faster.
+        default_speed: Speed in km/h assumed for vehicles we have only seen once.
+        min_speed: Lower limit in km/h for the speed used to calculate ETAs, so stopped vehicles get finite ETAs.
+        max_offset: Vehicles farther than this (km) from their route are considered off-route, and get no ETAs.
+        window: Number of route edges ahead of its last position to search when projecting a vehicle.
+    """
+
+    def __init__(self, routes, alpha=0.3, default_speed=15.0, min_speed=3.0, max_offset=0.1, window=8):
+        self.routes = {route.route_id: route for route in routes}
+        self.alpha = alpha
+        self.default_speed = default_speed
+        self.min_speed = min_speed
+        self.max_offset = max_offset
+        self.window = window
+        self.vehicles = {}  # {vehicle_id: VehicleProgress}, for the vehicles of all feeds.
+        self._vehicle_feeds = {}  # {vehicle_id: feed}
+        self._feed_vehicles = {}  # {feed: list of vehicle_ids}
+        self._route_vehicles = defaultdict(dict)  # {route_id: {vehicle_id: None}}, i.e. ordered sets of vehicle_ids.
+        self._stop_etas = {}  # {route_id: stop ETAs}, cleared for the routes changed by each update.
+
+    def update(self, snapshot, feed=None):
+        """Update vehicle progress and speeds with a new `VehicleSnapshot`.
+
+        Args:
+            snapshot: `VehicleSnapshot` with all vehicles in the feed.
+            feed: Key of the feed the snapshot is from, e.g. `FeedSnapshot.feed`. Only the vehicles of this feed
+                are replaced. Use None if each snapshot has the whole fleet.
+        """
+        timestamp = snapshot.timestamp
+        vehicles = {}
+        route_ids, inverse = np.unique(snapshot.route_id, return_inverse=True)
+        for k, route_id in enumerate(route_ids.tolist()):
+            route = self.routes.get(route_id)
+            if route is None:
+                continue
+            rows = np.flatnonzero(inverse == k)
+            ids = snapshot.id[rows].tolist()
+            previous = [self.vehicles.get(vehicle_id) for vehicle_id in ids]
+            previous = [p if p is not None and p.route_id == route_id else None for p in previous]
+            hint = np.array([-1 if p is None else p.edge for p in previous], dtype=np.int64)
+            prev_along = np.array([np.nan if p is None else p.along for p in previous])
+            prev_time = np.array([np.nan if p is None else p.timestamp for p in previous])
+            speed = np.array([self.default_speed if p is None else p.speed for p in previous])
+
+            along, offset, edge = route.shape.project(snapshot.positions[rows], hint=hint, window=self.window,
+                                                      max_offset=self.max_offset, wrap=route.loop,
+                                                      headings=snapshot.heading[rows])
+            progress = along - prev_along
+            if route.loop:
+                progress %= route.length
+                progress[progress > route.length / 2] = 0  # Moved backwards, e.g. GPS jitter.
+            dt = timestamp - prev_time
+            moved = dt > 0  # False for NaN, i.e. vehicles not seen before.
+            instant = np.maximum(progress[moved], 0) / dt[moved] * 3600
+            speed[moved] = self.alpha * instant + (1 - self.alpha) * speed[moved]
+
+            for i in np.flatnonzero(offset <= self.max_offset).tolist():
+                vehicles[ids[i]] = VehicleProgress(route_id, timestamp, along[i].item(), offset[i].item(),
+                                                   edge[i].item(), speed[i].item())
+
+        # Replace the vehicles of this feed, unless they have since been reported by another feed:
+        changed_routes = set()
+        for vehicle_id in self._feed_vehicles.pop(feed, []):
+            if self._vehicle_feeds.get(vehicle_id, feed) == feed:
+                progress = self.vehicles.pop(vehicle_id)
+                del self._vehicle_feeds[vehicle_id]
+                del self._route_vehicles[progress.route_id][vehicle_id]
+                changed_routes.add(progress.route_id)
+        for vehicle_id, progress in vehicles.items():
+            previous = self.vehicles.get(vehicle_id)
+            if previous is not None:  # Moved from another feed.
+                del self._route_vehicles[previous.route_id][vehicle_id]
+                changed_routes.add(previous.route_id)
+            self.vehicles[vehicle_id] = progress
+            self._vehicle_feeds[vehicle_id] = feed
+            self._route_vehicles[progress.route_id][vehicle_id] = None
+            changed_routes.add(progress.route_id)
+        self._feed_vehicles[feed] = list(vehicles)
+        for route_id in changed_routes:
+            self._stop_etas.pop(route_id, None)
+
+    def _arrival_times(self, route, vehicle_ids):
+        """Return (V, K) array with the estimated arrival time of each vehicle at each stop (inf if never)."""
+        progress = [self.vehicles[vehicle_id] for vehicle_id in vehicle_ids]
+        along = np.array([p.along for p in progress])
+        speed = np.maximum([p.speed for p in progress], self.min_speed)
+        timestamps = np.array([p.timestamp for p in progress])
+        remaining = route.stop_along[None, :] - along[:, None]
+        if route.loop:
+            remaining %= route.length
+        else:
+            remaining[remaining < -0.001] = np.inf  # Stops more than 1 m behind the vehicle.
+            remaining = np.maximum(remaining, 0)
+        return timestamps[:, None] + remaining / speed[:, None] * 3600
+
+    def stop_etas(self, route_id):
+        """Return dict of {stop_id: (vehicle_id, arrival_time)} with the next vehicle to arrive at each stop.
+
+        Arrival times are in seconds since epoch. Stops that no vehicle will reach are left out.
+        """
+        if route_id not in self._stop_etas:
+            route = self.routes[route_id]
+            vehicle_ids = list(self._route_vehicles.get(route_id, ()))
+            etas = {}
+            if vehicle_ids:
+                arrivals = self._arrival_times(route, vehicle_ids)
+                best = np.argmin(arrivals, axis=0)
+                for stop_id, i, arrival in zip(route.stop_ids, best.tolist(), arrivals.min(axis=0).tolist()):
+                    if arrival < np.inf and (stop_id not in etas or arrival < etas[stop_id][1]):
+                        etas[stop_id] = (vehicle_ids[i], arrival)
+            self._stop_etas[route_id] = etas
+        return self._stop_etas[route_id]
+
+    def vehicle_etas(self, vehicle_id):
+        """Return list of (stop_id, arrival_time) for the stops ahead of the given vehicle, in order of arrival."""
+        progress = self.vehicles.get(vehicle_id)
+        if progress is None:
+            return []
+        route = self.routes[progress.route_id]
+        arrivals = self._arrival_times(route, [vehicle_id])[0]
+        etas, seen = [], set()
+        for k in np.argsort(arrivals, kind='stable').tolist():
+            # Loop routes often list the first stop again as the last stop; only include it once.
+            if arrivals[k] < np.inf and route.stop_ids[k] not in seen:
+                seen.add(route.stop_ids[k])
+                etas.append((route.stop_ids[k], arrivals[k].item()))
+        return etas
+
+
+def test_eta_engine():
+    from practical_python.examples.webapis.transloc_snapshot import VehicleSnapshot
+
+    # A route going straight north, 0.001 degree (~111 m) between vertices, with a stop every 0.02 degrees:
+    shape = [(42.30 + i * 0.001, -71.10) for i in range(101)]
+    stop_positions = [(42.30 + k * 0.02, -71.10) for k in range(6)]
+    route = RouteGeometry(1, shape, stop_ids=[10, 11, 12, 13, 14, 15], stop_positions=stop_positions)
+    assert not route.loop
+    assert np.allclose(route.stop_along, np.arange(6) * haversine_py(stop_positions[0], stop_positions[1]), rtol=1e-3)
+
+    def snapshot(timestamp, vehicles):
+        return VehicleSnapshot.from_records([
+            dict(id=vehicle_id, route_id=route_id, heading=0, position=position)
+            for vehicle_id, route_id, position in vehicles], timestamp=timestamp)
+
+    engine = ETAEngine([route], alpha=1.0, default_speed=20.0)
+    # Vehicle 1 is on the route, vehicle 2 is off-route, vehicle 3 is on a route we don't track:
+    engine.update(snapshot(0, [(1, 1, (42.31, -71.10)), (2, 1, (42.31, -71.00)), (3, 2, (42.31, -71.10))]))
+    assert list(engine.vehicles) == [1]
+    km_per_deg = haversine_py((42.30, -71.10), (42.40, -71.10)) / 0.1
+    etas = engine.stop_etas(1)
+    assert sorted(etas) == [11, 12, 13, 14, 15]  # Stop 10 is behind the vehicle.
+    assert abs(etas[11][1] - 0.01 * km_per_deg / 20.0 * 3600) < 1.0  # Default speed is used for new vehicles.
+
+    # Vehicle 1 moves 0.01 degrees in 2 minutes; speed is now measured from its progress:
+    engine.update(snapshot(120, [(1, 1, (42.32, -71.10)), (4, 1, (42.375, -71.1001))]))
+    speed = engine.vehicles[1].speed
+    assert abs(speed - 0.01 * km_per_deg / 120 * 3600) < 0.1
+    assert engine.vehicle_etas(1)[0] == (11, 120)  # At the stop now.
+    assert abs(engine.vehicle_etas(1)[1][1] - (120 + 0.02 * km_per_deg / speed * 3600)) < 1.0
+    assert [stop_id for stop_id, _ in engine.vehicle_etas(1)] == [11, 12, 13, 14, 15]
+    # Vehicle 4 (new, at default speed) is ahead of vehicle 1, and arrives first at the last stops:
+    assert {stop_id: vehicle_id for stop_id, (vehicle_id, _) in engine.stop_etas(1).items()} == {
+        11: 1, 12: 1, 13: 1, 14: 4, 15: 4}
+
+    # On a loop route, ETAs wrap around to the stops at the start of the route:
+    square = [(42.30, -71.10), (42.31, -71.10), (42.31, -71.09), (42.30, -71.09), (42.30, -71.10)]
+    loop = RouteGeometry(2, square, stop_ids=[20, 21, 22, 23, 20])
+    assert loop.loop
+    engine = ETAEngine([loop])
+    engine.update(snapshot(0, [(5, 2, (42.305, -71.09))]))  # Between stops 22 and 23.
+    assert [stop_id for stop_id, _ in engine.vehicle_etas(5)] == [23, 20, 21, 22]
+    assert list(engine.stop_etas(2)) == [20, 21, 22, 23]
+
+
+def test_eta_engine_feeds():
+    from practical_python.examples.webapis.transloc_poller import Feed
+    from practical_python.examples.webapis.transloc_snapshot import VehicleSnapshot
+
+    north = RouteGeometry(1, [(42.30 + i * 0.001, -71.10) for i in range(101)], stop_ids=[10, 11],
+                          stop_positions=[(42.30, -71.10), (42.40, -71.10)])
+    east = RouteGeometry(2, [(42.30, -71.10 + i * 0.001) for i in range(101)], stop_ids=[20, 21],
+                         stop_positions=[(42.30, -71.10), (42.30, -71.00)])
+    feeds = [Feed(64, route_ids=[1]), Feed(52, route_ids=[2])]
+
+    def snapshot(timestamp, vehicles):
+        return VehicleSnapshot.from_records([
+            dict(id=vehicle_id, route_id=route_id, heading=heading, position=position)
+            for vehicle_id, route_id, heading, position in vehicles], timestamp=timestamp)
+
+    engine = ETAEngine([north, east], alpha=1.0, default_speed=20.0)
+    # Snapshots from the two feeds alternate, as delivered by the poller:
+    engine.update(snapshot(0, [(1, 1, 0, (42.31, -71.10))]), feed=feeds[0])
+    engine.update(snapshot(1, [(2, 2, 90, (42.30, -71.09))]), feed=feeds[1])
+    engine.update(snapshot(120, [(1, 1, 0, (42.32, -71.10))]), feed=feeds[0])
+    assert sorted(engine.vehicles) == [1, 2] and list(engine.stop_etas(2)) == [21]
+    etas_2 = engine.stop_etas(2)
+    engine.update(snapshot(121, [(2, 2, 90, (42.30, -71.08))]), feed=feeds[1])
+    # Speeds are measured from the previous snapshot of the same vehicle, in each feed:
+    km_per_deg = haversine_py((42.30, -71.10), (42.40, -71.10)) / 0.1
+    assert abs(engine.vehicles[1].speed - 0.01 * km_per_deg / 120 * 3600) < 0.1
+    assert engine.vehicles[2].speed < engine.vehicles[1].speed  # Longitude degrees are shorter.
+    assert engine.stop_etas(1)[11][0] == 1 and engine.stop_etas(2)[21][1] != etas_2[21][1]
+    # Vehicles leaving a feed are removed, without affecting the other feeds:
+    engine.update(snapshot(240, []), feed=feeds[0])
+    assert list(engine.vehicles) == [2] and engine.stop_etas(1) == {} and list(engine.stop_etas(2)) == [21]
+
+
+if __name__ == '__main__':
+    test_eta_engine()
+    test_eta_engine_feeds()
@@ -0,0 +1,256 @@
+"""
+
+Persistent cache for Transloc metadata: agencies, routes, stops and segments.
+
+Agency and route IDs rarely change, so there is no reason to download the full agency catalogue every time
+we need the ID of a single agency. The cache keeps each response in a JSON file, together with the time it
+was fetched and the `ETag`/`Last-Modified` headers from the server. When an entry is older than `ttl`
+seconds, it is refreshed with a conditional request; if the server replies "304 Not Modified", we just
+keep using the data we already have.
+
+Usage:
+    >>> cache = MetadataCache("transloc_cache.json")
+    >>> masco = cache.get('agencies', "MASCO")
+    >>> m2 = cache.get('routes', "M2", agency_id=masco['id'])
+
+Use `offline=True` to only use data already in the cache file, e.g. a previously recorded fixture.
+No requests are made in offline mode, regardless of how old the data is.
+
+Refs:
+* https://developer.mozilla.org/en-US/docs/Web/HTTP/Conditional_requests
+
+"""
+import json
+import os
+import tempfile
+import time
+import warnings
+import requests
+
+from practical_python.utils import metrics
+
+TRANSLOC_URL = "https://feeds.transloc.com/3/"
+
+# Fields used to look up records, in order of precedence:
+LOOKUP_FIELDS = ('id', 'short_name', 'long_name', 'name')
+
+
+class MetadataCache:
+    """Cache for Transloc metadata, with TTL-based refresh, conditional requests and O(1) lookups.
+
+    Args:
+        filename: JSON file to load the cache from and save it to. If None, the cache is only kept in memory.
+        ttl: Time in seconds before cached data is refreshed.
+        offline: If True, never make any requests, only use data from the cache file.
+        session: Object used to make requests, e.g. a `requests.Session`. Defaults to the `requests` module.
+        base_url: Base URL of the Transloc API.
+        timeout: Request timeout, in seconds.
+        retry: Time in seconds to wait before retrying a failed refresh. Until then, the cached data is used.
+    """
+
+    kinds = ('agencies', 'routes', 'stops', 'segments')
+
+    def __init__(self, filename=None, ttl=24*3600, offline=False, session=None, base_url=TRANSLOC_URL, timeout=10,
+                 retry=300):
+        self.filename = filename
+        self.ttl = ttl
+        self.offline = offline
+        self.session = session if session is not None else requests
+        self.base_url = base_url
+        self.timeout = timeout
+        self.retry = retry
+        self._entries = {}  # cache key -> dict(data=..., fetched=..., etag=..., last_modified=...)
+        self._lookups = {}  # cache key -> {field: {lookup value: record}}
+        if filename and os.path.exists(filename):
+            self.load()
+
+    def load(self, filename=None):
+        """Load cached entries from JSON file."""
+        with open(filename or self.filename) as fd:
+            self._entries = json.load(fd)
+        self._lookups.clear()
+
+    def save(self, filename=None):
+        """Save cached entries to JSON file. The file is replaced atomically, so it is never left half-written."""
+        filename = filename or self.filename
+        fd, tmpfn = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), suffix=".tmp")
+        with os.fdopen(fd, 'w') as fd:
+            json.dump(self._entries, fd)
+        os.replace(tmpfn, filename)
+
+    @staticmethod
+    def _key(kind, agency_id=None):
+        return kind if agency_id is None else "%s?agencies=%s" % (kind, agency_id)
+
+    def records(self, kind, agency_id=None):
+        """Return list of all records of the given kind, e.g. all routes for an agency.
+
+        Args:
+            kind: One of 'agencies', 'routes', 'stops', or 'segments'.
+            agency_id: Only get records for this agency. Not used for 'agencies'.
+        """
+        if kind not in self.kinds:
+            raise ValueError("`kind` must be one of %s, got %r." % (self.kinds, kind))
+        key = self._key(kind, agency_id)
+        entry = self._entries.get(key)
+        if self.offline:
+            if entry is None:
+                raise LookupError("%r is not in the cache, and cannot fetch it in offline mode." % key)
+        elif entry is None or (time.time() - entry['fetched'] > self.ttl
+                               and time.time() >= entry.get('retry_at', 0)):
+            entry = self._fetch(kind, agency_id, entry)
+        return entry['data']
+
+    def _fetch(self, kind, agency_id, entry=None):
+        """Fetch data from server, using a conditional request if we already have an older version."""
+        key = self._key(kind, agency_id)
+        params = {} if agency_id is None else dict(agencies=agency_id)
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        try:
+            with metrics.timer('http'):
+                res = self.session.get(self.base_url + kind, params=params, headers=headers, timeout=self.timeout)
+            metrics.count('http_requests')
+            if res.status_code == 304 and entry is not None:
+                entry = dict(entry, fetched=time.time())
+            else:
+                res.raise_for_status()
+                with metrics.timer('parse'):
+                    data = res.json()[kind]
+                entry = dict(data=data, fetched=time.time(),
+                             etag=res.headers.get('ETag'), last_modified=res.headers.get('Last-Modified'))
+                self._lookups.pop(key, None)
+        except requests.RequestException as exc:
+            if entry is None:
+                raise
+            warnings.warn("Could not refresh %r (%s), using cached data for the next %s s." % (key, exc, self.retry))
+            # Keep the entry stale, but don't retry (and warn) on every lookup:
+            self._entries[key] = dict(entry, retry_at=time.time() + self.retry)
+            return entry
+        self._entries[key] = entry
+        if self.filename:
+            self.save()
+        return entry
+
+    def get(self, kind, key, agency_id=None, field=None):
+        """Get a single record by its id, short_name, long_name, or name.
+
+        Args:
+            kind: One of 'agencies', 'routes', 'stops', or 'segments'.
+            key: Value to look up.
+            agency_id: Only get records for this agency. Not used for 'agencies'.
+            field: Only match `key` against this field. By default, the fields in `LOOKUP_FIELDS` are tried in order,
+                so e.g. a record whose id is `key` takes precedence over a record whose name is `key`.
+
+        Raises:
+            KeyError if no record matches `key`.
+
+        Examples:
+            >>> cache.get('agencies', "MASCO")['id']
+            64
+            >>> cache.get('routes', "M2", agency_id=64)['id']
+            4008182
+        """
+        records = self.records(kind, agency_id)
+        cache_key = self._key(kind, agency_id)
+        lookups = self._lookups.setdefault(cache_key, {})
+        for field in (LOOKUP_FIELDS if field is None else (field,)):
+            lookup = lookups.get(field)
+            if lookup is None:
+                # Records with an empty value (None or "") can't be looked up by that field:
+                lookup = lookups[field] = {}
+                for record in records:
+                    if record.get(field) not in (None, ""):
+                        lookup.setdefault(record[field], record)
+            if key in lookup:
+                return lookup[key]
+        raise KeyError("No %s record matching %r." % (kind, key))
+
+
+def test_metadata_cache():
+
+    class FakeResponse:
+        def __init__(self, status_code, data=None, headers=None):
+            self.status_code, self._data, self.headers = status_code, data, headers or {}
+
+        def json(self):
+            return self._data
+
+        def raise_for_status(self):
+            if self.status_code >= 400:
+                raise requests.HTTPError(self.status_code)
+
+    class FakeSession:
+        """Serves a fixed agencies/routes catalogue, honouring If-None-Match."""
+        def __init__(self):
+            self.requests = []
+            self.fail = False
+
+        def get(self, url, params=None, headers=None, timeout=None):
+            self.requests.append((url, params, headers))
+            if self.fail:
+                raise requests.ConnectionError("Connection refused")
+            if headers.get('If-None-Match') == '"v1"':
+                return FakeResponse(304)
+            kind = url.rsplit("/", 1)[-1]
+            data = {
+                'agencies': [dict(id=64, short_name="MASCO", long_name="MASCO", name="masco")],
+                'routes': [dict(id=4008182, short_name="M2", long_name="M2", agency_id=64),
+                           dict(id=4008183, short_name="", long_name="4008182", agency_id=64)],
+            }.get(kind, [])
+            return FakeResponse(200, {kind: data}, headers={'ETag': '"v1"'})
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fn = os.path.join(tmpdir, "cache.json")
+        session = FakeSession()
+        cache = MetadataCache(fn, ttl=3600, session=session)
+        assert cache.get('agencies', "MASCO")['id'] == 64
+        assert cache.get('agencies', 64)['short_name'] == "MASCO"
+        assert cache.get('routes', "M2", agency_id=64)['id'] == 4008182
+        assert cache.get('routes', "M2", agency_id=64)['id'] == 4008182
+        assert len(session.requests) == 2  # Second route lookup served from cache.
+        # Each field has its own lookup, so a name can't shadow an id, and empty values are never matched:
+        assert cache.get('routes', 4008182, agency_id=64)['short_name'] == "M2"
+        assert cache.get('routes', "4008182", agency_id=64)['id'] == 4008183
+        assert cache.get('routes', "M2", agency_id=64, field='long_name')['id'] == 4008182
+        for key, field in [("", None), ("M2", 'name')]:
+            try:
+                cache.get('routes', key, agency_id=64, field=field)
+            except KeyError:
+                pass
+            else:
+                raise AssertionError("Expected KeyError for %r." % (key,))
+
+        # Expired entries are refreshed with a conditional request:
+        cache.ttl = -1
+        assert cache.get('agencies', "MASCO")['id'] == 64
+        assert session.requests[-1][2] == {'If-None-Match': '"v1"'}
+
+        # A failed refresh falls back to the cached data, and is not retried until `retry` seconds later:
+        session.fail = True
+        n_requests = len(session.requests)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            for _ in range(3):
+                assert cache.get('agencies', "MASCO")['id'] == 64
+        assert len(session.requests) == n_requests + 1
+        assert len(caught) == 1
+        session.fail = False
+
+        # Offline mode only uses the recorded cache file:
+        offline = MetadataCache(fn, offline=True, session=None)
+        assert offline.get('routes', 4008182, agency_id=64)['long_name'] == "M2"
+        try:
+            offline.records('stops', agency_id=64)
+        except LookupError:
+            pass
+        else:
+            raise AssertionError("Expected LookupError in offline mode.")
+
+
+if __name__ == '__main__':
+    test_metadata_cache()
@@ -0,0 +1,164 @@
+"""
+
+Fast output of vehicle snapshots, as aligned text, CSV or NDJSON.
+
+Printing one line per vehicle with `print(TAB_LINEFMT.format(**bus))` is slow for large snapshots:
+each vehicle is first converted to a dict, the dict is unpacked to keyword arguments, and each `print` call
+is a separate write to the terminal (or log file), which is often unbuffered or line-buffered.
+
+`SnapshotWriter` instead formats the snapshot column-wise, without creating a dict per vehicle, joins all lines
+into a single string, and writes it with a single `write` call. In 'quiet' mode, nothing is formatted at all.
+
+Usage:
+    >>> writer = SnapshotWriter('tab')  # or 'csv', 'ndjson', 'quiet'
+    >>> writer.write(m2_buses, title="M2 buses")
+
+"""
+import csv
+import io
+import json
+import sys
+import numpy as np
+
+from practical_python.examples.webapis.transloc_snapshot import MISSING_ID
+from practical_python.utils import metrics
+
+FORMATS = ('tab', 'csv', 'ndjson', 'quiet')
+
+# Aligned text output, one line per vehicle. TAB_LINEFMT takes the fields in this order:
+# route_id, call_name, lat, lon, heading, speed, current_stop_id, segment_id.
+TAB_HEADER = "Route, Bus ID \t   Position    \tHeading\tSpeed\tStop\tSegment"
+TAB_LINEFMT = "{0}, {1}\t{2:0.03f}, {3:0.03f}\t{4:>7}\t{5:>4.01f}\t{6}\t{7}"
+
+# Fields in CSV and NDJSON output:
+FIELDS = ('timestamp', 'id', 'agency_id', 'route_id', 'call_name', 'lat', 'lon', 'heading', 'speed',
+          'current_stop_id', 'segment_id')
+
+
+def _id_values(column):
+    """Return list of IDs, with None for missing IDs."""
+    return [None if value == MISSING_ID else value for value in column.tolist()]
+
+
+def _float_values(column):
+    """Return list of values, with None for NaN, and integral values as int (same as `VehicleSnapshot.records`)."""
+    return [None if value != value else int(value) if value.is_integer() else value for value in column.tolist()]
+
+
+def snapshot_columns(snapshot):
+    """Return dict of {field: list of values} for all `FIELDS`, ready for formatting."""
+    return {
+        'timestamp': [snapshot.timestamp] * len(snapshot),
+        'id': _id_values(snapshot.id),
+        'agency_id': _id_values(snapshot.agency_id),
+        'route_id': _id_values(snapshot.route_id),
+        'call_name': snapshot.call_name.tolist(),
+        'lat': snapshot.positions[:, 0].tolist(),
+        'lon': snapshot.positions[:, 1].tolist(),
+        'heading': _float_values(snapshot.heading),
+        'speed': _float_values(snapshot.speed),
+        'current_stop_id': _id_values(snapshot.current_stop_id),
+        'segment_id': _id_values(snapshot.segment_id),
+    }
+
+
+class SnapshotWriter:
+    """Write vehicle snapshots to a file, one buffered write per snapshot.
+
+    Args:
+        format: 'tab' for aligned text (the same as the original per-bus prints), 'csv', 'ndjson' (one json
+            object per line), or 'quiet' to not write anything.
+        file: File to write to. Defaults to `sys.stdout` (at the time of writing).
+    """
+
+    def __init__(self, format='tab', file=None):
+        if format not in FORMATS:
+            raise ValueError("`format` must be one of %s, got %r." % (FORMATS, format))
+        self.format = format
+        self.file = file
+        self._csv_header_written = False
+
+    def render(self, snapshot, title=None):
+        """Return the formatted snapshot as a string. `title` is only used for the 'tab' format."""
+        if self.format == 'quiet':
+            return ""
+        columns = snapshot_columns(snapshot)
+        if self.format == 'tab':
+            # Missing headings and speeds are formatted as "nan", rather than raising an error:
+            headings = [np.nan if heading is None else heading for heading in columns['heading']]
+            speeds = [np.nan if speed is None else speed for speed in columns['speed']]
+            lines = [] if title is None else ["\n\n%s: %s\n" % (title, len(snapshot))]
+            lines.append(TAB_HEADER)
+            lines.extend(map(TAB_LINEFMT.format, columns['route_id'], columns['call_name'], columns['lat'],
+                             columns['lon'], headings, speeds, columns['current_stop_id'],
+                             columns['segment_id']))
+            return "\n".join(lines) + "\n"
+        rows = zip(*(columns[field] for field in FIELDS))
+        if self.format == 'ndjson':
+            return "".join(json.dumps(dict(zip(FIELDS, row))) + "\n" for row in rows)
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        if not self._csv_header_written:
+            writer.writerow(FIELDS)
+            self._csv_header_written = True
+        writer.writerows(rows)
+        return buffer.getvalue()
+
+    def write(self, snapshot, title=None):
+        """Write the snapshot with a single write call. Returns the number of characters written."""
+        if self.format == 'quiet':
+            return 0
+        with metrics.timer('output'):
+            text = self.render(snapshot, title=title)
+            file = self.file if self.file is not None else sys.stdout
+            file.write(text)
+            file.flush()
+        metrics.count('output_records', len(snapshot))
+        return len(text)
+
+
+def test_snapshot_writer():
+    from practical_python.examples.webapis.transloc_snapshot import VehicleSnapshot
+
+    vehicles = [
+        dict(id=1, agency_id=64, route_id=4008182, current_stop_id=10, segment_id=100, call_name="1101",
+             heading=45, speed=12.5, position=[42.3378, -71.1024]),
+        dict(id=2, agency_id=64, route_id=4008182, current_stop_id=None, segment_id=101, call_name="1102",
+             heading=90.5, speed=0, position=[42.3745, -71.1189]),
+    ]
+    snapshot = VehicleSnapshot.from_records(vehicles, timestamp=100)
+
+    out = io.StringIO()
+    SnapshotWriter('tab', file=out).write(snapshot, title="M2 buses")
+    assert out.getvalue() == "\n".join([
+        "\n\nM2 buses: 2\n", TAB_HEADER,
+        "4008182, 1101\t42.338, -71.102\t     45\t12.5\t10\t100",
+        "4008182, 1102\t42.374, -71.119\t   90.5\t 0.0\tNone\t101"]) + "\n"
+
+    # A vehicle without heading or speed doesn't break the output for the other vehicles:
+    missing = VehicleSnapshot.from_records([dict(id=3, route_id=1, call_name="1103", position=[42.3, -71.1])])
+    lines = SnapshotWriter('tab').render(missing).splitlines()
+    assert lines[1] == "1, 1103\t42.300, -71.100\t    nan\t nan\tNone\tNone"
+
+    out = io.StringIO()
+    writer = SnapshotWriter('csv', file=out)
+    writer.write(snapshot)
+    writer.write(snapshot[:1])  # The header is only written once.
+    rows = list(csv.DictReader(io.StringIO(out.getvalue())))
+    assert len(rows) == 3 and rows[1]['current_stop_id'] == "" and rows[2]['call_name'] == "1101"
+    assert float(rows[0]['lat']) == 42.3378
+
+    out = io.StringIO()
+    SnapshotWriter('ndjson', file=out).write(snapshot)
+    records = [json.loads(line) for line in out.getvalue().splitlines()]
+    for record, bus in zip(records, snapshot.records()):
+        assert record.pop('timestamp') == 100
+        assert [record.pop('lat'), record.pop('lon')] == bus.pop('position')
+        assert record == bus
+
+    out = io.StringIO()
+    assert SnapshotWriter('quiet', file=out).write(snapshot) == 0 and out.getvalue() == ""
+
+
+if __name__ == '__main__':
+    test_snapshot_writer()
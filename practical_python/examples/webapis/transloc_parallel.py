@@ -0,0 +1,253 @@
+"""
+
+Parallel evaluation of vehicle-to-stop proximity, using multiple processes.
+
+Python only runs one thread at a time, so to use more than one CPU core we need more than one process.
+`ParallelProximity` splits the stops into shards, either by spatial tile or by agency, and evaluates each
+shard in a `concurrent.futures.ProcessPoolExecutor`. Each worker only looks at the vehicles that can
+possibly be within `radius` of its stops.
+
+Sending the vehicle positions to every worker on every poll would mean pickling and copying all positions
+once per shard. Instead, positions are written once to a shared memory buffer
+(`multiprocessing.shared_memory`), and the workers read them directly from there.
+Only the buffer names and the (small) lists of stop indices are sent to the workers.
+
+Usage:
+    >>> with ParallelProximity(stop_positions, radius=1.0) as proximity:
+    ...     while True:
+    ...         snapshot = ...
+    ...         vehicle_idx, stop_idx, dists = proximity.evaluate(snapshot.positions)
+    ...         near_stop_0 = snapshot[vehicle_idx[stop_idx == 0]]  # Same as bus_near_location(snapshot, stops[0])
+
+"""
+import math
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+
+from practical_python.utils.geo_utils import GeoGridIndex, as_latlon_array, EARTH_RADIUS_KM
+
+
+class SharedArray:
+    """Numpy array backed by shared memory, which worker processes can attach to by name.
+
+    Args:
+        shape: Array shape.
+        dtype: Array dtype.
+    """
+
+    def __init__(self, shape, dtype=float):
+        dtype = np.dtype(dtype)
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize))
+        self.array = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf)
+
+    @property
+    def spec(self):
+        """(name, shape, dtype) tuple, used by `_attach` to attach to the array from another process."""
+        return self.shm.name, self.array.shape, self.array.dtype.str
+
+    def release(self):
+        """Close and remove the shared memory. The array can no longer be used after this."""
+        self.array = None
+        self.shm.close()
+        self.shm.unlink()
+
+
+# Shared arrays attached in this (worker) process, {slot: (name, SharedMemory, array)}, e.g. slot 'vehicles':
+_attached = {}
+
+
+def _attach(slot, spec):
+    """Attach to the shared array in `spec` (see `SharedArray.spec`), and return it as a numpy array.
+
+    Only the latest array for each `slot` is kept attached. When `ParallelProximity` re-allocates an array,
+    the worker closes its attachment to the old array, so the old shared memory can actually be freed.
+    """
+    name, shape, dtype = spec
+    attached = _attached.get(slot)
+    if attached is None or attached[0] != name:
+        if attached is not None:
+            shm = _attached.pop(slot)[1]
+            attached = None  # Release the array, which uses the shared memory buffer, before closing.
+            shm.close()
+        shm = shared_memory.SharedMemory(name=name)
+        attached = _attached[slot] = (name, shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+    return attached[2]
+
+
+def _proximity_shard(vehicles_spec, n_vehicles, stops_spec, stop_idxs, radius,
+                     vehicle_agencies_spec=None, agency_id=None):
+    """Find all (vehicle, stop) pairs within `radius` km for the stops in `stop_idxs`. Runs in worker processes.
+
+    If `agency_id` is given, only vehicles of that agency are considered. Otherwise, only vehicles within the
+    bounding box of the stops, expanded by `radius`, are considered.
+
+    Returns:
+        Tuple of (vehicle indices, stop indices, distances) arrays.
+    """
+    vehicles = _attach('vehicles', vehicles_spec)[:n_vehicles]
+    stops = _attach('stops', stops_spec)[stop_idxs]
+    if agency_id is not None:
+        candidates = np.flatnonzero(_attach('vehicle_agencies', vehicle_agencies_spec)[:n_vehicles] == agency_id)
+    else:
+        dlat = math.degrees(radius / EARTH_RADIUS_KM)
+        lat_min, lat_max = stops[:, 0].min() - dlat, stops[:, 0].max() + dlat
+        max_abs_lat = min(max(abs(lat_min), abs(lat_max)), 89.0)
+        dlon = dlat / math.cos(math.radians(max_abs_lat))
+        lon_min, lon_max = stops[:, 1].min() - dlon, stops[:, 1].max() + dlon
+        mask = (vehicles[:, 0] >= lat_min) & (vehicles[:, 0] <= lat_max)
+        if lon_min > -180 and lon_max < 180:  # Otherwise the box wraps around the antimeridian; check all lons.
+            mask &= (vehicles[:, 1] >= lon_min) & (vehicles[:, 1] <= lon_max)
+        candidates = np.flatnonzero(mask)
+    index = GeoGridIndex(vehicles[candidates], cell_size=radius)
+    vehicle_idx, stop_idx, dists = [], [], []
+    for stop, pos in zip(stop_idxs, stops):
+        idxs, stop_dists = index.query_radius(pos, radius, return_dist=True)
+        vehicle_idx.append(candidates[idxs])
+        stop_idx.append(np.full(len(idxs), stop, dtype=np.int64))
+        dists.append(stop_dists)
+    if not vehicle_idx:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+    return np.concatenate(vehicle_idx), np.concatenate(stop_idx), np.concatenate(dists)
+
+
+class ParallelProximity:
+    """Evaluate which vehicles are within `radius` km of each stop, using a pool of worker processes.
+
+    Args:
+        stop_positions: Array-like of shape (M, 2) with (lat, lon) stop positions.
+        radius: Proximity radius, in km.
+        shard_by: 'tile' to split stops into `tile_size` x `tile_size` degree tiles, or 'agency' to split stops
+            by `stop_agency_ids`. With 'agency', vehicles are only matched with stops of the same agency.
+        stop_agency_ids: Agency ID of each stop. Required for `shard_by='agency'`.
+        tile_size: Tile size in degrees, for `shard_by='tile'`.
+        max_workers: Number of worker processes. If 0, shards are evaluated in this process (useful for debugging).
+    """
+
+    def __init__(self, stop_positions, radius=1.0, shard_by='tile', stop_agency_ids=None, tile_size=1.0,
+                 max_workers=None):
+        stop_positions = as_latlon_array(stop_positions)
+        self.radius = radius
+        self.shard_by = shard_by
+        self.stops = SharedArray(stop_positions.shape)
+        self.stops.array[:] = stop_positions
+        self.vehicles = None
+        self.vehicle_agencies = None
+        self.shards = self._make_shards(stop_positions, shard_by, stop_agency_ids, tile_size)
+        self.executor = ProcessPoolExecutor(max_workers=max_workers) if max_workers != 0 else None
+
+    @staticmethod
+    def _make_shards(stop_positions, shard_by, stop_agency_ids, tile_size):
+        """Return list of (agency_id or None, stop indices) shards."""
+        groups = defaultdict(list)
+        if shard_by == 'agency':
+            if stop_agency_ids is None:
+                raise ValueError("`stop_agency_ids` is required for shard_by='agency'.")
+            for i, agency_id in enumerate(np.asarray(stop_agency_ids).tolist()):
+                groups[agency_id].append(i)
+            return [(agency_id, np.array(idxs)) for agency_id, idxs in groups.items()]
+        elif shard_by == 'tile':
+            tiles = np.floor(stop_positions / tile_size).astype(np.int64)
+            for i, tile in enumerate(map(tuple, tiles.tolist())):
+                groups[tile].append(i)
+            return [(None, np.array(idxs)) for idxs in groups.values()]
+        raise ValueError("`shard_by` must be 'tile' or 'agency', got %r." % (shard_by,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Shut down the worker processes and release the shared memory."""
+        if self.executor is not None:
+            self.executor.shutdown()
+        for shared in (self.stops, self.vehicles, self.vehicle_agencies):
+            if shared is not None:
+                shared.release()
+        self.stops = self.vehicles = self.vehicle_agencies = None
+
+    def _write_shared(self, attr, values, dtype):
+        """Copy `values` to the shared array `attr`, re-allocating it (with room to grow) if too small."""
+        shared = getattr(self, attr)
+        if shared is None or len(shared.array) < len(values):
+            if shared is not None:
+                shared.release()
+            shared = SharedArray((max(16, 2*len(values)),) + values.shape[1:], dtype=dtype)
+            setattr(self, attr, shared)
+        shared.array[:len(values)] = values
+        return shared
+
+    def evaluate(self, vehicle_positions, vehicle_agency_ids=None):
+        """Find all vehicles within `radius` of each stop.
+
+        Args:
+            vehicle_positions: Array-like of shape (N, 2) with (lat, lon) vehicle positions.
+            vehicle_agency_ids: Agency ID of each vehicle. Required for `shard_by='agency'`.
+
+        Returns:
+            Tuple of (vehicle indices, stop indices, distances) arrays, sorted by stop and then by vehicle index.
+        """
+        vehicle_positions = as_latlon_array(vehicle_positions)
+        n_vehicles = len(vehicle_positions)
+        vehicles_spec = self._write_shared('vehicles', vehicle_positions, float).spec
+        vehicle_agencies_spec = None
+        if self.shard_by == 'agency':
+            if vehicle_agency_ids is None:
+                raise ValueError("`vehicle_agency_ids` is required for shard_by='agency'.")
+            vehicle_agency_ids = np.asarray(vehicle_agency_ids, dtype=np.int64)
+            vehicle_agencies_spec = self._write_shared('vehicle_agencies', vehicle_agency_ids, np.int64).spec
+        tasks = [(vehicles_spec, n_vehicles, self.stops.spec, stop_idxs, self.radius, vehicle_agencies_spec, agency_id)
+                 for agency_id, stop_idxs in self.shards]
+        if self.executor is None:
+            results = [_proximity_shard(*task) for task in tasks]
+        else:
+            results = list(self.executor.map(_proximity_shard, *zip(*tasks))) if tasks else []
+        if not results:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+        vehicle_idx, stop_idx, dists = (np.concatenate(arrays) for arrays in zip(*results))
+        order = np.lexsort((vehicle_idx, stop_idx))
+        return vehicle_idx[order], stop_idx[order], dists[order]
+
+
+def test_parallel_proximity():
+    rng = np.random.RandomState(3)
+    vehicles = np.column_stack([rng.uniform(41.0, 43.0, 3000), rng.uniform(-72.0, -70.0, 3000)])
+    stops = np.column_stack([rng.uniform(41.0, 43.0, 200), rng.uniform(-72.0, -70.0, 200)])
+    radius = 2.0
+
+    # Brute-force reference, like calling bus_near_location for each stop:
+    expected = []
+    index = GeoGridIndex(vehicles, cell_size=radius)
+    for stop, pos in enumerate(stops):
+        expected.extend((vehicle, stop) for vehicle in sorted(index.query_radius(pos, radius).tolist()))
+
+    for max_workers in (0, 2):
+        with ParallelProximity(stops, radius=radius, tile_size=0.5, max_workers=max_workers) as proximity:
+            for tick in range(2):
+                vehicle_idx, stop_idx, dists = proximity.evaluate(vehicles)
+                assert list(zip(vehicle_idx.tolist(), stop_idx.tolist())) == expected
+                assert np.all(dists < radius)
+
+    # When the vehicles array is re-allocated, the attachment to the old array is closed:
+    with ParallelProximity(stops, radius=radius, tile_size=0.5, max_workers=0) as proximity:
+        proximity.evaluate(vehicles[:10])
+        old_shm = _attached['vehicles'][1]
+        proximity.evaluate(vehicles)
+        assert _attached['vehicles'][0] == proximity.vehicles.shm.name != old_shm.name
+        assert old_shm.buf is None  # Closed.
+        assert sorted(_attached) == ['stops', 'vehicles']
+
+    # Sharding by agency only matches vehicles and stops of the same agency:
+    vehicle_agencies, stop_agencies = rng.randint(0, 3, len(vehicles)), rng.randint(0, 3, len(stops))
+    with ParallelProximity(stops, radius=radius, shard_by='agency', stop_agency_ids=stop_agencies,
+                           max_workers=2) as proximity:
+        vehicle_idx, stop_idx, dists = proximity.evaluate(vehicles, vehicle_agency_ids=vehicle_agencies)
+    same_agency = [(vehicle, stop) for vehicle, stop in expected if vehicle_agencies[vehicle] == stop_agencies[stop]]
+    assert list(zip(vehicle_idx.tolist(), stop_idx.tolist())) == same_agency
+
+
+if __name__ == '__main__':
+    test_parallel_proximity()
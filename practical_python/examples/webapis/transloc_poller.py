@@ -0,0 +1,166 @@
+"""
+
+Concurrent polling of real-time Transloc vehicle statuses for many agencies and routes.
+
+Requesting data for hundreds of routes one after the other is slow, since most of the time is spent
+waiting for the server to respond. The poller uses asyncio to have many requests in flight at once,
+limited by `max_concurrency`, and polls each feed at its own interval.
+
+The requests themselves are made by a `TranslocClient` in a thread pool, so we re-use its pooled
+connections and retry logic without depending on an async HTTP library.
+
+Usage, as an async iterator:
+    >>> poller = VehiclePoller([Feed(64, route_ids=[4008182], interval=5), Feed([52, 12], interval=30)])
+    >>> async for snapshot in poller.snapshots():
+    ...     print(snapshot.feed, len(snapshot.vehicles))
+
+Or with a callback (either a regular function or a coroutine function):
+    >>> asyncio.run(poller.run(callback=print))
+
+"""
+import asyncio
+import time
+import warnings
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from practical_python.examples.webapis.transloc_client import TranslocClient, start_stub_server
+
+
+# A snapshot of all vehicles in a feed, fetched at `timestamp` (seconds since epoch):
+FeedSnapshot = namedtuple('FeedSnapshot', 'feed timestamp vehicles')
+
+
+class Feed:
+    """A set of agencies (and optionally routes) to poll at a given interval.
+
+    Args:
+        agency_ids: Agency ID or list of agency IDs. All agencies are fetched in a single request.
+        route_ids: If given, only include vehicles on these routes.
+        interval: Time between polls, in seconds.
+    """
+
+    def __init__(self, agency_ids, route_ids=None, interval=5.0):
+        self.agency_ids = [agency_ids] if isinstance(agency_ids, (int, str)) else list(agency_ids)
+        self.route_ids = None if route_ids is None else set(route_ids)
+        self.interval = interval
+
+    def __repr__(self):
+        return "Feed(%r, route_ids=%r, interval=%r)" % (self.agency_ids, self.route_ids, self.interval)
+
+
+class VehiclePoller:
+    """Poll vehicle statuses for many feeds concurrently.
+
+    Args:
+        feeds: List of `Feed` objects.
+        client: TranslocClient used to make requests. A new client is created if not given.
+        max_concurrency: Maximum number of requests in flight at the same time.
+    """
+
+    def __init__(self, feeds, client=None, max_concurrency=8):
+        self.feeds = list(feeds)
+        self.client = client if client is not None else TranslocClient(pool_maxsize=max_concurrency)
+        self.max_concurrency = max_concurrency
+
+    def fetch(self, feed):
+        """Fetch a snapshot of the feed's vehicles. Blocking; called from worker threads."""
+        timestamp = time.time()
+        vehicles = self.client.vehicle_statuses(feed.agency_ids, route_ids=feed.route_ids)
+        return FeedSnapshot(feed, timestamp, vehicles)
+
+    async def _poll_feed(self, feed, deliver, semaphore, executor, max_polls=None):
+        """Poll a single feed every `feed.interval` seconds, passing each snapshot to `deliver`."""
+        loop = asyncio.get_running_loop()
+        next_poll = loop.time()
+        n_polls = 0
+        while True:
+            async with semaphore:
+                try:
+                    snapshot = await loop.run_in_executor(executor, self.fetch, feed)
+                except Exception as exc:
+                    warnings.warn("Error polling %r: %r" % (feed, exc))
+                    snapshot = None
+            if snapshot is not None:
+                result = deliver(snapshot)
+                if asyncio.iscoroutine(result):
+                    await result
+            n_polls += 1
+            if max_polls is not None and n_polls >= max_polls:
+                break
+            # Keep to the schedule, but skip polls we are too late for rather than firing them all at once:
+            next_poll += feed.interval
+            now = loop.time()
+            if next_poll < now:
+                next_poll = now
+            await asyncio.sleep(next_poll - now)
+
+    async def run(self, callback, max_polls=None):
+        """Poll all feeds, calling `callback(snapshot)` for each new snapshot.
+
+        Args:
+            callback: Function or coroutine function taking a `FeedSnapshot`.
+            max_polls: Stop after polling each feed this many times. Default is to poll forever.
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            await asyncio.gather(*[
+                self._poll_feed(feed, callback, semaphore, executor, max_polls=max_polls) for feed in self.feeds
+            ])
+
+    async def snapshots(self, max_polls=None):
+        """Async iterator yielding snapshots as they arrive. See `run` for arguments."""
+        queue = asyncio.Queue()
+        done = object()
+
+        async def run():
+            try:
+                await self.run(queue.put, max_polls=max_polls)
+            finally:
+                await queue.put(done)
+
+        task = asyncio.ensure_future(run())
+        try:
+            while True:
+                snapshot = await queue.get()
+                if snapshot is done:
+                    break
+                yield snapshot
+            await task  # Re-raise any errors.
+        finally:
+            task.cancel()
+
+
+def test_vehicle_poller():
+    data = {'vehicles': [dict(id=i, agency_id=agency_id, route_id=agency_id*10 + i % 2)
+                         for agency_id in range(1, 21) for i in range(4)]}
+    server = start_stub_server(data)
+    try:
+        client = TranslocClient(base_url="http://%s:%s/3/" % server.server_address, backoff_factor=0)
+        feeds = [Feed(agency_id, interval=0.01) for agency_id in range(1, 20)]
+        feeds.append(Feed(20, route_ids=[200], interval=0.01))
+        poller = VehiclePoller(feeds, client=client, max_concurrency=4)
+
+        async def collect():
+            return [snapshot async for snapshot in poller.snapshots(max_polls=2)]
+
+        snapshots = asyncio.run(collect())
+        assert len(snapshots) == 2 * len(feeds)
+        assert len(server.requests_log) == 2 * len(feeds)
+        for snapshot in snapshots:
+            if snapshot.feed.route_ids:
+                assert [vehicle['route_id'] for vehicle in snapshot.vehicles] == [200, 200]
+            else:
+                assert {vehicle['agency_id'] for vehicle in snapshot.vehicles} == set(snapshot.feed.agency_ids)
+                assert len(snapshot.vehicles) == 4
+
+        received = []
+        asyncio.run(poller.run(received.append, max_polls=1))
+        assert len(received) == len(feeds)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    test_vehicle_poller()
@@ -15,33 +15,35 @@ Regarding speed:
 *
 
 """
+import argparse
 import sys
 import os
-import requests
 from pprint import pprint
-import yaml
+import numpy as np
 try:
-    from practical_python.utils.geo_utils import haversine as gps_dist
+    from practical_python.utils import metrics
 except ImportError:
     print("WARNING: `practical_python` package not installed. Will try to fix by modifying PATH...")
     _project_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__)))))
     sys.path.insert(0, _project_root)
     print(_project_root)
-    from practical_python.utils.geo_utils import haversine as gps_dist
+    from practical_python.utils import metrics
+from practical_python.examples.webapis.transloc_metadata import MetadataCache
+from practical_python.examples.webapis.transloc_client import TranslocClient
+from practical_python.examples.webapis.transloc_snapshot import VehicleSnapshot
+from practical_python.examples.webapis.transloc_replay import record_client, replay_client
+from practical_python.examples.webapis.transloc_output import SnapshotWriter, FORMATS as OUTPUT_FORMATS
 
 # The M2 LMA bus stop is at GPS coordinate (42.3378699, -71.1024789) - found e.g. using Google Maps.
 lma_pos = (42.3378699, -71.1024789)  # lat, lon
 # The corner of Luis Pasteur and Fenway is at (42.3389477, -71.1018647)
 
-# Output options:
-bus_header = "Route, Bus ID \t   Position    \tHeading\tSpeed\tStop\tSegment"
-bus_linefmt = ("{route_id}, {call_name}\t{position[0]:0.03f}, {position[1]:0.03f}\t{heading:>7}\t{speed:>4.01f}"
-               "\t{current_stop_id}\t{segment_id}")
 
-
-def get_masco_id():
-    # Get Transloc agencies:
-    agencies_res = requests.get("https://feeds.transloc.com/3/agencies")
+def get_masco_id(client=None):
+    # Get Transloc agencies.
+    # A TranslocClient re-uses the same connection for all requests, which is faster than `requests.get`:
+    client = client or TranslocClient()
+    agencies_res = client.get("agencies")
 
     # Parse json-formatted response:
     agencies_data = agencies_res.json()
@@ -66,9 +68,10 @@ def get_masco_id():
     return masco_id
 
 
-def get_m2_shuttle_id(masco_id):
+def get_m2_shuttle_id(masco_id, client=None):
     # Get all routes for the given agency (i.e. MASCO):
-    routes_res = requests.get("https://feeds.transloc.com/3/routes", params=dict(agencies=masco_id))
+    client = client or TranslocClient()
+    routes_res = client.get("routes", params=dict(agencies=masco_id))
 
     # Parse the json-formatted data:
     routes_data = routes_res.json()
@@ -90,71 +93,110 @@ def get_m2_shuttle_id(masco_id):
     return m2_id
 
 
-def get_m2_buses(masco_id, m2_id):
+def get_m2_buses(masco_id, m2_id, client=None, writer=None):
     # Lets get the real time data:
-    # We retrieve data on a per-agency basis:
-    vehicles_res = requests.get("https://feeds.transloc.com/3/vehicle_statuses", params=dict(agencies=masco_id))
-
-    # Parse the json-formatted data:
-    vehicles_data = vehicles_res.json()
-
-    # Again, the response data has two entries, 'success' and 'routes'. Get the 'routes' entry:
-    vehicles = vehicles_data['vehicles']
+    # We retrieve data on a per-agency basis. `masco_id` can also be a list of agency IDs,
+    # in which case the client requests data for all agencies using as few requests as possible.
+    # With `route_ids`, the response is filtered while it is parsed, so vehicles on other routes are discarded
+    # as soon as they are read:
+    client = client or TranslocClient()
+    vehicles = client.vehicle_statuses(masco_id, route_ids=m2_id)
 
     # Note: heading vs course vs bearing:
     # * heading: direction you are facing/heading, in degrees clockwise from grid north. heading 45 = North East.
     # * course:  direction of travel, relative to true/grid north.
     # * bearing: direction to target, often relative to magnetic north (although grid north is technically correct).
 
+    # Store the vehicles in a columnar VehicleSnapshot, which uses much less memory than a list of dicts,
+    # and lets us filter all vehicles in one vectorized operation (e.g. `snapshot.filter(route_id=m2_id)`),
+    # rather than with a list comprehension.
+    m2_buses = VehicleSnapshot.from_records(vehicles)
+
     # Print all M2 buses:
-    m2_buses = [bus for bus in vehicles if bus['route_id'] == m2_id]
 
-    print("\n\nM2 buses: %s\n" % len(m2_buses))
-    print(bus_header)
-    for bus in m2_buses:
-        print(bus_linefmt.format(**bus))
+    # Printing one line per bus, with a `print` call for each bus, is slow for large snapshots.
+    # A SnapshotWriter formats all buses at once, and writes them with a single write call:
+    writer = writer or SnapshotWriter('tab')
+    writer.write(m2_buses, title="M2 buses")
     return m2_buses
 
 
-def bus_near_location(m2_buses, near_pos=lma_pos, radius=1.0):
+def bus_near_location(m2_buses, near_pos=lma_pos, radius=1.0, index=None, dist_cache=None, writer=None):
     # There are three ways to determine the position of a Transloc vehicle: gps position, current stop, and segment.
     # * GPS position is the most precise and intuitive.
     # * current stop and segment are convenient, if you know the IDs of these.
 
-    # Find buses within 1 km of the LMA bus stop:
-    m2_at_lma = [bus for bus in m2_buses if gps_dist(bus['position'], near_pos) < radius]
-
-    print("\n\nM2 buses at LMA: %s\n" % len(m2_at_lma))
-    print(bus_header)
-    for bus in m2_at_lma:
-        print(bus_linefmt.format(**bus))
+    # Find buses within 1 km of the LMA bus stop.
+    # For a single location, calculating the distance to every bus in one vectorized operation is fastest.
+    # If you query many locations against the same buses, build a spatial index once per snapshot and pass it in,
+    # so each query only calculates the distance to buses in the vicinity of near_pos:
+    #     index = m2_buses.index(cell_size=radius)
+    # Alternatively, if you call this every poll and many buses are parked, a DistanceCache (from geo_utils)
+    # re-uses the distances calculated for buses that haven't moved since the last poll.
+    if not isinstance(m2_buses, VehicleSnapshot):
+        m2_buses = VehicleSnapshot.from_records(m2_buses)
+    with metrics.timer('distance'):
+        if dist_cache is not None:
+            m2_at_lma = m2_buses[dist_cache.dist_one_to_many(near_pos, m2_buses.positions) < radius]
+        elif index is not None:
+            m2_at_lma = m2_buses[np.sort(index.query_radius(near_pos, radius))]
+        else:
+            m2_at_lma = m2_buses.near(near_pos, radius)
+
+    writer = writer or SnapshotWriter('tab')
+    writer.write(m2_at_lma, title="M2 buses at LMA")
 
     # Note: We could also have used e.g. a square [(xmin, xmax), (ymin, ymax)] to evaluate the location of the bus.
     return m2_at_lma
 
 
-def main():
+def main(cachefn="transloc_cache.json", offline=False, record=None, replay=None, speed=1.0, output='tab'):
+    """Print M2 buses near LMA, and return the number of buses near LMA.
+
+    Args:
+        cachefn: Metadata cache file (see `MetadataCache`).
+        offline: Only use the metadata cache, never request metadata.
+        record: Save all API responses to this file (see `transloc_replay`).
+        replay: Use API responses from this recording instead of making requests.
+        speed: Replay speed, relative to real time. None to replay as fast as possible.
+            This only paces the recorded responses; poll intervals are not scaled (see `transloc_replay`).
+        output: Output format, 'tab', 'csv', 'ndjson' or 'quiet' (see `SnapshotWriter`).
+    """
     # OBS: We generally wouldn't expect the ID values of the MASCO agency and the M2 route to change.
     # Thus, we should save (cache) these so we can re-use them again next time we need them.
-    # We can either save all the data we have requested, or just the specific MASCO/M2 IDs. We do the latter:
-    try:
-        configfn = "config.yaml"
-        config = yaml.load(open(configfn))
-        print("config loaded from file:", configfn)
-        masco_id = config['agency']
-        m2_id = config['route']
-    except OSError:
-        print("\nObtaining MASCO agency id...")
-        masco_id = get_masco_id()
-        print("\nObtaining M2 shuttle route id...")
-        m2_id = get_m2_shuttle_id(masco_id)
-        config = dict(agency=masco_id, route=m2_id)
-        yaml.dump(config, stream=open("config.yaml", 'w'))
-
-    buses = get_m2_buses(masco_id=masco_id, m2_id=m2_id)
-    m2_at_lma = bus_near_location(buses)
+    # Previously, we saved just the MASCO/M2 IDs to config.yaml (see `get_masco_id` and `get_m2_shuttle_id`).
+    # The MetadataCache saves all agency and route data, and refreshes it when it gets old:
+    client = TranslocClient()
+    if record:
+        record_client(client, record)
+    if replay:
+        replay_client(client, replay, speed=speed)
+    metadata = MetadataCache(cachefn, offline=offline, session=client.session, base_url=client.base_url)
+    masco_id = metadata.get('agencies', "MASCO")['id']
+    m2_id = metadata.get('routes', "M2", agency_id=masco_id)['id']
+
+    writer = SnapshotWriter(output)
+    buses = get_m2_buses(masco_id=masco_id, m2_id=m2_id, client=client, writer=writer)
+    m2_at_lma = bus_near_location(buses, writer=writer)
+    # If instrumentation is enabled (see `practical_python.utils.metrics`), report where the time went:
+    metrics.report()
     return len(m2_at_lma)
 
 
+def parse_args(argv=None):
+    ap = argparse.ArgumentParser(description="Print M2 buses, and the M2 buses near LMA.")
+    ap.add_argument("--cache", default="transloc_cache.json", help="Metadata cache file.")
+    ap.add_argument("--offline", action='store_true', help="Only use the metadata cache, never request metadata.")
+    ap.add_argument("--record", metavar="FILE", help="Save all API responses to this file.")
+    ap.add_argument("--replay", metavar="FILE", help="Replay recorded responses instead of requesting Transloc.")
+    ap.add_argument("--speed", type=float, default=1.0,
+                    help="Replay speed, relative to real time. 0 to replay as fast as possible. "
+                         "Only paces the recorded responses, poll intervals are not scaled.")
+    ap.add_argument("--output", choices=OUTPUT_FORMATS, default='tab', help="Output format.")
+    return ap.parse_args(argv)
+
+
 if __name__ == '__main__':
-    main()
+    args = parse_args()
+    main(cachefn=args.cache, offline=args.offline, record=args.record, replay=args.replay, speed=args.speed or None,
+         output=args.output)
@@ -0,0 +1,207 @@
+"""
+
+Record Transloc API responses, and replay them later without network access.
+
+Waiting for real buses is a slow way to test code. Instead, we can record the responses from the Transloc
+API once, and then replay them as often as we like: at real-time speed, N times faster than real time,
+or as fast as possible.
+
+Recording and replay are implemented as `requests` transport adapters, which are mounted on the session of
+a `TranslocClient`. All code using the client, e.g. `get_m2_buses`, `MetadataCache` and `VehiclePoller`,
+therefore works exactly the same way with recorded data as with live data.
+
+The replay speed only paces the responses served by the transport adapter: a response is not served before its
+(scaled) recorded time. It doesn't change how often the code using the client makes requests, so when replaying
+polls N times faster, the poll intervals (e.g. `Feed.interval`) must be divided by N as well.
+
+Recordings are json-lines files, with one response per line (see `RecordingAdapter`).
+Requests are matched to recorded responses by method, endpoint path and query parameters (not host),
+and each recorded response is replayed once, in the order it was recorded.
+
+Usage:
+    >>> client = record_client(TranslocClient(), "recording.jsonl")  # Record responses while polling.
+    >>> client = replay_client(TranslocClient(), "recording.jsonl", speed=10)  # Replay at 10x real time.
+    >>> client = replay_client(TranslocClient(), "recording.jsonl", speed=None)  # Replay as fast as possible.
+
+"""
+import json
+import threading
+import time
+from collections import defaultdict, deque
+from urllib.parse import urlsplit, parse_qsl, urlencode
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+
+class ReplayExhausted(requests.ConnectionError):
+    """Raised when there are no more recorded responses for a request."""
+
+
+def request_key(method, url):
+    """Return key used to match requests with recorded responses, e.g. "GET /3/vehicle_statuses?agencies=64"."""
+    parts = urlsplit(url)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return "%s %s%s" % (method.upper(), parts.path, "?" + query if query else "")
+
+
+class RecordingAdapter(BaseAdapter):
+    """Transport adapter that passes requests on to another adapter, and saves all responses to a file.
+
+    Each line in the file is a json object with keys 'time' (seconds since epoch), 'key' (see `request_key`),
+    'status', 'reason', 'headers' and 'body'.
+
+    Args:
+        adapter: The adapter that actually makes the requests, e.g. `requests.adapters.HTTPAdapter()`.
+        filename: File to append the recorded responses to.
+    """
+
+    def __init__(self, adapter, filename):
+        super().__init__()
+        self.adapter = adapter
+        self.filename = filename
+        self._lock = threading.Lock()
+
+    def send(self, request, **kwargs):
+        response = self.adapter.send(request, **kwargs)
+        entry = dict(time=time.time(), key=request_key(request.method, request.url), status=response.status_code,
+                     reason=response.reason, headers=dict(response.headers),
+                     body=response.content.decode('utf-8'))  # Reads the whole body; streaming still works.
+        # The body is no longer compressed or chunked:
+        for header in ('Content-Encoding', 'Transfer-Encoding', 'Content-Length'):
+            entry['headers'].pop(header, None)
+        line = json.dumps(entry) + "\n"
+        with self._lock:
+            with open(self.filename, 'a') as fd:
+                fd.write(line)
+        return response
+
+    def close(self):
+        self.adapter.close()
+
+
+class ReplayAdapter(BaseAdapter):
+    """Transport adapter serving recorded responses instead of making requests.
+
+    Args:
+        filename: Recording made with `RecordingAdapter`.
+        speed: Replay speed relative to real time, e.g. 1 for real time, 10 for ten times faster.
+            A recorded response is not served before its (scaled) time since the start of the recording.
+            Use None to serve responses as fast as possible. Poll intervals are not scaled (see module docstring).
+        repeat_last: If True, keep serving the last recorded response for a request once all responses for that
+            request have been served. If False, raise `ReplayExhausted`.
+        clock, sleep: Time functions, can be replaced for testing.
+    """
+
+    def __init__(self, filename, speed=1.0, repeat_last=False, clock=time.monotonic, sleep=time.sleep):
+        super().__init__()
+        self.speed = speed
+        self.repeat_last = repeat_last
+        self.clock = clock
+        self.sleep = sleep
+        self._responses = defaultdict(deque)  # {key: deque of recorded entries}
+        with open(filename) as fd:
+            entries = [json.loads(line) for line in fd if line.strip()]
+        for entry in entries:
+            self._responses[entry['key']].append(entry)
+        self.start_time = min((entry['time'] for entry in entries), default=0)
+        self._wall_start = None
+        self._lock = threading.Lock()
+
+    def send(self, request, **kwargs):
+        key = request_key(request.method, request.url)
+        with self._lock:
+            if self._wall_start is None:
+                self._wall_start = self.clock()
+            queue = self._responses.get(key)
+            if not queue:
+                raise ReplayExhausted("No more recorded responses for %r." % key, request=request)
+            entry = queue.popleft() if len(queue) > 1 or not self.repeat_last else queue[0]
+        if self.speed:
+            delay = self._wall_start + (entry['time'] - self.start_time) / self.speed - self.clock()
+            if delay > 0:
+                self.sleep(delay)
+        return self.build_response(request, entry)
+
+    @staticmethod
+    def build_response(request, entry):
+        response = requests.Response()
+        response.status_code = entry['status']
+        response.reason = entry.get('reason')
+        response.headers = CaseInsensitiveDict(entry['headers'])
+        response.encoding = 'utf-8'
+        response._content = entry['body'].encode('utf-8')
+        response._content_consumed = True
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def record_client(client, filename):
+    """Make `client` (a TranslocClient) save all responses to `filename`. Returns the client."""
+    for prefix in ("https://", "http://"):
+        client.session.mount(prefix, RecordingAdapter(client.session.get_adapter(prefix), filename))
+    return client
+
+
+def replay_client(client, filename, speed=1.0, repeat_last=False):
+    """Make `client` (a TranslocClient) serve responses from `filename` instead of the network. Returns the client.
+
+    See `ReplayAdapter` for arguments.
+    """
+    adapter = ReplayAdapter(filename, speed=speed, repeat_last=repeat_last)
+    for prefix in ("https://", "http://"):
+        client.session.mount(prefix, adapter)
+    return client
+
+
+def test_record_replay():
+    import os
+    import tempfile
+    from practical_python.examples.webapis.transloc_client import TranslocClient, start_stub_server
+
+    data = {'agencies': [dict(id=64, short_name="MASCO")], 'vehicles': [dict(id=1, agency_id=64, route_id=1)]}
+    server = start_stub_server(data)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fn = os.path.join(tmpdir, "recording.jsonl")
+        try:
+            client = record_client(TranslocClient(base_url="http://%s:%s/3/" % server.server_address), fn)
+            recorded = [client.vehicle_statuses(64)]
+            data['vehicles'][0]['route_id'] = 2
+            recorded.append(client.vehicle_statuses(64))
+            assert client.agencies()[0]['id'] == 64
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        # Replay as fast as possible, against a different host:
+        client = replay_client(TranslocClient(base_url="http://replay.invalid/3/"), fn, speed=None)
+        assert client.agencies()[0]['short_name'] == "MASCO"
+        assert [client.vehicle_statuses(64), client.vehicle_statuses(64)] == recorded
+        try:
+            client.vehicle_statuses(64)
+        except ReplayExhausted:
+            pass
+        else:
+            raise AssertionError("Expected ReplayExhausted.")
+
+        # Replay at 1000x speed, with a fake clock; responses are paced by their recorded times:
+        now, sleeps = [0.0], []
+
+        def fake_sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+        adapter = ReplayAdapter(fn, speed=1000, repeat_last=True, clock=lambda: now[0], sleep=fake_sleep)
+        with open(fn) as fd:
+            times = [json.loads(line)['time'] for line in fd]
+        client = TranslocClient(base_url="http://replay.invalid/3/")
+        client.session.mount("http://", adapter)
+        assert [client.vehicle_statuses(64) for _ in range(3)] == recorded + recorded[-1:]
+        assert abs(now[0] - (times[1] - times[0]) / 1000) < 1e-6
+
+
+if __name__ == '__main__':
+    test_record_replay()
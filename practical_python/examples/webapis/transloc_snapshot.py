@@ -0,0 +1,156 @@
+"""
+
+Compact, columnar representation of a snapshot of Transloc vehicle statuses.
+
+The `vehicle_statuses` endpoint gives us a list of dicts, one dict per vehicle.
+That is convenient, but each dict takes up several hundred bytes, and filtering e.g. by route
+means looping over every dict in Python.
+
+`VehicleSnapshot` instead stores each field as a numpy array ("column"), so a snapshot of N vehicles
+is just a handful of arrays of length N. Filtering is done with vectorized numpy comparisons,
+and positions can be passed directly to the vectorized distance functions in geo_utils.
+
+Usage:
+    >>> snapshot = VehicleSnapshot.from_records(vehicles_data['vehicles'])
+    >>> m2_buses = snapshot.filter(route_id=4008182)
+    >>> m2_at_lma = m2_buses.near(lma_pos, radius=1.0)
+    >>> for bus in m2_at_lma.records():
+    ...     print(bus['call_name'], bus['position'])
+
+"""
+import time
+import numpy as np
+
+from practical_python.utils.geo_utils import dist_one_to_many, GeoGridIndex
+from practical_python.utils import metrics
+
+# Value used in integer ID columns when the ID is missing (e.g. a vehicle not at any stop):
+MISSING_ID = -1
+
+
+def _id_column(records, field):
+    return np.array([MISSING_ID if record.get(field) is None else record[field] for record in records],
+                    dtype=np.int64)
+
+
+def _float_column(records, field):
+    return np.array([np.nan if record.get(field) is None else record[field] for record in records],
+                    dtype=float)
+
+
+class VehicleSnapshot:
+    """Columnar snapshot of vehicle statuses.
+
+    Attributes:
+        timestamp: Time of the snapshot, in seconds since epoch.
+        id, agency_id, route_id, current_stop_id, segment_id: int64 arrays. Missing IDs are `MISSING_ID`.
+        call_name: Unicode string array with the vehicle call names.
+        positions: float64 array of shape (N, 2) with (lat, lon) positions.
+        heading, speed: float64 arrays. Missing values are NaN.
+    """
+
+    id_columns = ('id', 'agency_id', 'route_id', 'current_stop_id', 'segment_id')
+    float_columns = ('heading', 'speed')
+    columns = id_columns + float_columns + ('call_name', 'positions')
+
+    def __init__(self, timestamp=None, **columns):
+        self.timestamp = time.time() if timestamp is None else timestamp
+        missing = set(self.columns) - set(columns)
+        if missing:
+            raise ValueError("Missing columns: %s" % ", ".join(sorted(missing)))
+        for name in self.columns:
+            setattr(self, name, columns[name])
+        lengths = {len(columns[name]) for name in self.columns}
+        if len(lengths) > 1:
+            raise ValueError("All columns must have the same length, got lengths %s." % sorted(lengths))
+
+    @classmethod
+    def from_records(cls, vehicles, timestamp=None):
+        """Create snapshot from a list of vehicle dicts, as returned by the `vehicle_statuses` endpoint."""
+        with metrics.timer('snapshot'):
+            columns = {field: _id_column(vehicles, field) for field in cls.id_columns}
+            columns.update({field: _float_column(vehicles, field) for field in cls.float_columns})
+            columns['call_name'] = np.array([str(vehicle.get('call_name', "")) for vehicle in vehicles], dtype=str)
+            columns['positions'] = np.array([vehicle['position'] for vehicle in vehicles], dtype=float).reshape(-1, 2)
+            return cls(timestamp=timestamp, **columns)
+
+    def __len__(self):
+        return len(self.id)
+
+    def __getitem__(self, selection):
+        """Return a new snapshot with the selected vehicles, using a boolean mask, index array or slice."""
+        if isinstance(selection, (int, np.integer)):
+            selection = [selection]
+        return type(self)(timestamp=self.timestamp, **{name: getattr(self, name)[selection] for name in self.columns})
+
+    def mask(self, agency_id=None, route_id=None, stop_id=None, segment_id=None):
+        """Return boolean mask selecting vehicles matching all the given criteria.
+
+        Each criterion can be a single ID or a collection of IDs.
+        """
+        mask = np.ones(len(self), dtype=bool)
+        for column, ids in [(self.agency_id, agency_id), (self.route_id, route_id),
+                            (self.current_stop_id, stop_id), (self.segment_id, segment_id)]:
+            if ids is None:
+                continue
+            if np.ndim(ids) == 0 and not isinstance(ids, (set, frozenset)):
+                mask &= column == ids
+            else:
+                mask &= np.isin(column, list(ids))
+        return mask
+
+    def filter(self, agency_id=None, route_id=None, stop_id=None, segment_id=None):
+        """Return snapshot with only the vehicles matching all the given criteria. See `mask`."""
+        with metrics.timer('filter'):
+            return self[self.mask(agency_id=agency_id, route_id=route_id, stop_id=stop_id, segment_id=segment_id)]
+
+    def distances_to(self, pos, method=None):
+        """Return array with the distance in km from each vehicle to `pos`, using the given distance backend."""
+        return dist_one_to_many(pos, self.positions, method=method)
+
+    def near(self, pos, radius, method=None):
+        """Return snapshot with only the vehicles within `radius` km of `pos`."""
+        return self[self.distances_to(pos, method=method) < radius]
+
+    def index(self, cell_size=1.0):
+        """Return a spatial index over the vehicle positions. Query results are indices into this snapshot."""
+        return GeoGridIndex(self.positions, cell_size=cell_size)
+
+    def records(self):
+        """Yield each vehicle as a dict with the same fields as the `vehicle_statuses` response."""
+        for i in range(len(self)):
+            record = {field: getattr(self, field)[i].item() for field in self.id_columns}
+            for field in self.id_columns:
+                if record[field] == MISSING_ID:
+                    record[field] = None
+            for field in self.float_columns:
+                value = getattr(self, field)[i].item()
+                record[field] = None if np.isnan(value) else int(value) if value.is_integer() else value
+            record['call_name'] = str(self.call_name[i])
+            record['position'] = self.positions[i].tolist()
+            yield record
+
+
+def test_vehicle_snapshot():
+    vehicles = [
+        dict(id=1, agency_id=64, route_id=4008182, current_stop_id=10, segment_id=100, call_name="1101",
+             heading=45, speed=12.5, position=[42.3378, -71.1024]),
+        dict(id=2, agency_id=64, route_id=4008182, current_stop_id=None, segment_id=101, call_name="1102",
+             heading=90, speed=0, position=[42.3745, -71.1189]),
+        dict(id=3, agency_id=64, route_id=4008184, current_stop_id=11, segment_id=None, call_name="1201",
+             heading=270, speed=5.25, position=[42.3380, -71.1030]),
+    ]
+    snapshot = VehicleSnapshot.from_records(vehicles, timestamp=0)
+    assert len(snapshot) == 3
+    assert snapshot.filter(route_id=4008182).id.tolist() == [1, 2]
+    assert snapshot.filter(route_id=[4008182, 4008184], stop_id=11).id.tolist() == [3]
+    assert snapshot.filter(segment_id={100, 101}).id.tolist() == [1, 2]
+    assert snapshot.filter(route_id=4008182).near((42.3378699, -71.1024789), radius=1.0).id.tolist() == [1]
+    assert snapshot.index().query_radius((42.3378699, -71.1024789), 1.0).tolist() == [0, 2]
+    assert len(snapshot.filter(route_id=1)) == 0
+    assert list(snapshot.records()) == vehicles
+    assert len(VehicleSnapshot.from_records([])) == 0
+
+
+if __name__ == '__main__':
+    test_vehicle_snapshot()
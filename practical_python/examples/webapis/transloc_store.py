@@ -0,0 +1,350 @@
+"""
+
+Append-only on-disk store for vehicle snapshots, with memory-mapped reading.
+
+Saving each `vehicle_statuses` response as json is simple, but weeks of json are slow to load and take
+up a lot of space. The store instead writes each vehicle as a fixed-width binary record (see `RECORD_DTYPE`),
+appending to a single `records.bin` file. A separate `index.bin` file has one entry per snapshot,
+with the snapshot timestamp and the location of its records. Call names have no fixed length, so they are
+stored once each in `names.jsonl`, and records only have the line number of their call name.
+
+Because the records are fixed-width, the files can be read with `numpy.memmap`: the operating system loads
+only the parts of the file we actually access, and columns are returned as views into the file, without copying.
+Time range queries use a binary search on the snapshot timestamps, and vehicle queries use an index of
+the records sorted by vehicle ID and time.
+
+Snapshots from different feeds arrive in the order their requests complete, which is not always the order
+they were requested in. The store therefore accepts snapshots up to `max_delay` seconds older than the newest
+snapshot in the store, and returns snapshots in order of their timestamps.
+
+Usage, saving snapshots from the poller:
+    >>> store = SnapshotStore("vehicle_snapshots")
+    >>> async for feed_snapshot in poller.snapshots():
+    ...     store.append(VehicleSnapshot.from_records(feed_snapshot.vehicles, timestamp=feed_snapshot.timestamp))
+
+Replaying an hour of snapshots:
+    >>> store = SnapshotStore("vehicle_snapshots", mode='r')
+    >>> for snapshot in store.replay(start=t0, end=t0 + 3600):
+    ...     ...
+
+"""
+import json
+import os
+import numpy as np
+
+from practical_python.examples.webapis.transloc_snapshot import VehicleSnapshot
+
+# One record per vehicle per snapshot: 88 bytes per record, vs. about 300 bytes as json.
+RECORD_DTYPE = np.dtype([
+    ('timestamp', 'f8'),
+    ('id', 'i8'),
+    ('agency_id', 'i8'),
+    ('route_id', 'i8'),
+    ('current_stop_id', 'i8'),
+    ('segment_id', 'i8'),
+    ('position', 'f8', (2,)),
+    ('heading', 'f8'),
+    ('speed', 'f8'),
+    ('call_name', 'i8'),  # Line number of the call name in names.jsonl.
+])
+
+# One entry per snapshot: records[start:start+count] are the records of the snapshot taken at `timestamp`.
+INDEX_DTYPE = np.dtype([
+    ('timestamp', 'f8'),
+    ('start', 'i8'),
+    ('count', 'i8'),
+])
+
+
+def _memmap(filename, dtype):
+    """Memory-map a file as an array of `dtype` records. Returns an empty array for empty/missing files."""
+    n = os.path.getsize(filename) // dtype.itemsize if os.path.exists(filename) else 0
+    if n == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode='r', shape=(n,))
+
+
+class SnapshotStore:
+    """Append-only binary store of vehicle snapshots in directory `path`.
+
+    Args:
+        path: Directory with the store files. Created if it doesn't exist (in append mode).
+        mode: 'a' to append (and read), 'r' for read-only.
+        max_delay: Maximum number of seconds a snapshot may be older than the newest snapshot in the store.
+    """
+
+    def __init__(self, path, mode='a', max_delay=60.0):
+        if mode not in ('a', 'r'):
+            raise ValueError("`mode` must be 'a' or 'r', got %r." % (mode,))
+        self.path = path
+        self.mode = mode
+        self.max_delay = max_delay
+        self.records_fn = os.path.join(path, "records.bin")
+        self.index_fn = os.path.join(path, "index.bin")
+        self.names_fn = os.path.join(path, "names.jsonl")
+        if mode == 'a':
+            os.makedirs(path, exist_ok=True)
+            self._repair()
+        self._records = self._index = self._sorted = None
+        self._names, self._name_codes, self._names_size = [], {}, 0
+        self._names_array = np.array([], dtype=str)
+        self._vehicle_index = None
+        self.refresh()
+
+    def _repair(self):
+        """Truncate records (and partial index entries and names) left over from an interrupted `append`."""
+        index = _memmap(self.index_fn, INDEX_DTYPE)
+        index_size = len(index) * INDEX_DTYPE.itemsize
+        n_records = int(index['start'][-1] + index['count'][-1]) if len(index) else 0
+        del index
+        for filename, size in [(self.index_fn, index_size), (self.records_fn, n_records * RECORD_DTYPE.itemsize)]:
+            if os.path.exists(filename) and os.path.getsize(filename) != size:
+                with open(filename, 'r+b') as fd:
+                    fd.truncate(size)
+        # Names are written before the records using them, so only a partially written last line can be invalid:
+        if os.path.exists(self.names_fn):
+            with open(self.names_fn, 'r+b') as fd:
+                data = fd.read()
+                if data and not data.endswith(b"\n"):
+                    fd.truncate(data.rfind(b"\n") + 1)
+
+    def refresh(self):
+        """Re-map the files, to see snapshots appended since the store was opened (e.g. by another process)."""
+        self._index = _memmap(self.index_fn, INDEX_DTYPE)
+        self._records = _memmap(self.records_fn, RECORD_DTYPE)
+        timestamps = self._index['timestamp']
+        if np.any(timestamps[1:] < timestamps[:-1]):
+            self._sorted = self._index[np.argsort(timestamps, kind='stable')]
+        else:
+            self._sorted = self._index
+        if self._vehicle_index is not None and self._vehicle_index[0] != len(self._records):
+            self._vehicle_index = None
+        self._read_names()
+
+    def _read_names(self):
+        """Read call names added to names.jsonl since the last call."""
+        if not os.path.exists(self.names_fn) or os.path.getsize(self.names_fn) == self._names_size:
+            return
+        with open(self.names_fn, 'rb') as fd:
+            fd.seek(self._names_size)
+            data = fd.read()
+        data = data[:data.rfind(b"\n") + 1]  # Ignore a partial line, still being written by another process.
+        for line in data.splitlines():
+            name = json.loads(line)
+            self._name_codes.setdefault(name, len(self._names))
+            self._names.append(name)
+        self._names_size += len(data)
+        self._names_array = np.array(self._names, dtype=str)
+
+    def _encode_names(self, names):
+        """Return array with the line number in names.jsonl of each name, adding new names to the file."""
+        new_names = [name for name in dict.fromkeys(names) if name not in self._name_codes]
+        if new_names:
+            with open(self.names_fn, 'a', encoding='utf-8') as fd:
+                fd.write("".join(json.dumps(name) + "\n" for name in new_names))
+            self._read_names()
+        return np.array([self._name_codes[name] for name in names], dtype=np.int64)
+
+    def __len__(self):
+        """Number of snapshots in the store."""
+        return len(self._index)
+
+    @property
+    def timestamps(self):
+        """Array with the timestamp of each snapshot, in order of time."""
+        return self._sorted['timestamp']
+
+    @property
+    def records(self):
+        """All records, in the order they were appended, as a memory-mapped array with dtype `RECORD_DTYPE`."""
+        return self._records
+
+    def append(self, snapshot):
+        """Append a `VehicleSnapshot`, at most `max_delay` seconds older than the newest snapshot in the store."""
+        if self.mode != 'a':
+            raise ValueError("Store is opened read-only.")
+        if len(self._index) and snapshot.timestamp < self.timestamps[-1] - self.max_delay:
+            raise ValueError("Snapshot timestamp %s is more than %s seconds before the last snapshot in the store (%s)."
+                             % (snapshot.timestamp, self.max_delay, self.timestamps[-1]))
+        records = np.zeros(len(snapshot), dtype=RECORD_DTYPE)
+        records['timestamp'] = snapshot.timestamp
+        for field in VehicleSnapshot.id_columns + VehicleSnapshot.float_columns:
+            records[field] = getattr(snapshot, field)
+        records['position'] = snapshot.positions
+        records['call_name'] = self._encode_names(snapshot.call_name.tolist())
+        start = int(self._index['start'][-1] + self._index['count'][-1]) if len(self._index) else 0
+        entry = np.array([(snapshot.timestamp, start, len(snapshot))], dtype=INDEX_DTYPE)
+        # Write records before the index entry, so an interrupted append never leaves an index entry without records:
+        with open(self.records_fn, 'ab') as fd:
+            fd.write(records.tobytes())
+        with open(self.index_fn, 'ab') as fd:
+            fd.write(entry.tobytes())
+        self.refresh()
+
+    def _index_range(self, start=None, end=None):
+        """Return (first, last) snapshot numbers for snapshots with start <= timestamp < end."""
+        timestamps = self.timestamps
+        first = 0 if start is None else int(np.searchsorted(timestamps, start, side='left'))
+        last = len(timestamps) if end is None else int(np.searchsorted(timestamps, end, side='left'))
+        return first, last
+
+    def range(self, start=None, end=None):
+        """Return all records from snapshots with start <= timestamp < end, in order of time.
+
+        If the snapshots were appended in order, this is a memory-mapped view, otherwise a copy.
+        """
+        first, last = self._index_range(start, end)
+        if first >= last:
+            return self._records[:0]
+        entries = self._sorted[first:last]
+        if np.all(entries['start'][1:] == entries['start'][:-1] + entries['count'][:-1]):
+            return self._records[int(entries['start'][0]):int(entries['start'][-1] + entries['count'][-1])]
+        return np.concatenate([self._records[start:start+count] for start, count in
+                               zip(entries['start'].tolist(), entries['count'].tolist())])
+
+    def _vehicle_order(self):
+        """Return (ids, timestamps, order), with the records sorted by vehicle ID and time as `records[order]`.
+
+        Built on first use, and rebuilt when records were appended since.
+        """
+        if self._vehicle_index is None:
+            order = np.lexsort((self._records['timestamp'], self._records['id']))
+            self._vehicle_index = (len(self._records), self._records['id'][order], self._records['timestamp'][order],
+                                   order)
+        return self._vehicle_index[1:]
+
+    def vehicle_history(self, vehicle_id, start=None, end=None):
+        """Return all records for the given vehicle with start <= timestamp < end, in order of time."""
+        ids, timestamps, order = self._vehicle_order()
+        first, last = np.searchsorted(ids, vehicle_id, side='left'), np.searchsorted(ids, vehicle_id, side='right')
+        if start is not None:
+            first += np.searchsorted(timestamps[first:last], start, side='left')
+        if end is not None:
+            last = first + np.searchsorted(timestamps[first:last], end, side='left')
+        return self._records[order[first:last]]
+
+    def snapshot(self, i):
+        """Return snapshot number `i` (in order of time) as a `VehicleSnapshot`.
+
+        Columns are views into the memory-mapped file, except for `call_name`.
+        """
+        timestamp, start, count = self._sorted[i].tolist()
+        return self._to_snapshot(self._records[start:start+count], timestamp)
+
+    def _to_snapshot(self, records, timestamp):
+        columns = {field: records[field] for field in VehicleSnapshot.id_columns + VehicleSnapshot.float_columns}
+        columns['positions'] = records['position']
+        columns['call_name'] = self._names_array[records['call_name']]
+        return VehicleSnapshot(timestamp=timestamp, **columns)
+
+    def replay(self, start=None, end=None):
+        """Yield each snapshot with start <= timestamp < end, in order of time, as a `VehicleSnapshot`."""
+        first, last = self._index_range(start, end)
+        for i in range(first, last):
+            yield self.snapshot(i)
+
+
+def test_snapshot_store():
+    import tempfile
+
+    def make_snapshot(timestamp, n):
+        return VehicleSnapshot.from_records([
+            dict(id=i, agency_id=64, route_id=4008182 + i % 2, current_stop_id=None if i % 3 else 10 + i,
+                 segment_id=100 + i, call_name="11%02d" % i, heading=i * 10, speed=timestamp + 0.5,
+                 position=[42.33 + i * 0.001, -71.10 + timestamp * 0.0001])
+            for i in range(n)], timestamp=timestamp)
+
+    snapshots = [make_snapshot(timestamp, n) for timestamp, n in [(100, 3), (110, 5), (120, 0), (130, 4)]]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store = SnapshotStore(tmpdir)
+        for snapshot in snapshots:
+            store.append(snapshot)
+        assert len(store) == 4 and len(store.records) == 12
+
+        reader = SnapshotStore(tmpdir, mode='r')
+        assert isinstance(reader.records, np.memmap)
+        assert reader.timestamps.tolist() == [100, 110, 120, 130]
+        for original, replayed in zip(snapshots, reader.replay()):
+            assert replayed.timestamp == original.timestamp
+            assert list(replayed.records()) == list(original.records())
+        assert [snapshot.timestamp for snapshot in reader.replay(start=105, end=130)] == [110, 120]
+        assert len(reader.range(105, 125)) == 5
+        assert isinstance(reader.range(105, 125), np.memmap)
+        assert reader.vehicle_history(2)['timestamp'].tolist() == [100, 110, 130]
+        assert reader.vehicle_history(2, start=105, end=130)['timestamp'].tolist() == [110]
+        assert len(reader.vehicle_history(99)) == 0
+        assert reader.snapshot(1).filter(route_id=4008182).id.tolist() == [0, 2, 4]
+
+        # An interrupted append (records written, but no index entry) is cleaned up when re-opened:
+        with open(store.records_fn, 'ab') as fd:
+            fd.write(b"partial")
+        with open(store.names_fn, 'ab') as fd:
+            fd.write(b'"Part')
+        store = SnapshotStore(tmpdir)
+        assert len(store.records) == 12
+        store.append(make_snapshot(140, 2))
+        assert len(store) == 5 and store.snapshot(4).id.tolist() == [0, 1]
+        reader.refresh()  # Sees the appended snapshot, and updates the vehicle index:
+        assert reader.vehicle_history(1)['timestamp'].tolist() == [100, 110, 130, 140]
+
+
+def test_snapshot_store_round_trip():
+    import tempfile
+
+    # Long and non-ASCII call names, and values that are not exact as 32-bit floats, are stored exactly:
+    vehicles = [dict(id=1, call_name="Shuttle 1201", heading=12.3, speed=45.67, position=[42.3378699, -71.1024789]),
+                dict(id=2, call_name="Bus Åløb", heading=None, speed=0.1, position=[42.3, -71.1]),
+                dict(id=3, call_name="", heading=359.9, speed=None, position=[42.4, -71.2])]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store = SnapshotStore(tmpdir)
+        store.append(VehicleSnapshot.from_records(vehicles, timestamp=100))
+        store.append(VehicleSnapshot.from_records(vehicles[::-1], timestamp=110))
+        with open(store.names_fn, encoding='utf-8') as fd:
+            assert len(fd.readlines()) == 3  # Each name is only stored once.
+        reader = SnapshotStore(tmpdir, mode='r')
+        for replayed, expected in zip(reader.replay(), [vehicles, vehicles[::-1]]):
+            for record, vehicle in zip(replayed.records(), expected):
+                assert {field: record[field] for field in vehicle} == vehicle
+
+
+def test_snapshot_store_feeds():
+    import asyncio
+    import tempfile
+    import time
+    from practical_python.examples.webapis.transloc_poller import Feed, VehiclePoller
+
+    class SlowClient:
+        """Client where requests for agency 1 take longer than requests for agency 2."""
+        def vehicle_statuses(self, agency_ids, route_ids=None):
+            time.sleep(0.05 if agency_ids == [1] else 0)
+            return [dict(id=agency_ids[0], agency_id=agency_ids[0], call_name="%s" % agency_ids, position=[42, -71])]
+
+    poller = VehiclePoller([Feed(1, interval=0.01), Feed(2, interval=0.01)], client=SlowClient())
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store = SnapshotStore(tmpdir)
+
+        async def save():
+            delivered = []
+            async for feed_snapshot in poller.snapshots(max_polls=2):
+                delivered.append(feed_snapshot.timestamp)
+                store.append(VehicleSnapshot.from_records(feed_snapshot.vehicles, timestamp=feed_snapshot.timestamp))
+            return delivered
+
+        delivered = asyncio.run(save())
+        assert delivered != sorted(delivered)  # The slow feed's snapshots arrive after later snapshots.
+        assert store.timestamps.tolist() == sorted(delivered)
+        assert [snapshot.timestamp for snapshot in store.replay()] == sorted(delivered)
+        assert store.range()['timestamp'].tolist() == sorted(delivered)
+        assert store.vehicle_history(1)['agency_id'].tolist() == [1, 1]
+        try:
+            store.append(VehicleSnapshot.from_records([], timestamp=min(delivered) - 120))
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("Expected ValueError for a snapshot older than `max_delay`.")
+
+
+if __name__ == '__main__':
+    test_snapshot_store()
+    test_snapshot_store_round_trip()
+    test_snapshot_store_feeds()
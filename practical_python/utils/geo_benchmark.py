@@ -0,0 +1,207 @@
+"""
+
+Benchmarks for the geo_utils distance functions and heading labels.
+
+For each distance backend, and each input size, we measure the time per distance calculation and the
+error relative to a reference. The reference is the ellipsoidal (WGS-84) geodesic distance from
+`geographiclib` if available, otherwise the spherical `haversine_array` (in which case the spherical
+backends will all show an error of ~0).
+
+Usage:
+    python -m practical_python.utils.geo_benchmark
+    python -m practical_python.utils.geo_benchmark --sizes 1000 100000 --max-dist 5 --json results.json
+
+To check for performance regressions, save results from a known-good version with `--json`, and compare:
+    python -m practical_python.utils.geo_benchmark --compare results.json --tolerance 0.2
+
+This exits with status 1 if any benchmark is more than 20% slower than in `results.json`.
+Timings are the best of `--repeat` runs, which is more stable than the average.
+
+"""
+import argparse
+import json
+import sys
+import time
+import numpy as np
+
+from practical_python.utils.geo_utils import (
+    haversine_py, equirectangular_dist, haversine_array, equirectangular_array, dist_rowwise,
+    get_distance_backend, get_heading_str, get_heading_strs,
+)
+
+
+def make_pairs(n, max_dist=10.0, center=(42.34, -71.10), spread=1.0, seed=0):
+    """Make `n` random pairs of positions, up to about `max_dist` km apart, in a `spread` degree area around `center`.
+
+    Returns:
+        Two float arrays of shape (n, 2) with (lat, lon) positions.
+    """
+    rng = np.random.RandomState(seed)
+    positions1 = np.column_stack([
+        rng.uniform(center[0] - spread, center[0] + spread, n),
+        rng.uniform(center[1] - spread, center[1] + spread, n),
+    ])
+    dist = rng.uniform(0, max_dist, n)
+    bearing = rng.uniform(0, 2*np.pi, n)
+    dlat = dist * np.cos(bearing) / 110.574
+    dlon = dist * np.sin(bearing) / (111.320 * np.cos(np.radians(positions1[:, 0])))
+    return positions1, positions1 + np.column_stack([dlat, dlon])
+
+
+def reference_dists(positions1, positions2):
+    """Return (name, distances) for the most accurate distance reference available."""
+    try:
+        from geographiclib.geodesic import Geodesic
+    except ImportError:
+        return "haversine_array (spherical)", dist_rowwise(positions1, positions2)
+    wgs84 = Geodesic.WGS84
+    dists = [wgs84.Inverse(lat1, lon1, lat2, lon2, Geodesic.DISTANCE)['s12'] / 1000
+             for (lat1, lon1), (lat2, lon2) in zip(positions1.tolist(), positions2.tolist())]
+    return "geographiclib (WGS-84)", np.array(dists)
+
+
+def get_scalar_backends():
+    """Return dict of available scalar distance functions, {name: func(pos1, pos2) -> km}."""
+    backends = {}
+    try:
+        from haversine import haversine
+        backends['haversine (package)'] = haversine
+    except ImportError:
+        pass
+    try:
+        from geopy.distance import great_circle
+        backends['great_circle (geopy)'] = lambda pos1, pos2: great_circle(pos1, pos2).km
+    except ImportError:
+        pass
+    backends['haversine_py'] = haversine_py
+    backends['equirectangular_dist'] = equirectangular_dist
+    backends['auto'] = get_distance_backend('auto')
+    return backends
+
+
+def get_vector_backends():
+    """Return dict of vectorized distance functions, {name: func(positions1, positions2) -> km array}."""
+    return {
+        'haversine_array': lambda p1, p2: haversine_array(p1[:, 0], p1[:, 1], p2[:, 0], p2[:, 1]),
+        'equirectangular_array': lambda p1, p2: equirectangular_array(p1[:, 0], p1[:, 1], p2[:, 0], p2[:, 1]),
+        'auto_array': lambda p1, p2: dist_rowwise(p1, p2, method='auto'),
+    }
+
+
+def best_time(func, repeat=5):
+    """Return the best wall-clock time of `repeat` calls to `func()`, and the result of the last call."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def run_benchmarks(sizes=(100, 1000, 10000), max_dist=10.0, repeat=5, seed=0):
+    """Run all benchmarks and return a list of result dicts.
+
+    Each result has keys 'name', 'size', 'seconds' (best total time), 'ns_per_op', 'ops_per_sec',
+    'max_abs_err' and 'max_rel_err' (for distances, in km and relative to the reference),
+    or 'mismatches' (for heading labels, relative to `get_heading_str`).
+    """
+    results = []
+    for size in sizes:
+        positions1, positions2 = make_pairs(size, max_dist=max_dist, seed=seed)
+        reference_name, reference = reference_dists(positions1, positions2)
+        pairs = list(zip(map(tuple, positions1.tolist()), map(tuple, positions2.tolist())))
+
+        cases = [(name, lambda func=func: [func(pos1, pos2) for pos1, pos2 in pairs])
+                 for name, func in get_scalar_backends().items()]
+        cases += [(name, lambda func=func: func(positions1, positions2))
+                  for name, func in get_vector_backends().items()]
+        for name, func in cases:
+            seconds, dists = best_time(func, repeat=repeat)
+            abs_err = np.abs(np.asarray(dists, dtype=float) - reference)
+            rel_err = abs_err / np.maximum(reference, 1e-9)
+            results.append(dict(
+                name=name, size=size, seconds=seconds, ns_per_op=seconds / size * 1e9, ops_per_sec=size / seconds,
+                reference=reference_name, max_abs_err=float(abs_err.max()), max_rel_err=float(rel_err.max()),
+            ))
+
+        headings = np.random.RandomState(seed).uniform(0, 360, size)
+        expected = [get_heading_str(heading) for heading in headings.tolist()]
+        for name, func in [('get_heading_str', lambda: [get_heading_str(heading) for heading in headings.tolist()]),
+                           ('get_heading_strs', lambda: get_heading_strs(headings).tolist())]:
+            seconds, labels = best_time(func, repeat=repeat)
+            results.append(dict(
+                name=name, size=size, seconds=seconds, ns_per_op=seconds / size * 1e9, ops_per_sec=size / seconds,
+                mismatches=sum(label != exp for label, exp in zip(labels, expected)),
+            ))
+    return results
+
+
+def format_results(results):
+    """Format benchmark results as a text table."""
+    lines = ["%-24s %8s %12s %14s %12s %12s" % ("Benchmark", "Size", "ns/op", "ops/s", "max err km", "max rel err")]
+    for res in results:
+        if 'mismatches' in res:
+            errors = "%12s %12s" % ("", "%s wrong" % res['mismatches'])
+        else:
+            errors = "%12.3g %12.3g" % (res['max_abs_err'], res['max_rel_err'])
+        lines.append("%-24s %8d %12.1f %14.0f %s" % (res['name'], res['size'], res['ns_per_op'], res['ops_per_sec'],
+                                                     errors))
+    references = {res['reference'] for res in results if 'reference' in res}
+    lines.append("Distance errors relative to: %s" % ", ".join(sorted(references)))
+    return "\n".join(lines)
+
+
+def compare_results(results, baseline, tolerance=0.2):
+    """Return list of (name, size, seconds, baseline_seconds) for benchmarks slower than baseline by > tolerance."""
+    baseline = {(res['name'], res['size']): res['seconds'] for res in baseline}
+    regressions = []
+    for res in results:
+        base_seconds = baseline.get((res['name'], res['size']))
+        if base_seconds is not None and res['seconds'] > base_seconds * (1 + tolerance):
+            regressions.append((res['name'], res['size'], res['seconds'], base_seconds))
+    return regressions
+
+
+def parse_args(argv=None):
+    ap = argparse.ArgumentParser(description="Benchmark geo_utils distance functions and heading labels.")
+    ap.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000], help="Input sizes to benchmark.")
+    ap.add_argument("--max-dist", type=float, default=10.0, help="Maximum distance (km) between point pairs.")
+    ap.add_argument("--repeat", type=int, default=5, help="Number of runs per benchmark; the best time is used.")
+    ap.add_argument("--seed", type=int, default=0, help="Random seed for the input data.")
+    ap.add_argument("--json", metavar="FILE", help="Save results to this json file.")
+    ap.add_argument("--compare", metavar="FILE", help="Compare against results in this json file.")
+    ap.add_argument("--tolerance", type=float, default=0.2, help="Allowed slow-down relative to --compare results.")
+    return ap.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = run_benchmarks(sizes=args.sizes, max_dist=args.max_dist, repeat=args.repeat, seed=args.seed)
+    print(format_results(results))
+    if args.json:
+        with open(args.json, 'w') as fd:
+            json.dump(results, fd, indent=1)
+    if args.compare:
+        with open(args.compare) as fd:
+            regressions = compare_results(results, json.load(fd), tolerance=args.tolerance)
+        for name, size, seconds, base_seconds in regressions:
+            print("REGRESSION: %s (size %s) took %.3g s, baseline %.3g s." % (name, size, seconds, base_seconds))
+        if regressions:
+            return 1
+    return 0
+
+
+def test_run_benchmarks():
+    results = run_benchmarks(sizes=[50], repeat=1)
+    by_name = {res['name']: res for res in results}
+    assert by_name['haversine_py']['max_rel_err'] < 0.01  # Spherical vs. ellipsoidal earth: less than 1% error.
+    assert abs(by_name['haversine_array']['max_abs_err'] - by_name['haversine_py']['max_abs_err']) < 1e-9
+    assert by_name['get_heading_strs']['mismatches'] == 0
+    assert "haversine_array" in format_results(results)
+    slower = [dict(res, seconds=res['seconds'] / 2) for res in results]
+    assert len(compare_results(results, slower, tolerance=0.5)) == len(results)
+    assert compare_results(results, results) == []
+
+
+if __name__ == '__main__':
+    sys.exit(main())
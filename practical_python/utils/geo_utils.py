@@ -1,28 +1,59 @@
 
 from math import cos, sqrt, pi, radians, sin, asin
+from collections import namedtuple
+import contextlib
+import contextvars
+import functools
 import numpy as np
-try:
-    # Haversine ("great circle") formula for converting difference in lat/lon coordinates to distance in km:
-    from haversine import haversine
-    # Methods, in order of precision: Vincenty's > Haversine
-    # Note: The differences are insignificant for distances less than 100 km.
-    # Packages: geopy, haversine, geographiclib
-except ImportError:
+
+from practical_python.utils import metrics
+
+# Mean earth radius in km, same value as used by the `haversine` package. Use 3958.7613 for miles.
+EARTH_RADIUS_KM = 6371.0088
+
+
+def haversine_py(pos1, pos2):
+    """Pure-python haversine distance in km between two (lat, lon) positions.
+
+    From https://stackoverflow.com/a/4913653/3241277, adapted to take (lat, lon) positions.
+    """
+    (lat1, lon1), (lat2, lon2) = pos1, pos2
+    # convert decimal degrees to radians
+    lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
+
+    # haversine formula:
+    dlon, dlat = lon2 - lon1, lat2 - lat1
+    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
+    c = 2 * asin(sqrt(a))
+    return c * EARTH_RADIUS_KM
+
+
+def _load_haversine():
+    try:
+        # Haversine ("great circle") formula for converting difference in lat/lon coordinates to distance in km:
+        from haversine import haversine
+    except ImportError:
+        haversine = haversine_py
+    return haversine
+
+
+def _load_great_circle():
+    from geopy.distance import great_circle
+    return lambda pos1, pos2: great_circle(pos1, pos2).km
+
+
+def _load_geodesic():
+    """Distance on the WGS-84 ellipsoid. More accurate than Vincenty's formula, and always converges."""
     try:
-        from geopy.distance import great_circle as haversine
+        from geographiclib.geodesic import Geodesic
     except ImportError:
-        def haversine(pos1, pos2):
-            """From https://stackoverflow.com/a/4913653/3241277"""
-            (lon1, lat1), (lon2, lat2) = pos1, pos2
-            # convert decimal degrees to radians
-            lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
+        from geopy.distance import geodesic
+        return lambda pos1, pos2: geodesic(pos1, pos2).km
+    wgs84 = Geodesic.WGS84
 
-            # haversine formula:
-            dlon, dlat = lon2 - lon1, lat2 - lat1
-            a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-            c = 2 * asin(sqrt(a))
-            r = 6371  # Radius of earth in kilometers. Use 3956 for miles
-            return c * r
+    def geodesic_dist(pos1, pos2):
+        return wgs84.Inverse(pos1[0], pos1[1], pos2[0], pos2[1], Geodesic.DISTANCE)['s12'] / 1000
+    return geodesic_dist
 
 
 def equirectangular_dist(pos1, pos2):
@@ -41,7 +72,859 @@ def equirectangular_dist(pos1, pos2):
     x = (pos1[1] - pos2[1]) * 111.320 * cos((pos1[0]+pos2[0]) * pi/360)  # OK for small distances
     return sqrt(x**2 + y**2)
 
-gps_dist = haversine
+
+# Distance backends
+# -----------------
+# Methods, in order of precision: Vincenty's (geodesic) > Haversine > Equirectangular.
+# Note: The differences are insignificant for distances less than 100 km.
+# Packages: geopy, haversine, geographiclib
+#
+# Backends are registered as loader functions, which are only called (importing any required packages)
+# the first time the backend is used. That way, importing geo_utils doesn't import e.g. geopy unless needed.
+# The special backend 'auto' uses the equirectangular approximation for distances below a threshold,
+# and haversine for longer distances.
+
+# Threshold (in km) below which the 'auto' backend uses the equirectangular approximation:
+AUTO_THRESHOLD_KM = 1.0
+
+_distance_backend_loaders = {
+    'haversine': _load_haversine,
+    'haversine_py': lambda: haversine_py,
+    'equirectangular': lambda: equirectangular_dist,
+    'great_circle': _load_great_circle,
+    'geodesic': _load_geodesic,
+    'vincenty': _load_geodesic,
+}
+_distance_backends = {}  # Loaded backends, {name: dist_func}
+
+# Current default backend and 'auto' threshold. Use `set_distance_backend` or `distance_backend` to change.
+_backend_context = contextvars.ContextVar('distance_backend', default=('haversine', AUTO_THRESHOLD_KM))
+
+
+def register_distance_backend(name, loader, vectorized=None):
+    """Register a distance backend.
+
+    Args:
+        name: Name of the backend.
+        loader: Function without arguments, returning a function `dist(pos1, pos2)` that gives the distance in km.
+        vectorized: Optional vectorized version, `func(lat1, lon1, lat2, lon2)`, taking numpy arrays.
+            If not given, vectorized functions call the scalar function for each position.
+    """
+    _distance_backend_loaders[name] = loader
+    _distance_backends.pop(name, None)
+    if vectorized is None:
+        # Don't keep the vectorized function of a previously registered backend with the same name:
+        vectorized_dist_funcs.pop(name, None)
+    else:
+        vectorized_dist_funcs[name] = vectorized
+
+
+def _resolve_backend_name(backend):
+    return _backend_context.get() if backend is None else (backend, _backend_context.get()[1])
+
+
+def get_distance_backend(backend=None):
+    """Return scalar distance function `dist(pos1, pos2)` for the given backend name (default: current backend)."""
+    name, threshold = _resolve_backend_name(backend)
+    if name == 'auto':
+        return functools.partial(_auto_dist, threshold=threshold, far_dist=get_distance_backend('haversine'))
+    try:
+        return _distance_backends[name]
+    except KeyError:
+        pass
+    try:
+        loader = _distance_backend_loaders[name]
+    except KeyError:
+        raise ValueError("Unknown distance backend %r, must be one of %s." % (
+            name, ['auto'] + list(_distance_backend_loaders)))
+    dist_func = _distance_backends[name] = loader()
+    return dist_func
+
+
+def set_distance_backend(backend, threshold=None):
+    """Set the default distance backend, and optionally the threshold in km for the 'auto' backend."""
+    _backend_context.set((backend, _backend_context.get()[1] if threshold is None else threshold))
+
+
+@contextlib.contextmanager
+def distance_backend(backend, threshold=None):
+    """Context manager for using a given distance backend within a block of code.
+
+    The setting is local to the current thread / asyncio task.
+
+    Examples:
+        >>> with distance_backend('auto', threshold=2.0):
+        ...     dists = dist_one_to_many(lma_pos, positions)
+    """
+    token = _backend_context.set((backend, _backend_context.get()[1] if threshold is None else threshold))
+    try:
+        yield
+    finally:
+        _backend_context.reset(token)
+
+
+def gps_dist(pos1, pos2, backend=None):
+    """Distance in km between two (lat, lon) positions, using the given backend (default: current backend).
+
+    Available backends are 'haversine', 'haversine_py', 'equirectangular', 'great_circle' (geopy),
+    'geodesic' or 'vincenty' (geographiclib or geopy), and 'auto'.
+    """
+    return get_distance_backend(backend)(pos1, pos2)
+
+
+def _auto_dist(pos1, pos2, threshold=AUTO_THRESHOLD_KM, far_dist=haversine_py):
+    dist = equirectangular_dist(pos1, pos2)
+    return dist if dist < threshold else far_dist(pos1, pos2)
+
+
+def __getattr__(name):
+    # Lazily resolve `haversine`, so `from geo_utils import haversine` still works (PEP 562):
+    if name == 'haversine':
+        return get_distance_backend('haversine')
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+# Vectorized distance functions
+# ------------------------------
+# The scalar functions above are fine for a handful of positions, but calling them once per vehicle
+# in a Python loop gets slow for large fleets. The functions below take numpy arrays of lat/lon
+# coordinates (in degrees) and compute all distances in one go. They broadcast like numpy ufuncs.
+
+def haversine_array(lat1, lon1, lat2, lon2):
+    """Haversine ("great circle") distance in km between arrays of lat/lon coordinates (in degrees).
+
+    Args:
+        lat1, lon1: Latitude and longitude of the first position(s).
+        lat2, lon2: Latitude and longitude of the second position(s).
+
+    Returns:
+        numpy array with distances in km, with the broadcast shape of the inputs.
+    """
+    lat1, lon1, lat2, lon2 = (np.radians(arr) for arr in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1)/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1)/2)**2
+    # Clip `a` to guard against rounding errors pushing it slightly above 1 for antipodal points:
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def equirectangular_array(lat1, lon1, lat2, lon2):
+    """Vectorized version of `equirectangular_dist`, taking arrays of lat/lon coordinates (in degrees)."""
+    y = (np.asarray(lat1) - lat2) * 110.574
+    x = (np.asarray(lon1) - lon2) * 111.320 * np.cos((np.asarray(lat1) + lat2) * pi/360)
+    return np.sqrt(x**2 + y**2)
+
+
+vectorized_dist_funcs = {
+    'haversine': haversine_array,
+    'equirectangular': equirectangular_array,
+}
+
+
+def as_latlon_array(positions):
+    """Convert `positions` to a float array of shape (N, 2) with columns (lat, lon).
+
+    A single (lat, lon) pair is returned as an array of shape (1, 2).
+    """
+    positions = np.asarray(positions, dtype=float)
+    if positions.ndim == 1:
+        positions = positions.reshape(-1, 2)
+    if positions.ndim != 2 or positions.shape[1] != 2:
+        raise ValueError("`positions` must have shape (N, 2), got %s." % (positions.shape,))
+    return positions
+
+
+def _auto_array(lat1, lon1, lat2, lon2, threshold=AUTO_THRESHOLD_KM):
+    """Equirectangular approximation for distances below `threshold` km, haversine for the rest."""
+    dists = equirectangular_array(lat1, lon1, lat2, lon2)
+    far = dists >= threshold
+    if np.any(far):
+        lat1, lon1, lat2, lon2 = (np.broadcast_to(arr, dists.shape)[far] for arr in (lat1, lon1, lat2, lon2))
+        dists[far] = haversine_array(lat1, lon1, lat2, lon2)
+    return dists
+
+
+def _get_vectorized_dist_func(method=None):
+    """Return vectorized distance function for the given method / backend name (default: current backend).
+
+    Backends without a vectorized version fall back to calling the scalar function for each position.
+    """
+    name, threshold = _resolve_backend_name(method)
+    if name == 'auto':
+        return functools.partial(_auto_array, threshold=threshold)
+    try:
+        return vectorized_dist_funcs[name]
+    except KeyError:
+        pass
+    dist_func = get_distance_backend(name)
+
+    def dist_loop(lat1, lon1, lat2, lon2):
+        arrays = np.broadcast_arrays(*(np.asarray(arr, dtype=float) for arr in (lat1, lon1, lat2, lon2)))
+        dists = [dist_func((la1, lo1), (la2, lo2)) for la1, lo1, la2, lo2 in zip(*(arr.ravel() for arr in arrays))]
+        return np.array(dists, dtype=float).reshape(arrays[0].shape)
+    return dist_loop
+
+
+def dist_one_to_many(pos, positions, method=None):
+    """Distance in km from a single (lat, lon) position `pos` to each of the (N, 2) `positions`.
+
+    Args:
+        pos: (lat, lon) position.
+        positions: Array-like of shape (N, 2) with (lat, lon) positions.
+        method: Distance backend, e.g. 'haversine', 'equirectangular' or 'auto'.
+            Default is the current backend, see `distance_backend`.
+
+    Returns:
+        numpy array of shape (N,).
+
+    Examples:
+        >>> dist_one_to_many((42.3378699, -71.1024789), [(42.3389477, -71.1018647), (42.35, -71.05)])
+        array([0.13004466, 4.51901365])
+    """
+    dist_func = _get_vectorized_dist_func(method)
+    lat, lon = as_latlon_array(pos)[0]
+    positions = as_latlon_array(positions)
+    metrics.count('distance_calls', len(positions))
+    return dist_func(lat, lon, positions[:, 0], positions[:, 1])
+
+
+def dist_pairwise(positions1, positions2=None, method=None):
+    """Distance matrix in km between each of the (N, 2) `positions1` and each of the (M, 2) `positions2`.
+
+    If `positions2` is not given, the distances between all points in `positions1` is calculated.
+    See `dist_one_to_many` for `method`.
+
+    Returns:
+        numpy array of shape (N, M), where element [i, j] is the distance between positions1[i] and positions2[j].
+    """
+    dist_func = _get_vectorized_dist_func(method)
+    positions1 = as_latlon_array(positions1)
+    positions2 = positions1 if positions2 is None else as_latlon_array(positions2)
+    metrics.count('distance_calls', len(positions1) * len(positions2))
+    return dist_func(positions1[:, 0, None], positions1[:, 1, None], positions2[None, :, 0], positions2[None, :, 1])
+
+
+def dist_rowwise(positions1, positions2, method=None):
+    """Distance in km between each pair of rows in `positions1` and `positions2`, both of shape (N, 2).
+
+    See `dist_one_to_many` for `method`.
+
+    Returns:
+        numpy array of shape (N,), where element i is the distance between positions1[i] and positions2[i].
+    """
+    dist_func = _get_vectorized_dist_func(method)
+    positions1, positions2 = as_latlon_array(positions1), as_latlon_array(positions2)
+    if positions1.shape != positions2.shape:
+        raise ValueError("`positions1` and `positions2` must have the same shape, got %s and %s." % (
+            positions1.shape, positions2.shape))
+    metrics.count('distance_calls', len(positions1))
+    return dist_func(positions1[:, 0], positions1[:, 1], positions2[:, 0], positions2[:, 1])
+
+
+DistanceCacheInfo = namedtuple('DistanceCacheInfo', 'hits misses maxsize currsize')
+
+
+class DistanceCache:
+    """Memoized distance calculations with LRU eviction, keyed on coordinates rounded to `precision` decimals.
+
+    Vehicles that are parked, or waiting at a stop, report the same position poll after poll.
+    Caching the distance from these positions to e.g. a bus stop saves re-calculating the same distances.
+    Distances are always calculated from the rounded coordinates, so the result is the same whether the
+    distance comes from the cache or not. 5 decimals corresponds to about 1 m.
+
+    For each origin position (and backend), the cache keeps a sorted array of the rounded destination
+    coordinates, packed into one int64 per position. Positions are looked up with `np.searchsorted`, rather than
+    with a dict lookup per position, and positions unchanged since the previous call (the usual case for a
+    fleet polled in the same order) are found by comparing the arrays, without searching.
+
+    Args:
+        maxsize: Maximum number of distances to keep. The least recently used distances are evicted first.
+        precision: Number of decimals to round coordinates to, at most 7 (about 1 cm).
+        backend: Distance backend, see `gps_dist`. Default is the current backend at the time of calculation.
+            Distances calculated with different backends are cached separately.
+
+    Examples:
+        >>> cache = DistanceCache(maxsize=100000, precision=5)
+        >>> dists = cache.dist_one_to_many(lma_pos, snapshot.positions)
+        >>> cache.info()
+        DistanceCacheInfo(hits=950, misses=50, maxsize=100000, currsize=1000)
+    """
+
+    def __init__(self, maxsize=100000, precision=5, backend=None):
+        if not 0 <= precision <= 7:
+            raise ValueError("`precision` must be between 0 and 7, got %r." % (precision,))
+        self.maxsize = maxsize
+        self.precision = precision
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._scale = 10 ** precision
+        self._lon_range = 360 * self._scale + 1
+        self._origins = {}  # {(backend, threshold, lat, lon): _DistanceCacheEntry}
+        self._size = 0
+        self._tick = 0
+
+    def info(self):
+        return DistanceCacheInfo(self.hits, self.misses, self.maxsize, self._size)
+
+    def clear(self):
+        """Clear the cache and reset the hit/miss counters."""
+        self._origins.clear()
+        self._size = self.hits = self.misses = 0
+
+    def _quantize(self, positions):
+        """Return (lat, lon) int64 arrays with the positions rounded to `precision` decimals, times 10**precision."""
+        quantized = np.round(as_latlon_array(positions) * self._scale).astype(np.int64)
+        return quantized[:, 0], quantized[:, 1]
+
+    def _evict(self):
+        """Evict the least recently used distances, until there are at most `maxsize`."""
+        n_evict = self._size - self.maxsize
+        if n_evict <= 0:
+            return
+        origins = list(self._origins.items())
+        evict = np.zeros(self._size, dtype=bool)
+        evict[np.argpartition(np.concatenate([entry.used for _, entry in origins]), n_evict - 1)[:n_evict]] = True
+        offset = 0
+        for origin, entry in origins:
+            keep = ~evict[offset:offset + len(entry.keys)]
+            offset += len(entry.keys)
+            if not keep.any():
+                del self._origins[origin]
+            elif not keep.all():
+                entry.keys, entry.dists, entry.used = entry.keys[keep], entry.dists[keep], entry.used[keep]
+                entry.last_keys = None
+        self._size -= n_evict
+
+    def dist(self, pos1, pos2):
+        """Distance in km between two (lat, lon) positions, using the cached value if available."""
+        return float(self.dist_one_to_many(pos1, [pos2])[0])
+
+    def dist_one_to_many(self, pos, positions):
+        """Distance in km from `pos` to each of the (N, 2) `positions`. Cache misses are calculated vectorized."""
+        (lat,), (lon,) = self._quantize(pos)
+        origin = _resolve_backend_name(self.backend) + (int(lat), int(lon))
+        lats, lons = self._quantize(positions)
+        keys = lats * self._lon_range + lons
+        self._tick += 1
+        entry = self._origins.get(origin)
+        if entry is None:
+            entry = self._origins[origin] = _DistanceCacheEntry()
+        # Positions that are the same as in the previous call are found without searching:
+        if entry.last_keys is not None and len(entry.last_keys) == len(keys):
+            same = entry.last_keys == keys
+            if same.all():
+                at = entry.last_at
+            else:
+                at = entry.last_at.copy()
+                at[~same] = np.searchsorted(entry.keys, keys[~same])
+        else:
+            at = np.searchsorted(entry.keys, keys)
+        hit = entry.keys[np.minimum(at, len(entry.keys) - 1)] == keys if len(entry.keys) else np.zeros(len(keys), bool)
+        n_hits = int(np.count_nonzero(hit))
+        self.hits += n_hits
+        self.misses += len(keys) - n_hits
+        metrics.count('distance_cache_hits', n_hits)
+        metrics.count('distance_cache_misses', len(keys) - n_hits)
+        if n_hits == len(keys):
+            entry.used[at] = self._tick
+            entry.last_keys, entry.last_at = keys, at
+            return entry.dists[at]
+        missing = ~hit
+        new_keys, first = np.unique(keys[missing], return_index=True)
+        new_positions = np.column_stack([lats[missing][first], lons[missing][first]]) / self._scale
+        new_dists = dist_one_to_many((lat / self._scale, lon / self._scale), new_positions, method=origin[0])
+        insert_at = np.searchsorted(entry.keys, new_keys)
+        entry.keys = np.insert(entry.keys, insert_at, new_keys)
+        entry.dists = np.insert(entry.dists, insert_at, new_dists)
+        entry.used = np.insert(entry.used, insert_at, self._tick)
+        at = np.searchsorted(entry.keys, keys)
+        entry.used[at] = self._tick
+        entry.last_keys, entry.last_at = keys, at
+        dists = entry.dists[at]
+        self._size += len(new_keys)
+        self._evict()
+        return dists
+
+
+class _DistanceCacheEntry:
+    """Cached distances from one origin: `keys` are the sorted packed destinations, with `dists` and `used` ticks.
+
+    `last_keys` and `last_at` are the keys of the previous lookup and their location in `keys`, or None if
+    `keys` changed since.
+    """
+    __slots__ = ('keys', 'dists', 'used', 'last_keys', 'last_at')
+
+    def __init__(self):
+        self.keys = np.empty(0, dtype=np.int64)
+        self.dists = np.empty(0)
+        self.used = np.empty(0, dtype=np.int64)
+        self.last_keys = self.last_at = None
+
+
+def bounding_box(pos, radius):
+    """Return the lat/lon bounding box (lat_min, lon_min, lat_max, lon_max) of a circle around `pos`.
+
+    The box is exact for a spherical earth, see
+    http://janmatuschek.de/LatitudeLongitudeBoundingCoordinates
+    If the circle covers a pole, the box spans all longitudes. If the box crosses the antimeridian,
+    lon_min will be larger than lon_max.
+
+    Args:
+        pos: (lat, lon) center position, in degrees.
+        radius: Circle radius, in km.
+    """
+    lat, lon = pos
+    dlat = np.degrees(radius / EARTH_RADIUS_KM)
+    lat_min, lat_max = lat - dlat, lat + dlat
+    if lat_min <= -90 or lat_max >= 90 or radius / EARTH_RADIUS_KM >= pi/2:
+        return max(lat_min, -90.0), -180.0, min(lat_max, 90.0), 180.0
+    dlon = np.degrees(asin(min(1.0, sin(radius / EARTH_RADIUS_KM) / cos(radians(lat)))))
+    lon_min, lon_max = (lon - dlon + 180) % 360 - 180, (lon + dlon + 180) % 360 - 180
+    return lat_min, lon_min, lat_max, lon_max
+
+
+class GeoGridIndex:
+    """Spatial index for fast radius, k-nearest and bounding-box queries against a fixed set of positions.
+
+    Positions are bucketed into a regular lat/lon grid. A query only needs to look at the positions
+    in the grid cells overlapping the query area, rather than at all positions.
+    Build the index once per snapshot of positions, then run as many queries against it as needed.
+
+    Args:
+        positions: Array-like of shape (N, 2) with (lat, lon) positions in degrees.
+        cell_size: Approximate grid cell size, in km. A good value is on the order of the typical query radius.
+
+    Examples:
+        >>> index = GeoGridIndex([bus['position'] for bus in buses], cell_size=1.0)
+        >>> near_lma = [buses[i] for i in index.query_radius(lma_pos, 1.0)]
+    """
+
+    def __init__(self, positions, cell_size=1.0):
+        self.positions = as_latlon_array(positions)
+        self.cell_size = cell_size
+        # Cells are `cell_lat` degrees tall and `cell_lon` degrees wide. Cells are made at least `cell_size`
+        # wide at the highest latitude in the dataset (longitude degrees get shorter towards the poles).
+        max_abs_lat = min(np.abs(self.positions[:, 0]).max(), 89.0) if len(self.positions) else 0.0
+        self.cell_lat = np.degrees(cell_size / EARTH_RADIUS_KM)
+        self.n_lon_cells = max(1, int(360 // (self.cell_lat / cos(radians(max_abs_lat)))))
+        self.cell_lon = 360 / self.n_lon_cells
+        # Sort position indices by cell, and record where each cell starts and stops in the sorted array:
+        keys = self._cell_keys(self.positions)
+        self._order = np.argsort(keys, kind='stable')
+        cell_keys, starts, counts = np.unique(keys[self._order], return_index=True, return_counts=True)
+        self._cells = {key: (start, start + count) for key, start, count in
+                       zip(cell_keys.tolist(), starts.tolist(), counts.tolist())}
+        self._cell_keys_array = cell_keys
+
+    def __len__(self):
+        return len(self.positions)
+
+    def _cell_rows_cols(self, lat, lon):
+        row = np.floor((np.asarray(lat) + 90) / self.cell_lat).astype(np.int64)
+        col = np.floor((np.asarray(lon) + 180) / self.cell_lon).astype(np.int64) % self.n_lon_cells
+        return row, col
+
+    def _cell_keys(self, positions):
+        row, col = self._cell_rows_cols(positions[:, 0], positions[:, 1])
+        return row * self.n_lon_cells + col
+
+    def _candidates(self, lat_min, lon_min, lat_max, lon_max):
+        """Return indices of all positions in grid cells overlapping the given bounding box."""
+        (row_min, row_max), (col_min, col_max) = self._cell_rows_cols([lat_min, lat_max], [lon_min, lon_max])
+        if lon_max - lon_min >= 360 or (lon_min <= -180 and lon_max >= 180):
+            # Box spans all longitudes (e.g. around a pole). Note that col_max wraps around to 0 for lon 180:
+            col_min, col_max = 0, self.n_lon_cells - 1
+        elif lon_min > lon_max or col_min > col_max:
+            # Box crosses the antimeridian. Both ends can be in the same column, so don't visit any column twice:
+            col_max = min(col_max + self.n_lon_cells, col_min + self.n_lon_cells - 1)
+        row_min, row_max = max(row_min, 0), min(row_max, int(180 // self.cell_lat))
+        if (row_max - row_min + 1) * (col_max - col_min + 1) > len(self._cells):
+            # Large box: select from the non-empty cells, rather than looking up every cell in the box.
+            rows, cols = np.divmod(self._cell_keys_array, self.n_lon_cells)
+            cols = np.where(cols < col_min, cols + self.n_lon_cells, cols)
+            keys = self._cell_keys_array[(rows >= row_min) & (rows <= row_max) & (cols <= col_max)].tolist()
+        else:
+            keys = [row * self.n_lon_cells + col % self.n_lon_cells
+                    for row in range(row_min, row_max + 1) for col in range(col_min, col_max + 1)]
+        chunks = []
+        for key in keys:
+            cell = self._cells.get(key)
+            if cell is not None:
+                chunks.append(self._order[cell[0]:cell[1]])
+        return np.concatenate(chunks) if chunks else np.empty(0, dtype=np.int64)
+
+    def query_bbox(self, lat_min, lon_min, lat_max, lon_max):
+        """Return indices of all positions inside the given lat/lon bounding box (sorted ascending).
+
+        If lon_min is larger than lon_max, the box is taken to cross the antimeridian.
+        """
+        idxs = self._candidates(lat_min, lon_min, lat_max, lon_max)
+        lat, lon = self.positions[idxs, 0], self.positions[idxs, 1]
+        in_lon = (lon >= lon_min) & (lon <= lon_max) if lon_min <= lon_max else (lon >= lon_min) | (lon <= lon_max)
+        return np.sort(idxs[(lat >= lat_min) & (lat <= lat_max) & in_lon])
+
+    def query_radius(self, pos, radius, return_dist=False):
+        """Return indices of all positions within `radius` km of `pos`, sorted by distance.
+
+        Args:
+            pos: (lat, lon) position to search around.
+            radius: Search radius, in km.
+            return_dist: If True, return a tuple of (indices, distances).
+        """
+        idxs = self._candidates(*bounding_box(pos, radius))
+        dists = dist_one_to_many(pos, self.positions[idxs])
+        within = dists < radius
+        idxs, dists = idxs[within], dists[within]
+        order = np.argsort(dists, kind='stable')
+        return (idxs[order], dists[order]) if return_dist else idxs[order]
+
+    def query_knn(self, pos, k=1, return_dist=False):
+        """Return indices of the `k` positions nearest to `pos`, sorted by distance.
+
+        The search radius is expanded until at least `k` positions are found.
+        """
+        k = min(k, len(self.positions))
+        radius = self.cell_size
+        while radius < pi * EARTH_RADIUS_KM:
+            idxs, dists = self.query_radius(pos, radius, return_dist=True)
+            if len(idxs) >= k:
+                break
+            radius *= 2
+        else:
+            dists = dist_one_to_many(pos, self.positions)
+            idxs = np.argsort(dists, kind='stable')
+            dists = dists[idxs]
+        return (idxs[:k], dists[:k]) if return_dist else idxs[:k]
+
+
+class CircleGeofence:
+    """Geofence covering all positions within `radius` km of `center`.
+
+    Args:
+        center: (lat, lon) position of the center, in degrees.
+        radius: Radius, in km.
+        name: Name used to identify the geofence, e.g. in events.
+    """
+
+    def __init__(self, center, radius, name=None):
+        self.center = tuple(center)
+        self.radius = radius
+        self.name = name
+
+    def __repr__(self):
+        return "CircleGeofence(%r, %r, name=%r)" % (self.center, self.radius, self.name)
+
+    def contains(self, positions):
+        """Return boolean array telling whether each of the (N, 2) `positions` is inside the geofence."""
+        return dist_one_to_many(self.center, positions) < self.radius
+
+
+def decode_polyline(encoded, precision=5):
+    """Decode a Google "encoded polyline" string, as used e.g. for Transloc segments, to a list of (lat, lon).
+
+    See https://developers.google.com/maps/documentation/utilities/polylinealgorithm
+
+    >>> decode_polyline("_p~iF~ps|U_ulLnnqC_mqNvxq`@")
+    [(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)]
+    """
+    values, value, shift = [], 0, 0
+    for char in encoded:
+        byte = ord(char) - 63
+        value |= (byte & 0x1f) << shift
+        shift += 5
+        if byte < 0x20:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value, shift = 0, 0
+    factor = 10 ** precision
+    lats, lons = np.cumsum(values[0::2]), np.cumsum(values[1::2])
+    return [(lat / factor, lon / factor) for lat, lon in zip(lats.tolist(), lons.tolist())]
+
+
+class Polyline:
+    """A path through a sequence of (lat, lon) vertices, e.g. the shape of a bus route.
+
+    Edge lengths and the cumulative distance along the path are computed once, when the polyline is created.
+    Positions are projected onto edges using a local flat-earth approximation around each edge's start vertex,
+    which is accurate to well within GPS precision for edges up to a few km long.
+
+    Args:
+        vertices: Array-like of shape (M, 2) with (lat, lon) positions in degrees, M >= 2.
+
+    Examples:
+        >>> route = Polyline(decode_polyline(segment['points']))
+        >>> along, offset, edge = route.project(snapshot.positions)
+    """
+
+    def __init__(self, vertices):
+        self.vertices = as_latlon_array(vertices)
+        if len(self.vertices) < 2:
+            raise ValueError("A polyline needs at least two vertices, got %s." % len(self.vertices))
+        self._start = self.vertices[:-1]
+        self._coslat = np.cos(np.radians(self._start[:, 0]))
+        # Edge vectors in km, as (north, east):
+        delta = np.diff(self.vertices, axis=0)
+        delta[:, 1] = (delta[:, 1] + 180) % 360 - 180
+        self._north = np.radians(delta[:, 0]) * EARTH_RADIUS_KM
+        self._east = np.radians(delta[:, 1]) * self._coslat * EARTH_RADIUS_KM
+        self.edge_lengths = np.hypot(self._north, self._east)
+        self.bearings = np.degrees(np.arctan2(self._east, self._north)) % 360  # Compass bearing of each edge.
+        self.cumulative = np.concatenate([[0.0], np.cumsum(self.edge_lengths)])  # Distance along path at each vertex.
+        self.length = float(self.cumulative[-1])
+
+    def __len__(self):
+        """Number of edges."""
+        return len(self.edge_lengths)
+
+    def _project_edges(self, positions, edges):
+        """Project each position onto each of its candidate edges.
+
+        Args:
+            positions: Array of shape (N, 2).
+            edges: Integer array of shape (N, W) with W candidate edges for each position.
+
+        Returns:
+            Tuple of (along, offset) arrays of shape (N, W): the distance along the path to the projected position,
+            and the distance from the position to the edge, in km.
+        """
+        north = np.radians(positions[:, 0:1] - self._start[edges, 0]) * EARTH_RADIUS_KM
+        east = np.radians((positions[:, 1:2] - self._start[edges, 1] + 180) % 360 - 180) * self._coslat[edges] \
+            * EARTH_RADIUS_KM
+        edge_north, edge_east, lengths = self._north[edges], self._east[edges], self.edge_lengths[edges]
+        t = (north * edge_north + east * edge_east) / np.where(lengths > 0, lengths**2, 1)
+        t = np.clip(t, 0, 1)
+        offset = np.hypot(north - t * edge_north, east - t * edge_east)
+        return self.cumulative[edges] + t * lengths, offset
+
+    def project(self, positions, hint=None, window=8, max_offset=None, wrap=False, headings=None,
+                heading_penalty=0.1):
+        """Find the nearest point on the polyline for each position.
+
+        Searching all edges for every position costs O(N * M). When positions are updated incrementally,
+        e.g. a vehicle's position on each poll, pass the previous edge of each position as `hint`; only
+        edges from `hint - 1` to `hint + window` are then searched, falling back to a full search for
+        positions without a hint, or (if `max_offset` is given) farther than `max_offset` from the hinted edges.
+
+        Args:
+            positions: Array-like of shape (N, 2) with (lat, lon) positions.
+            hint: Optional integer array of shape (N,) with the previous edge of each position, -1 for none.
+            window: Number of edges ahead of `hint` to search.
+            max_offset: Maximum distance in km from the hinted edges before doing a full search.
+            wrap: If True, the hint window wraps around from the last edge to the first (for closed loops).
+            headings: Optional array of shape (N,) with the heading of each position (compass degrees).
+                Edges whose bearing differs by more than 90 degrees are penalized by `heading_penalty` km,
+                so vehicles are matched to the correct side of routes that go back and forth along the same road.
+
+        Returns:
+            Tuple of (along, offset, edge) arrays: distance in km along the polyline to the nearest point,
+            distance in km from the position to that point, and the index of the edge it is on.
+        """
+        positions = as_latlon_array(positions)
+        n, n_edges = len(positions), len(self)
+        along, offset, edge = np.zeros(n), np.full(n, np.inf), np.full(n, -1, dtype=np.int64)
+        if headings is not None:
+            headings = np.asarray(headings, dtype=float)
+
+        def search(rows, candidates):
+            cand_along, cand_offset = self._project_edges(positions[rows], candidates)
+            score = cand_offset
+            if headings is not None:
+                diff = np.abs((headings[rows, None] - self.bearings[candidates] + 180) % 360 - 180)
+                score = cand_offset + np.where(diff > 90, heading_penalty, 0)
+            best = np.argmin(score, axis=1)
+            k = np.arange(len(rows))
+            along[rows], offset[rows], edge[rows] = cand_along[k, best], cand_offset[k, best], candidates[k, best]
+
+        if hint is not None:
+            hint = np.asarray(hint, dtype=np.int64)
+            rows = np.flatnonzero(hint >= 0)
+            if len(rows):
+                candidates = hint[rows, None] + np.arange(-1, window + 1)
+                candidates = candidates % n_edges if wrap else np.clip(candidates, 0, n_edges - 1)
+                search(rows, candidates)
+        redo = edge < 0
+        if max_offset is not None:
+            redo |= offset > max_offset
+        rows = np.flatnonzero(redo)
+        if len(rows):
+            search(rows, np.broadcast_to(np.arange(n_edges), (len(rows), n_edges)))
+        return along, offset, edge
+
+    def interpolate(self, along):
+        """Return (N, 2) array with the (lat, lon) positions at distances `along` (km) along the polyline."""
+        along = np.clip(np.asarray(along, dtype=float), 0, self.length)
+        edge = np.clip(np.searchsorted(self.cumulative, along, side='right') - 1, 0, len(self) - 1)
+        t = (along - self.cumulative[edge]) / np.where(self.edge_lengths[edge] > 0, self.edge_lengths[edge], 1)
+        lat = self._start[edge, 0] + t * np.degrees(self._north[edge] / EARTH_RADIUS_KM)
+        lon = self._start[edge, 1] + t * np.degrees(self._east[edge] / EARTH_RADIUS_KM) / self._coslat[edge]
+        return np.column_stack([lat, (lon + 180) % 360 - 180])
+
+
+class _LatitudeBands:
+    """Index of items (e.g. polygon edges) by the latitude bands they overlap.
+
+    The latitude range of all items is split into bands of equal height, and each band lists the items
+    overlapping it. A position then only needs to be checked against the items in its own band.
+
+    Args:
+        lat_min, lat_max: Arrays with the latitude range of each item.
+        n_bands: Number of bands. Defaults to about one band per four items.
+    """
+
+    def __init__(self, lat_min, lat_max, n_bands=None):
+        self.lat_min, self.lat_max = float(np.min(lat_min)), float(np.max(lat_max))
+        self.n_bands = n_bands or int(np.clip(len(lat_min) // 4, 1, 1024))
+        self.height = (self.lat_max - self.lat_min) / self.n_bands or 1.0
+        first, last = self._band(lat_min), self._band(lat_max)
+        bands = [[] for _ in range(self.n_bands)]
+        for item, (start, stop) in enumerate(zip(first.tolist(), last.tolist())):
+            for band in range(start, stop + 1):
+                bands[band].append(item)
+        self.bands = [np.array(items, dtype=np.int64) for items in bands]
+
+    def _band(self, lats):
+        return np.clip(np.floor((np.asarray(lats) - self.lat_min) / self.height).astype(np.int64), 0, self.n_bands - 1)
+
+    def groups(self, lats):
+        """Yield (rows, items) for each band, where `rows` are the indices of the `lats` inside that band."""
+        lats = np.asarray(lats)
+        rows = np.flatnonzero((lats >= self.lat_min) & (lats <= self.lat_max))
+        bands = self._band(lats[rows])
+        order = np.argsort(bands, kind='stable')
+        rows, bands = rows[order], bands[order]
+        band_ids, starts = np.unique(bands, return_index=True)
+        for band, start, stop in zip(band_ids.tolist(), starts.tolist(), starts[1:].tolist() + [len(rows)]):
+            if len(self.bands[band]):
+                yield rows[start:stop], self.bands[band]
+
+
+class PolygonGeofence:
+    """Geofence covering the inside of a polygon, e.g. a bus depot.
+
+    Edges are straight lines in lat/lon, as in GeoJSON. The polygon must not cross the antimeridian.
+    Positions outside the polygon's bounding box are rejected right away; for the others, the exact
+    point-in-polygon (ray casting) test only looks at the edges in the position's latitude band.
+
+    Args:
+        vertices: Array-like of shape (M, 2) with the (lat, lon) polygon vertices. The polygon is closed
+            automatically, i.e. the last vertex does not need to repeat the first.
+        name: Name used to identify the geofence, e.g. in events.
+    """
+
+    def __init__(self, vertices, name=None):
+        self.vertices = as_latlon_array(vertices)
+        if len(self.vertices) < 3:
+            raise ValueError("A polygon needs at least three vertices, got %s." % len(self.vertices))
+        self.name = name
+        self._start, self._end = self.vertices, np.roll(self.vertices, -1, axis=0)
+        (self.lat_min, self.lon_min), (self.lat_max, self.lon_max) = self.vertices.min(0), self.vertices.max(0)
+        self._bands = _LatitudeBands(np.minimum(self._start[:, 0], self._end[:, 0]),
+                                     np.maximum(self._start[:, 0], self._end[:, 0]))
+
+    def __repr__(self):
+        return "PolygonGeofence(<%s vertices>, name=%r)" % (len(self.vertices), self.name)
+
+    def contains(self, positions):
+        """Return boolean array telling whether each of the (N, 2) `positions` is inside the geofence."""
+        positions = as_latlon_array(positions)
+        inside = np.zeros(len(positions), dtype=bool)
+        in_box = (positions[:, 1] >= self.lon_min) & (positions[:, 1] <= self.lon_max)
+        candidates = np.flatnonzero(in_box)
+        for rows, edges in self._bands.groups(positions[candidates, 0]):
+            rows = candidates[rows]
+            lat, lon = positions[rows, 0:1], positions[rows, 1:2]
+            (lat1, lon1), (lat2, lon2) = self._start[edges].T, self._end[edges].T
+            spans = (lat1 > lat) != (lat2 > lat)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                crossing_lon = lon1 + (lat - lat1) * (lon2 - lon1) / (lat2 - lat1)
+            crossings = np.count_nonzero(spans & (lon < crossing_lon), axis=1)
+            inside[rows] = crossings % 2 == 1
+        return inside
+
+
+class CorridorGeofence:
+    """Geofence covering all positions within `width` km of a path, e.g. a detour along a route's segments.
+
+    Each edge of the path has a precomputed bounding box, expanded by `width`. Positions are first matched
+    to the edges in their latitude band, then to the edges whose box they are inside; the exact distance to the
+    edge is only calculated for those. The path must not cross the antimeridian.
+
+    Args:
+        path: Array-like of shape (M, 2) with (lat, lon) vertices, or a `Polyline`, e.g. `RouteGeometry.shape`.
+        width: Distance from the path, in km.
+        name: Name used to identify the geofence, e.g. in events.
+    """
+
+    def __init__(self, path, width, name=None):
+        self.path = path if isinstance(path, Polyline) else Polyline(path)
+        self.width = width
+        self.name = name
+        start, end = self.path.vertices[:-1], self.path.vertices[1:]
+        dlat = np.degrees(width / EARTH_RADIUS_KM)
+        max_abs_lat = np.minimum(np.maximum(np.abs(start[:, 0]), np.abs(end[:, 0])) + dlat, 89.0)
+        dlon = dlat / np.cos(np.radians(max_abs_lat))
+        self.edge_boxes = np.column_stack([  # (lat_min, lon_min, lat_max, lon_max) of each edge.
+            np.minimum(start[:, 0], end[:, 0]) - dlat, np.minimum(start[:, 1], end[:, 1]) - dlon,
+            np.maximum(start[:, 0], end[:, 0]) + dlat, np.maximum(start[:, 1], end[:, 1]) + dlon,
+        ])
+        self._bands = _LatitudeBands(self.edge_boxes[:, 0], self.edge_boxes[:, 2])
+
+    def __repr__(self):
+        return "CorridorGeofence(<%s edges>, %r, name=%r)" % (len(self.path), self.width, self.name)
+
+    def contains(self, positions):
+        """Return boolean array telling whether each of the (N, 2) `positions` is inside the geofence."""
+        positions = as_latlon_array(positions)
+        inside = np.zeros(len(positions), dtype=bool)
+        for rows, edges in self._bands.groups(positions[:, 0]):
+            boxes = self.edge_boxes[edges]
+            lat, lon = positions[rows, 0:1], positions[rows, 1:2]
+            in_box = (lat >= boxes[:, 0]) & (lon >= boxes[:, 1]) & (lat <= boxes[:, 2]) & (lon <= boxes[:, 3])
+            row_idx, edge_idx = np.nonzero(in_box)
+            if len(row_idx):
+                _, offset = self.path._project_edges(positions[rows[row_idx]], edges[edge_idx, None])
+                inside[rows[row_idx[offset[:, 0] <= self.width]]] = True
+        return inside
+
+
+# Heading labels for each resolution, with heading_strs[resolution][index] covering the arc centered on
+# index * 90 / 2**(resolution-1) degrees:
+heading_strs = [
+    [],  # resolution=0
+    ["N", "E", "S", "W"],
+    ["N", "NE", "E", "SE", "S", "SW", "W", "NW"],
+    ["N", "NNE", "NE", "ENE", "E", "ESE", "SE", "SSE", "S", "SSW", "SW", "WSW", "W", "WNW", "NW", "NNW"]
+]
+# Alternative approach: Use cos/sin to determine how close to North/South (sin) and East/West (cos) we are.
+assert [len(arr) for arr in heading_strs] == [0, 4, 8, 16]
+corners = {
+    "N": "North",
+    "E": "East",
+    "S": "South",
+    "W": "West"
+}
+# Lookup tables, {(resolution, long_form, sep): labels}, as lists for `get_heading_str` and as numpy arrays for
+# `get_heading_strs`. Long-form tables for separators other than "-" are added by `_get_heading_labels` as needed.
+_heading_labels = {}
+_heading_label_arrays = {}
+
+
+def _get_heading_labels(resolution, long_form, sep, as_array=False):
+    if not long_form:
+        sep = "-"  # sep is only used for the long form.
+    key = (resolution, bool(long_form), sep)
+    if key not in _heading_labels:
+        if not 0 < resolution < 4:
+            raise ValueError("`resolution` must be 1, 2, or 3.")
+        labels = heading_strs[resolution]
+        if long_form:
+            labels = [sep.join(corners[char] for char in res) for res in labels]
+        _heading_labels[key] = labels
+        _heading_label_arrays[key] = np.array(labels)
+    return _heading_label_arrays[key] if as_array else _heading_labels[key]
+
+
+for _resolution in range(1, 4):
+    _get_heading_labels(_resolution, long_form=False, sep="-")
+    _get_heading_labels(_resolution, long_form=True, sep="-")
 
 
 def get_heading_str(heading, resolution=2, long_form=False, sep="-"):
@@ -65,38 +948,41 @@ def get_heading_str(heading, resolution=2, long_form=False, sep="-"):
         >>> get_heading_str(40, resolution=3)  # Use three words to describe heading
         "North-East"
     """
-    if not 0 < resolution < 4:
-        raise ValueError("`resolution` must be 1, 2, or 3.")
+    labels = _get_heading_labels(resolution, long_form, sep)
     if heading < -360:
         raise ValueError("`heading` is %s, but must be above -360 degrees, preferably between 0 and 360." % heading)
     arc = 90 / 2**(resolution-1)  # 90 for resolution of 1, 45 for resolution of 2, etc.
-    # print("resolution, arc =", resolution, arc, end=": ")
-    # print("heading = %0.02f" % heading, end=" ")
     heading = (heading + 360) % 360  # Ensure heading in range 0..360
-    # print("=> %0.02f" % heading, end=" ")
     index = int(((heading + arc/2) % 360) // arc)
-    # print(", index =", index, end=" ", flush=True)
-    # heading_strs[resolution][index]
-    heading_strs = [
-        [],  # resolution=0
-        ["N", "E", "S", "W"],
-        ["N", "NE", "E", "SE", "S", "SW", "W", "NW"],
-        ["N", "NNE", "NE", "ENE", "E", "ESE", "SE", "SSE", "S", "SSW", "SW", "WSW", "W", "WNW", "NW", "NNW"]
-    ]
-    # Alternative approach: Use cos/sin to determine how close to North/South (sin) and East/West (cos) we are.
-    assert [len(arr) for arr in heading_strs] == [0, 4, 8, 16]
-    corners = {
-        "N": "North",
-        "E": "East",
-        "S": "South",
-        "W": "West"
-    }
-    res = heading_strs[resolution][index]
-    if long_form:
-        res = sep.join(corners[char] for char in res)
-    # print(", res =", res)
-    # print(heading_old, heading, index, res)
-    return res
+    return labels[index]
+
+
+def get_heading_strs(headings, resolution=2, long_form=False, sep="-"):
+    """Vectorized version of `get_heading_str`, labelling an array of headings in one go.
+
+    Args:
+        headings: Array-like of headings, in degrees.
+        resolution, long_form, sep: As for `get_heading_str`.
+
+    Returns:
+        numpy array of heading labels (str), with the same shape as `headings`.
+        Missing headings (NaN, e.g. from `VehicleSnapshot.heading`) are labelled "".
+
+    Examples:
+        >>> get_heading_strs([22, 44, 180+46, np.nan], resolution=3)
+        array(['NNE', 'NE', 'SW', ''], dtype='<U3')
+    """
+    labels = _get_heading_labels(resolution, long_form, sep, as_array=True)
+    headings = np.asarray(headings, dtype=float)
+    if np.any(headings < -360):
+        raise ValueError("`headings` must be above -360 degrees, preferably between 0 and 360.")
+    missing = ~np.isfinite(headings)
+    if np.any(missing):
+        headings = np.where(missing, 0.0, headings)
+    arc = 90 / 2**(resolution-1)
+    headings = (headings + 360) % 360
+    index = (((headings + arc/2) % 360) // arc).astype(np.intp)
+    return np.where(missing, "", labels[index]) if np.any(missing) else labels[index]
 
 
 def test_get_heading_str():
@@ -149,11 +1035,234 @@ def test_get_heading_str():
         for heading in np.linspace(origin-45/4, origin+45/4-0.1, 20):
             assert get_heading_str(heading, resolution=3) == bearing[0]
 
+
+def print_heading_strs():
+    """Print heading labels for headings from -60 to 390 degrees, for visual inspection."""
     for i in range(-60, 390):
         print("Heading %3s => %3s (%s) or %03s (%s)" % (
             i, get_heading_str(i), get_heading_str(i, long_form=True),
             get_heading_str(i, resolution=3), get_heading_str(i, long_form=True, resolution=3),
         ))
 
+
+def test_vectorized_dist():
+    rng = np.random.RandomState(0)
+    # Positions around Boston, within ~50 km:
+    positions1 = np.column_stack([rng.uniform(42.0, 42.6, 50), rng.uniform(-71.5, -70.8, 50)])
+    positions2 = np.column_stack([rng.uniform(42.0, 42.6, 40), rng.uniform(-71.5, -70.8, 40)])
+    pos = (42.3378699, -71.1024789)
+
+    dists = dist_one_to_many(pos, positions1)
+    assert dists.shape == (50,)
+    for pos1, dist in zip(positions1, dists):
+        assert abs(float(gps_dist(tuple(pos1), pos)) - dist) < 1e-9
+    dists = dist_one_to_many(pos, positions1, method='equirectangular')
+    for pos1, dist in zip(positions1, dists):
+        assert abs(equirectangular_dist(tuple(pos1), pos) - dist) < 1e-9
+
+    matrix = dist_pairwise(positions1, positions2)
+    assert matrix.shape == (50, 40)
+    for i, j in [(0, 0), (3, 17), (49, 39)]:
+        assert abs(float(gps_dist(tuple(positions1[i]), tuple(positions2[j]))) - matrix[i, j]) < 1e-9
+    assert np.allclose(np.diag(dist_pairwise(positions1)), 0)
+
+    rowwise = dist_rowwise(positions1[:40], positions2)
+    assert np.allclose(rowwise, np.diag(matrix[:40]))
+
+
+def test_geo_grid_index():
+    rng = np.random.RandomState(1)
+    positions = np.column_stack([rng.uniform(42.0, 42.6, 2000), rng.uniform(-71.5, -70.8, 2000)])
+    index = GeoGridIndex(positions, cell_size=2.0)
+    pos = (42.3378699, -71.1024789)
+    dists = dist_one_to_many(pos, positions)
+
+    for radius in (0.5, 1.0, 5.0, 30.0):
+        assert set(index.query_radius(pos, radius).tolist()) == set(np.flatnonzero(dists < radius).tolist())
+    idxs, knn_dists = index.query_knn(pos, k=10, return_dist=True)
+    assert idxs.tolist() == np.argsort(dists, kind='stable')[:10].tolist()
+    assert np.allclose(knn_dists, np.sort(dists)[:10])
+
+    bbox = (42.2, -71.2, 42.4, -71.0)
+    expected = np.flatnonzero((positions[:, 0] >= 42.2) & (positions[:, 0] <= 42.4)
+                              & (positions[:, 1] >= -71.2) & (positions[:, 1] <= -71.0))
+    assert index.query_bbox(*bbox).tolist() == expected.tolist()
+
+    # Queries across the antimeridian:
+    index = GeoGridIndex([(0.0, 179.99), (0.0, -179.99), (0.0, 170.0)], cell_size=1.0)
+    assert sorted(index.query_radius((0.0, 180.0), 5.0).tolist()) == [0, 1]
+    assert index.query_bbox(-1, 179, 1, -179).tolist() == [0, 1]
+
+    # World, polar and very large radius queries, which span all longitudes:
+    positions = np.column_stack([np.degrees(np.arcsin(rng.uniform(-1, 1, 1000))), rng.uniform(-180, 180, 1000)])
+    positions[:100, 0] = rng.uniform(89.5, 90, 100)
+    index = GeoGridIndex(positions, cell_size=100.0)
+    assert index.query_bbox(-90, -180, 90, 180).tolist() == list(range(1000))
+    for pos, radius in [((0, 0), 15000), ((89.9, 0), 4000), ((89.9, 0), 50), ((-30, 179), 8000), ((0, 0), 25000)]:
+        expected = np.flatnonzero(dist_one_to_many(pos, positions) < radius)
+        assert len(expected) and sorted(index.query_radius(pos, radius).tolist()) == expected.tolist()
+    for pos in [(89.9, 0), (47.0, 173.2), (-60, -179.5)]:  # Large knn searches, also across the antimeridian:
+        expected = np.argsort(dist_one_to_many(pos, positions), kind='stable')[:500]
+        assert index.query_knn(pos, k=500).tolist() == expected.tolist()
+
+
+def test_polyline():
+    assert decode_polyline("_p~iF~ps|U_ulLnnqC_mqNvxq`@") == [(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)]
+    rng = np.random.RandomState(2)
+    vertices = np.cumsum(np.column_stack([rng.uniform(-0.002, 0.004, 200), rng.uniform(-0.002, 0.004, 200)]),
+                         axis=0) + (42.33, -71.10)
+    line = Polyline(vertices)
+    assert np.allclose(line.edge_lengths, dist_rowwise(vertices[:-1], vertices[1:]), rtol=1e-3)
+    assert np.allclose(line.interpolate(line.cumulative), vertices)
+
+    # Positions offset from points on the line project back onto (close to) those points:
+    along = np.sort(rng.uniform(0, line.length, 50))
+    positions = line.interpolate(along)
+    got_along, offset, edge = line.project(positions)
+    assert np.allclose(got_along, along, atol=1e-6) and np.all(offset < 1e-6)
+    assert np.all(line.cumulative[edge] <= got_along + 1e-9) and np.all(got_along <= line.cumulative[edge + 1] + 1e-9)
+    positions += rng.normal(0, 0.0001, positions.shape)
+    full = line.project(positions)
+    dense = line.interpolate(np.linspace(0, line.length, 20000))
+    assert np.all(full[1] <= dist_pairwise(positions, dense).min(axis=1) + 1e-3)
+    # Searching near a hint gives the same result, and falls back to a full search when the hint is wrong:
+    hinted = line.project(positions, hint=np.maximum(full[2] - 2, 0), max_offset=0.05)
+    assert np.allclose(hinted[0], full[0]) and np.array_equal(hinted[2], full[2])
+    wrong = line.project(positions, hint=(full[2] + 100) % len(line), max_offset=0.05)
+    assert np.allclose(wrong[0], full[0])
+
+    # Headings select the correct side of an out-and-back route:
+    out_and_back = Polyline([(42.33, -71.10), (42.34, -71.10), (42.33, -71.1001)])
+    along, offset, edge = out_and_back.project([(42.335, -71.10005)] * 2, headings=[0, 180])
+    assert edge.tolist() == [0, 1]
+
+
+def test_geofences():
+    rng = np.random.RandomState(4)
+    positions = np.column_stack([rng.uniform(42.28, 42.40, 5000), rng.uniform(-71.16, -71.04, 5000)])
+
+    # Star-shaped (non-convex) polygon, compared with ray casting against all edges:
+    angles = np.linspace(0, 2*pi, 40, endpoint=False)
+    radii = np.where(np.arange(40) % 2, 0.02, 0.05)
+    star = np.column_stack([42.34 + radii * np.sin(angles), -71.10 + radii * np.cos(angles)])
+    polygon = PolygonGeofence(star, name="Depot")
+    expected = np.zeros(len(positions), dtype=bool)
+    for (lat1, lon1), (lat2, lon2) in zip(star, np.roll(star, -1, axis=0)):
+        spans = (lat1 > positions[:, 0]) != (lat2 > positions[:, 0])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            crossing_lon = lon1 + (positions[:, 0] - lat1) * (lon2 - lon1) / (lat2 - lat1)
+        expected ^= spans & (positions[:, 1] < crossing_lon)
+    assert 0 < expected.sum() < len(positions)
+    assert np.array_equal(polygon.contains(positions), expected)
+    assert polygon.contains([(42.34, -71.10), (42.50, -71.10)]).tolist() == [True, False]
+
+    # Corridor, compared with the distance to the path from a full search of all edges:
+    path = np.cumsum(np.column_stack([rng.uniform(-0.001, 0.003, 100), rng.uniform(-0.001, 0.003, 100)]),
+                     axis=0) + (42.30, -71.14)
+    corridor = CorridorGeofence(path, 0.2, name="Detour")
+    _, offset, _ = Polyline(path).project(positions)
+    assert 0 < np.count_nonzero(offset <= 0.2) < len(positions)
+    assert np.array_equal(corridor.contains(positions), offset <= 0.2)
+    assert corridor.contains(np.empty((0, 2))).shape == (0,)
+
+
+def test_get_heading_strs():
+    headings = np.concatenate([np.arange(-60, 390), np.linspace(-360, 720, 2001)])
+    for resolution in range(1, 4):
+        for long_form, sep in [(False, "-"), (True, "-"), (True, " ")]:
+            expected = [get_heading_str(heading, resolution=resolution, long_form=long_form, sep=sep)
+                        for heading in headings]
+            assert get_heading_strs(headings, resolution=resolution, long_form=long_form, sep=sep).tolist() == expected
+    assert get_heading_strs(22, resolution=3) == "NNE"
+    # Missing headings, as in `VehicleSnapshot.heading`:
+    assert get_heading_strs([np.nan, 90, np.inf], resolution=1).tolist() == ["", "E", ""]
+    assert get_heading_strs(np.nan, long_form=True) == ""
+
+
+def test_distance_backends():
+    pos1, pos2 = (42.3378699, -71.1024789), (42.3389477, -71.1018647)
+    far = (42.3745, -71.1189)
+    assert gps_dist(pos1, pos2) == gps_dist(pos1, pos2, backend='haversine')
+    assert abs(gps_dist(pos1, pos2, backend='haversine_py') - gps_dist(pos1, pos2)) < 1e-9
+    assert gps_dist(pos1, pos2, backend='equirectangular') == equirectangular_dist(pos1, pos2)
+    with distance_backend('auto', threshold=1.0):
+        assert gps_dist(pos1, pos2) == equirectangular_dist(pos1, pos2)
+        assert gps_dist(pos1, far) == gps_dist(pos1, far, backend='haversine')
+        dists = dist_one_to_many(pos1, [pos2, far])
+        assert dists.tolist() == [equirectangular_dist(pos1, pos2), gps_dist(pos1, far, backend='haversine')]
+        with distance_backend('haversine_py'):
+            assert gps_dist(pos1, pos2) == haversine_py(pos1, pos2)
+        assert gps_dist(pos1, pos2) == equirectangular_dist(pos1, pos2)
+    assert gps_dist(pos1, pos2) == gps_dist(pos1, pos2, backend='haversine')
+
+    # Backends are only loaded when first used:
+    loaded = []
+
+    def load_manhattan():
+        loaded.append(True)
+        return lambda p1, p2: (abs(p1[0] - p2[0]) + abs(p1[1] - p2[1])) * 111
+    register_distance_backend('manhattan', load_manhattan)
+    assert loaded == []
+    assert abs(gps_dist((0, 0), (1, 1), backend='manhattan') - 222) < 1e-9
+    # Backends without a vectorized function fall back to the scalar function:
+    assert np.allclose(dist_one_to_many((0, 0), [(1, 1), (0, 1)], method='manhattan'), [222, 111])
+    assert loaded == [True]
+    # Re-registering without a vectorized function drops the previous one:
+    register_distance_backend('manhattan', load_manhattan, vectorized=lambda lat1, lon1, lat2, lon2: lat2 * 0)
+    assert dist_one_to_many((0, 0), [(1, 1)], method='manhattan').tolist() == [0]
+    register_distance_backend('manhattan', load_manhattan)
+    assert dist_one_to_many((0, 0), [(1, 1)], method='manhattan').round(9).tolist() == [222]
+    del _distance_backend_loaders['manhattan'], _distance_backends['manhattan']
+    try:
+        gps_dist(pos1, pos2, backend='nonexistent')
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Expected ValueError for unknown backend.")
+
+
+def test_distance_cache():
+    rng = np.random.RandomState(2)
+    positions = np.round(np.column_stack([rng.uniform(42.0, 42.6, 100), rng.uniform(-71.5, -70.8, 100)]), 5)
+    pos = (42.3378699, -71.1024789)
+    cache = DistanceCache(maxsize=150, precision=5)
+    dists = cache.dist_one_to_many(pos, positions)
+    assert np.allclose(dists, dist_one_to_many(pos, positions), atol=0.01)  # 5 decimals ~ 1 m.
+    assert cache.info() == DistanceCacheInfo(hits=0, misses=100, maxsize=150, currsize=100)
+    # Moving positions less than the precision gives cache hits with identical results:
+    assert cache.dist_one_to_many(pos, positions + 1e-7).tolist() == dists.tolist()
+    assert (cache.hits, cache.misses) == (100, 100)
+    assert cache.dist(pos, positions[0]) == dists[0]
+    assert cache.hits == 101
+    # Least recently used entries are evicted first:
+    cache.dist_one_to_many(pos, positions[:60] + 0.1)
+    assert cache.info().currsize == 150
+    cache.dist(pos, positions[0])
+    assert cache.hits == 102
+    # Positions in a different order are found as well:
+    shuffled = np.random.RandomState(3).permutation(60)
+    assert np.array_equal(cache.dist_one_to_many(pos, positions[:60][shuffled] + 0.1),
+                          cache.dist_one_to_many(pos, positions[:60] + 0.1)[shuffled])
+    # Distances are cached separately for each backend:
+    cache = DistanceCache(maxsize=300, precision=5)
+    haversine_dists = cache.dist_one_to_many(pos, positions)
+    with distance_backend('equirectangular'):
+        equirectangular_dists = cache.dist_one_to_many(pos, positions)
+        assert cache.info().currsize == 200
+    assert not np.array_equal(haversine_dists, equirectangular_dists)
+    assert np.allclose(equirectangular_dists, dist_one_to_many(pos, positions, method='equirectangular'), atol=0.01)
+    assert np.array_equal(cache.dist_one_to_many(pos, positions), haversine_dists)
+    cache.clear()
+    assert cache.info() == DistanceCacheInfo(hits=0, misses=0, maxsize=300, currsize=0)
+
+
 if __name__ == '__main__':
     test_get_heading_str()
+    print_heading_strs()
+    test_get_heading_strs()
+    test_vectorized_dist()
+    test_distance_backends()
+    test_distance_cache()
+    test_geo_grid_index()
+    test_polyline()
+    test_geofences()
@@ -0,0 +1,173 @@
+"""
+
+Incremental ("streaming") parsing of large JSON responses.
+
+`response.json()` reads the whole response into memory and parses all of it, even if we only need
+a single record from a long list. For responses of the form `{"success": true, "agencies": [{...}, {...}, ...]}`,
+`iter_json_array` instead reads the data chunk by chunk and yields the records in the list one at a time.
+Records that are not needed can be discarded right away, and we can stop reading as soon as we have
+found what we are looking for.
+
+Records are parsed with `json.JSONDecoder.raw_decode`, i.e. the standard library's C parser,
+so we don't need a dedicated streaming JSON library such as `ijson`.
+
+Usage:
+    >>> res = requests.get("https://feeds.transloc.com/3/agencies", stream=True)
+    >>> masco = find_json_record(res.iter_content(65536), 'agencies', lambda agency: agency['short_name'] == "MASCO")
+
+"""
+import codecs
+import json
+
+from practical_python.utils import metrics
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+_VALUE_END = _WHITESPACE + ",:]}"  # Characters that can follow a complete value.
+
+
+class _ChunkBuffer:
+    """Text buffer fed from an iterator of str or bytes chunks, with a read position."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.utf8_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.text = ""
+        self.pos = 0
+
+    def read_more(self):
+        """Append the next chunk to the buffer. Returns False if there are no more chunks."""
+        for chunk in self.chunks:
+            if isinstance(chunk, bytes):
+                chunk = self.utf8_decoder.decode(chunk)
+            if not chunk:
+                continue
+            # Drop the part of the buffer we have already parsed, so the buffer doesn't grow indefinitely:
+            self.text = self.text[self.pos:] + chunk
+            self.pos = 0
+            return True
+        return False
+
+    def skip_whitespace(self):
+        """Advance to the next non-whitespace character and return it (or "" at the end of the data)."""
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.text) or not self.read_more():
+                return self.text[self.pos:self.pos+1]
+
+    def expect(self, chars):
+        char = self.skip_whitespace()
+        if char not in chars:
+            raise ValueError("Expected one of %r at position %s, got %r." % (chars, self.pos, char))
+        self.pos += 1
+        return char
+
+    def decode_value(self):
+        """Parse and return the next JSON value, reading more chunks as needed."""
+        self.skip_whitespace()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.text, self.pos)
+            except json.JSONDecodeError:
+                if not self.read_more():
+                    raise
+                continue
+            # Numbers and literals are not self-delimiting, e.g. "12" could be the start of "123" or "12.5".
+            # Only accept the value once it is followed by a character that ends a value:
+            if (end < len(self.text) and self.text[end] in _VALUE_END) or not self.read_more():
+                self.pos = end
+                return value
+
+
+def iter_json_array(chunks, key, predicate=None, fields=None):
+    """Yield the items of the list `key` in a JSON object, parsing the data incrementally.
+
+    Args:
+        chunks: Iterable of str or (utf-8) bytes chunks, e.g. `response.iter_content(65536)`.
+        key: Name of the top-level entry containing the list, e.g. 'agencies' or 'vehicles'.
+        predicate: If given, only yield items for which `predicate(item)` is true.
+        fields: If given, only keep these fields of each (dict) item.
+
+    Raises:
+        KeyError if the JSON object has no entry `key`.
+    """
+    buffer = _ChunkBuffer(chunks)
+    buffer.expect("{")
+    if buffer.skip_whitespace() == "}":
+        raise KeyError(key)
+    while True:
+        name = buffer.decode_value()
+        buffer.expect(":")
+        if name != key:
+            buffer.decode_value()  # Skip value, e.g. the "success" entry.
+        else:
+            buffer.expect("[")
+            if buffer.skip_whitespace() == "]":
+                return
+            while True:
+                item = buffer.decode_value()
+                metrics.count('records_parsed')
+                if predicate is None or predicate(item):
+                    yield item if fields is None else {field: item.get(field) for field in fields}
+                if buffer.expect(",]") == "]":
+                    return
+        if buffer.expect(",}") == "}":
+            raise KeyError(key)
+
+
+def find_json_record(chunks, key, predicate):
+    """Return the first item in the list `key` for which `predicate(item)` is true, or None if not found.
+
+    Stops reading `chunks` as soon as a matching item is found.
+    """
+    return next(iter_json_array(chunks, key, predicate=predicate), None)
+
+
+def test_iter_json_array():
+    data = {
+        'success': True,
+        'rate_limit': 1,
+        'agencies': [dict(id=i, short_name="A%s" % i, location="Boston, MA", name="Ågency {%s}," % i)
+                     for i in range(100)] + [12345, None, "x"],
+    }
+    text = json.dumps(data, indent=1)
+    for chunk_size in (1, 7, 4096):
+        chunks = [text[i:i+chunk_size] for i in range(0, len(text), chunk_size)]
+        assert list(iter_json_array(chunks, 'agencies')) == data['agencies']
+        # utf-8 encoded bytes chunks, which may split multi-byte characters:
+        raw = text.encode()
+        bytes_chunks = [raw[i:i+chunk_size] for i in range(0, len(raw), chunk_size)]
+        assert list(iter_json_array(bytes_chunks, 'agencies')) == data['agencies']
+
+    chunks_read = []
+
+    def chunks():
+        for i in range(0, len(text), 100):
+            chunks_read.append(i)
+            yield text[i:i+100]
+
+    record = find_json_record(chunks(), 'agencies', lambda agency: isinstance(agency, dict) and agency['id'] == 3)
+    assert record == data['agencies'][3]
+    assert len(chunks_read) < len(text) / 100 / 2  # Stopped early.
+
+    # Chunks split inside numbers, e.g. right after the decimal point or inside the exponent:
+    text = '{"generated_on": 1508.25, "vehicles": [1.5, 200000.0, 1e5, {"a": 1}], "n": 2.5e-3}'
+    for split in range(1, len(text)):
+        assert list(iter_json_array([text[:split], text[split:]], 'vehicles')) == [1.5, 200000.0, 1e5, {"a": 1}]
+
+    text = json.dumps(data)
+    records = iter_json_array([text], 'agencies', fields=['id'],
+                              predicate=lambda agency: isinstance(agency, dict) and agency['id'] < 2)
+    assert list(records) == [dict(id=0), dict(id=1)]
+    assert list(iter_json_array(['{"vehicles": [] }'], 'vehicles')) == []
+    try:
+        list(iter_json_array(['{"success": false}'], 'vehicles'))
+    except KeyError:
+        pass
+    else:
+        raise AssertionError("Expected KeyError for missing key.")
+
+
+if __name__ == '__main__':
+    test_iter_json_array()
@@ -0,0 +1,276 @@
+"""
+
+Lightweight instrumentation: per-stage timers and counters, reported through pluggable hooks.
+
+To find out where the time goes in a poll cycle, the hot paths are instrumented with timers for each stage
+(e.g. 'http', 'parse', 'filter', 'distance', 'output') and counters (e.g. 'http_bytes', 'records_parsed',
+'distance_calls', 'distance_cache_hits').
+
+Instrumentation is disabled by default. While disabled, `timer()` returns a shared no-op context manager
+and `count()` returns right away, so the instrumented code runs at (almost) full speed.
+
+Usage:
+    >>> with instrumented(hooks=[PrometheusFileHook("transloc.prom"), print_hook]):
+    ...     main()
+    ...     report()  # Calls each hook with the current metrics.
+
+Instrumenting code:
+    >>> with timer('parse'):
+    ...     data = res.json()
+    >>> count('records_parsed', len(data['vehicles']))
+
+Timers and counters are cumulative, so they can be scraped directly by Prometheus (e.g. via the node_exporter
+textfile collector reading the file written by `PrometheusFileHook`).
+
+Refs:
+* https://prometheus.io/docs/instrumenting/exposition_formats/
+
+"""
+import contextlib
+import os
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+
+class Metrics:
+    """Thread-safe collection of counters and stage timers.
+
+    Args:
+        hooks: Callables, called as `hook(data)` by `report()`, with `data` as returned by `snapshot()`.
+    """
+
+    def __init__(self, hooks=()):
+        self.hooks = list(hooks)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Set all counters and timers back to zero."""
+        with self._lock:
+            self.counters = defaultdict(int)
+            self.timers = {}  # {stage: [calls, total seconds, max seconds]}
+
+    def count(self, name, n=1):
+        """Add `n` to counter `name`."""
+        with self._lock:
+            self.counters[name] += n
+
+    def observe(self, stage, seconds):
+        """Record that `stage` took `seconds`."""
+        with self._lock:
+            timer = self.timers.get(stage)
+            if timer is None:
+                self.timers[stage] = [1, seconds, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+                timer[2] = max(timer[2], seconds)
+
+    def timer(self, stage):
+        """Return context manager timing the code inside it as `stage`."""
+        return _Timer(self, stage)
+
+    def snapshot(self):
+        """Return dict with the current 'counters' ({name: value}) and 'timers' ({stage: {calls, seconds, max}})."""
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'timers': {stage: dict(calls=calls, seconds=seconds, max=max_seconds)
+                           for stage, (calls, seconds, max_seconds) in self.timers.items()},
+            }
+
+    def report(self):
+        """Call all hooks with the current metrics, and return the metrics."""
+        data = self.snapshot()
+        for hook in self.hooks:
+            hook(data)
+        return data
+
+
+class _Timer:
+    __slots__ = ('metrics', 'stage', 'start')
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start)
+
+
+# The active Metrics, or None if instrumentation is disabled. This is a plain global rather than a ContextVar,
+# so code running in worker threads (e.g. in VehiclePoller) is instrumented as well.
+_metrics = None
+_NULL_TIMER = contextlib.nullcontext()
+
+
+def enable(hooks=()):
+    """Enable instrumentation, and return the new active `Metrics`."""
+    global _metrics
+    _metrics = Metrics(hooks)
+    return _metrics
+
+
+def disable():
+    """Disable instrumentation."""
+    global _metrics
+    _metrics = None
+
+
+def get_metrics():
+    """Return the active `Metrics`, or None if instrumentation is disabled."""
+    return _metrics
+
+
+@contextlib.contextmanager
+def instrumented(hooks=()):
+    """Context manager enabling instrumentation inside the `with` block. Yields the active `Metrics`."""
+    global _metrics
+    previous = _metrics
+    try:
+        yield enable(hooks)
+    finally:
+        _metrics = previous
+
+
+def count(name, n=1):
+    """Add `n` to counter `name`, if instrumentation is enabled."""
+    if _metrics is not None:
+        _metrics.count(name, n)
+
+
+def timer(stage):
+    """Return context manager timing the code inside it as `stage`, or a no-op if instrumentation is disabled."""
+    if _metrics is None:
+        return _NULL_TIMER
+    return _metrics.timer(stage)
+
+
+def timed_iter(iterable, stage):
+    """Time the work done by `iterable` as `stage`, not including the time spent by the consumer between items.
+
+    Returns `iterable` unchanged if instrumentation is disabled.
+    """
+    if _metrics is None:
+        return iterable
+    return _timed_iter(_metrics, iter(iterable), stage)
+
+
+def _timed_iter(metrics, iterator, stage):
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            metrics.observe(stage, time.perf_counter() - start)
+            return
+        metrics.observe(stage, time.perf_counter() - start)
+        yield item
+
+
+def counted_iter(iterable, name, size=len):
+    """Add `size(item)` to counter `name` for each item in `iterable`, e.g. the bytes in each downloaded chunk.
+
+    Returns `iterable` unchanged if instrumentation is disabled.
+    """
+    if _metrics is None:
+        return iterable
+    return _counted_iter(_metrics, iterable, name, size)
+
+
+def _counted_iter(metrics, iterable, name, size):
+    for item in iterable:
+        metrics.count(name, size(item))
+        yield item
+
+
+def report():
+    """Call the hooks of the active `Metrics`, and return the metrics (None if instrumentation is disabled)."""
+    if _metrics is not None:
+        return _metrics.report()
+
+
+def format_metrics(data):
+    """Format metrics (as returned by `Metrics.snapshot`) as a human-readable text table."""
+    lines = ["%-12s %8s %12s %12s" % ("Stage", "Calls", "Total ms", "Max ms")]
+    for stage, timer in sorted(data['timers'].items(), key=lambda item: -item[1]['seconds']):
+        lines.append("%-12s %8d %12.3f %12.3f" % (stage, timer['calls'], timer['seconds'] * 1000, timer['max'] * 1000))
+    lines += ["%-30s %12s" % (name, value) for name, value in sorted(data['counters'].items())]
+    return "\n".join(lines)
+
+
+def print_hook(data):
+    """Hook printing the metrics as a table."""
+    print(format_metrics(data))
+
+
+def format_prometheus(data, prefix="transloc_"):
+    """Format metrics (as returned by `Metrics.snapshot`) in the Prometheus text exposition format."""
+    lines = []
+    for name, value in sorted(data['counters'].items()):
+        lines += ["# TYPE %s%s_total counter" % (prefix, name), "%s%s_total %s" % (prefix, name, value)]
+    for metric, field, kind in [('stage_calls_total', 'calls', 'counter'),
+                                ('stage_seconds_total', 'seconds', 'counter'),
+                                ('stage_max_seconds', 'max', 'gauge')]:
+        lines.append("# TYPE %s%s %s" % (prefix, metric, kind))
+        lines += ['%s%s{stage="%s"} %r' % (prefix, metric, stage, timer[field])
+                  for stage, timer in sorted(data['timers'].items())]
+    return "\n".join(lines) + "\n"
+
+
+class PrometheusFileHook:
+    """Hook writing the metrics to a file in the Prometheus text format.
+
+    The file is replaced atomically, so a scraper never reads a half-written file.
+
+    Args:
+        filename: File to write, e.g. "/var/lib/node_exporter/textfile_collector/transloc.prom".
+        prefix: Prefix for all metric names.
+    """
+
+    def __init__(self, filename, prefix="transloc_"):
+        self.filename = filename
+        self.prefix = prefix
+
+    def __call__(self, data):
+        fd, tmpfn = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.filename)), suffix=".tmp")
+        with os.fdopen(fd, 'w') as fd:
+            fd.write(format_prometheus(data, prefix=self.prefix))
+        os.replace(tmpfn, self.filename)
+
+
+def test_metrics():
+    assert get_metrics() is None
+    with timer('parse'):  # No-op while disabled.
+        count('records_parsed')
+    reports = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        prom_fn = os.path.join(tmpdir, "metrics.prom")
+        with instrumented(hooks=[reports.append, PrometheusFileHook(prom_fn)]) as metrics:
+            for _ in range(3):
+                with timer('parse'):
+                    count('records_parsed', 10)
+            assert list(timed_iter(range(4), 'filter')) == [0, 1, 2, 3]
+            assert list(counted_iter([b"ab", b"cde"], 'http_bytes')) == [b"ab", b"cde"]
+            data = report()
+        assert get_metrics() is None
+        assert reports == [data]
+        assert data['counters'] == {'records_parsed': 30, 'http_bytes': 5}
+        assert data['timers']['parse']['calls'] == 3 and data['timers']['filter']['calls'] == 5
+        with open(prom_fn) as fd:
+            text = fd.read()
+    assert "transloc_records_parsed_total 30\n" in text and "transloc_http_bytes_total 5\n" in text
+    assert 'transloc_stage_calls_total{stage="parse"} 3\n' in text
+    assert "records_parsed" in format_metrics(data)
+    metrics.reset()
+    assert metrics.snapshot() == {'counters': {}, 'timers': {}}
+
+
+if __name__ == '__main__':
+    test_metrics()
@@ -1,4 +1,4 @@
-from distutils.core import setup
+from setuptools import setup
 
 
 long_description = """
@@ -17,7 +17,9 @@ setup(
     long_description=long_description,
     # long_description=open('README.txt').read(),
     version='0.1.0dev',  # Update for each new version
-    packages=['practical_python'],  # List all packages (directories) to include in the source dist.
+    # List all packages (directories) to include in the source dist:
+    packages=['practical_python', 'practical_python.utils',
+              'practical_python.examples', 'practical_python.examples.webapis'],
     url='https://github.com/scholer/practical_python_tutorial',
     download_url='https://github.com/scholer/practical_python_tutorial/archive/master.zip',
     author='Rasmus Scholer Sorensen',
@@ -35,9 +37,10 @@ setup(
     # When the package is installed with pip, a script is automatically created (.exe for Windows).
     # Note: The entry points are stored in ./gelutils.egg-info/entry_points.txt, which is used by pkg_resources.
     entry_points={
-        # 'console_scripts': [
-        #     # These should all be lower-case, else you may get an error when uninstalling:
-        # ],
+        'console_scripts': [
+            # These should all be lower-case, else you may get an error when uninstalling:
+            'transloc-daemon=practical_python.examples.webapis.transloc_daemon:main',
+        ],
         # 'gui_scripts': [
         # ]
     },